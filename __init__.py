@@ -25,6 +25,7 @@ from bpy.utils.toolsystem import ToolDef
 from bpy.props import IntProperty, FloatProperty, FloatVectorProperty, StringProperty, BoolProperty
 from bpy.types import WorkSpaceTool
 from bpy_extras.io_utils import ImportHelper
+from bpy_extras import view3d_utils
 
 # Load local modules
 print("Path: {}".format(os.path.realpath(__file__)))
@@ -32,6 +33,59 @@ sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
 for dir in sys.path:
     print("{}".format(dir))
 import gcode
+import analysis
+import collision
+import compare
+import envelope
+import live
+import lod
+import machines
+import optimize
+import planner
+import preview
+import playback
+import segments
+import spatial
+import voxel
+import writer
+
+# Seconds between the checks of the zoom level
+LOD_INTERVAL = 0.25
+
+# Seconds between the playback ticks
+PLAY_INTERVAL = 1.0 / 30
+
+# Points of a spline of the drawn curve
+SPLINE_POINTS = 4096
+
+# Seconds between the checks of the loaded file for changes
+WATCH_INTERVAL = 1.0
+
+# Seconds between the drains of a live feed
+LIVE_INTERVAL = 1.0 / 60
+
+# Colours of the removed, added and modified toolpath of a comparison
+DIFF_COLORS = {
+    compare.REMOVED: (1.0, 0.2, 0.2, 1.0),
+    compare.ADDED: (0.2, 1.0, 0.3, 1.0),
+    compare.MODIFIED: (1.0, 0.8, 0.1, 1.0),
+}
+
+# Prefix of the curves the machines draw, followed by the machine name
+MACHINE_CURVE = "CNCCurve_"
+
+# Viewport colors of the toolpath layers, in the order of segments.LAYERS
+LAYER_COLORS = (
+    (1.0, 0.2, 0.2, 1.0),
+    (0.2, 0.6, 1.0, 1.0),
+    (1.0, 0.8, 0.1, 1.0),
+    (0.3, 1.0, 0.4, 1.0),
+    (0.6, 0.6, 0.6, 1.0),
+)
+
+# Colours of the air cuts and the rapids in the material removal colouring
+AIR_COLOR = (1.0, 0.0, 0.0, 1.0)
+RAPID_COLOR = (0.5, 0.5, 0.5, 1.0)
 
 # Virtual CNC
 class VirtualCNC():
@@ -44,21 +98,61 @@ class VirtualCNC():
     offset = Vector([0,0,0])
     state = None
     curve = None
-    resolution = 5
     message = "Initialized"
     statement = "No codes yet"
     polyline = None
+    # Points written to the spline drawn into
+    polylinePoints = 0
     finished = False
+    # Segment arrays and spatial index of the whole simulated program
+    simulation = None
+    segments = None
+    index = None
+    picked = None
+    # Simplified toolpath meshes, the level shown and the time window shown
+    # in full detail
+    lod = None
+    lodMeshes = None
+    lodLevel = -1
+    lodWindow = None
+    # Real time playback of the state
+    player = None
+    # Modification time and size of the file when it was loaded
+    fileStamp = None
+    # Volumetric stock cut by the paths as they are drawn
+    voxels = None
+    # Material removed by every segment of the simulated program
+    analysis = None
+    # The machine profile the simulation was timed with, None when it was
+    # not planned
+    profile = None
+    # A job streamed by a sender, and the server receiving it
+    live = None
+    liveServer = None
+    # Machines running programs of their own side by side, and by machine
+    # name the spline each draws and the points written to it
+    machines = None
+    machineSplines = None
 
     def __init__(self):
         self.filename = None
 
+    # The modification time and size of the loaded file, None without one
+    def file_stamp(self):
+        try:
+            info = os.stat(self.filename)
+        except (OSError, TypeError):
+            return None
+        return (info.st_mtime, info.st_size)
+
     def load_program(self):
         self.MoveObject = bpy.context.scene.MoveObject
         self.debug = bpy.context.scene.CNCDebug
         if self.filename:
+            self.fileStamp = self.file_stamp()
             self.program = gcode.parse_program(self.filename)
             self.run_program()
+            self.simulate()
         else:
             self.message = "No filename"
         self.CNCObject = bpy.context.scene.objects[bpy.context.scene.CNCObject]
@@ -73,6 +167,282 @@ class VirtualCNC():
             self.state.lineno = 0
             self.finished = False
             self.message = "Loaded {} statements".format(len(self.program.statements))
+
+    # Load the file again after it changed on disk. The states go back to
+    # before the first changed statement and only run on from there, and
+    # the toolpath geometry built so far is patched with the new paths.
+    def reload_program(self):
+        if not self.simulation:
+            self.load_program()
+            return
+        self.fileStamp = self.file_stamp()
+        program = gcode.parse_program(self.filename)
+        change = gcode.first_change(self.program, program)
+        if change is None:
+            self.message = "No changes"
+            return
+        kept = self.simulation.reload(program)
+        self.program = program
+        self.simulation.run()
+        self.segments = segments.from_reload(self.segments, self.simulation, kept)
+        self.index = spatial.SegmentIndex(self.segments)
+        self.picked = None
+        self.analysis = None
+        if self.state:
+            self.reload_state(program)
+
+        # Only the geometry that was built
+        if self.lod is not None:
+            self.build_lod()
+        if bpy.data.objects.get("CNCMesh"):
+            self.build_mesh(self.segments)
+        if bpy.data.objects.get("CNC" + segments.LAYERS[0]):
+            self.build_layers()
+        self.message = "Reloaded from statement {}, {} paths kept".format(change, kept)
+
+    # Take the stepped state back to before the changes. The curve drawn past
+    # them is drawn again from the paths kept, in one go.
+    def reload_state(self, program):
+        drawn = len(self.state.paths)
+        kept = self.state.reload(program)
+        if kept is None:
+            return
+        self.currentline = self.state.lineno
+        self.finished = False
+        if kept < drawn:
+            self.delete_polyline()
+            self.draw_paths([path for record in self.state.paths.values() for path in record.expand()])
+        if self.player:
+            self.play()
+
+    # Run a separate copy of the program to the end and index its toolpath
+    def simulate(self):
+        state = self.program.start()
+        state.scale = bpy.context.scene.CNCScale
+        state.run()
+        self.simulation = state
+        self.segments = segments.from_state(state)
+        self.index = spatial.SegmentIndex(self.segments)
+        self.picked = None
+        self.lod = None
+        self.voxels = None
+        self.analysis = None
+        self.profile = None
+
+    # Returns the statement drawn closest to the given viewport ray, which is
+    # in Blender world coordinates
+    def pick(self, origin, direction, radius):
+        if not self.index:
+            return None
+        scale = self.segments.scale
+        origin = (origin - self.offset.to_3d()) * scale
+        i = self.index.pick(origin, direction, radius * scale)
+        if i is None:
+            return None
+        self.picked = self.segments.paths[i].statement
+        return self.picked
+
+    # Get the named object showing the given mesh, creating it if needed
+    def mesh_object(self, name, mesh, collection=None):
+        obj = bpy.data.objects.get(name)
+        if obj is not None and obj.type != 'MESH':
+            bpy.data.objects.remove(obj)
+            obj = None
+        if obj is None:
+            obj = bpy.data.objects.new(name, mesh)
+            (collection or bpy.context.scene.collection).objects.link(obj)
+        elif obj.data != mesh:
+            obj.data = mesh
+        return obj
+
+    # Fill a mesh with the loose edges of a polyline given in machine units,
+    # one bulk write each for the vertices and the edges
+    def fill_edges(self, mesh, points, connect):
+        co = points / self.segments.scale + numpy.array(self.offset.to_3d())
+        edges = lod.edges(connect)
+        mesh.clear_geometry()
+        mesh.vertices.add(len(co))
+        mesh.vertices.foreach_set("co", co.astype(numpy.float32).ravel())
+        mesh.edges.add(len(edges))
+        mesh.edges.foreach_set("vertices", edges.astype(numpy.int32).ravel())
+        mesh.update()
+
+    # Fill a mesh with quads given in machine units
+    def fill_quads(self, mesh, vertices, quads):
+        co = vertices / self.segments.scale + numpy.array(self.offset.to_3d())
+        mesh.clear_geometry()
+        mesh.vertices.add(len(co))
+        mesh.vertices.foreach_set("co", co.astype(numpy.float32).ravel())
+        mesh.loops.add(quads.size)
+        mesh.loops.foreach_set("vertex_index", quads.astype(numpy.int32).ravel())
+        mesh.polygons.add(len(quads))
+        mesh.polygons.foreach_set("loop_start", numpy.arange(0, quads.size, 4, dtype=numpy.int32))
+        mesh.polygons.foreach_set("loop_total", numpy.full(len(quads), 4, dtype=numpy.int32))
+        mesh.update()
+
+    # A fresh voxel stock around the cutting moves of the program, from the
+    # stock top down to the deepest cut
+    def build_voxels(self):
+        scene = bpy.context.scene
+        (lo, hi) = self.segments.bounds()
+        cuts = ~self.segments.rapid
+        if cuts.any():
+            (lo, hi) = (lo[cuts], hi[cuts])
+        lo = lo.min(axis=0)
+        hi = hi.max(axis=0)
+        radius = scene.CNCToolDiameter / 2
+        lo[:2] -= radius
+        hi[:2] += radius
+        lo[2] = min(lo[2], scene.CNCStockTop) - scene.CNCVoxelSize
+        hi[2] = scene.CNCStockTop
+        self.voxels = voxel.VoxelStock(lo, hi, scene.CNCVoxelSize)
+        self.update_voxels()
+
+    # Cut the stock along the given paths
+    def cut_voxels(self, paths):
+        scene = bpy.context.scene
+        segs = segments.Segments(paths, self.segments.scale)
+        self.voxels.cut_segments(segs, scene.CNCToolDiameter / 2, scene.CNCToolLength)
+        self.update_voxels()
+
+    # Write the surface of the stock chunks changed since the last update,
+    # one mesh per chunk, so the rest of the view is left alone
+    def update_voxels(self):
+        collection = bpy.data.collections.get("CNCStock")
+        if collection is None:
+            collection = bpy.data.collections.new("CNCStock")
+            bpy.context.scene.collection.children.link(collection)
+        for chunk in self.voxels.take_dirty():
+            name = "CNCVoxel_%d_%d_%d" % tuple(chunk)
+            mesh = bpy.data.meshes.get(name) or bpy.data.meshes.new(name)
+            (vertices, quads) = self.voxels.surface(self.voxels.chunk_blocks(chunk))
+            self.fill_quads(mesh, vertices, quads)
+            self.mesh_object(name, mesh, collection)
+
+    # Build the simplified copies of the whole toolpath, shown one at a time
+    # by show_lod
+    def build_lod(self):
+        scene = bpy.context.scene
+        self.lod = lod.ToolpathLOD(self.segments, scene.CNCDetailTolerance)
+        self.lodMeshes = []
+        for (i, level) in enumerate(self.lod.levels):
+            name = "CNCToolpathLOD%d" % i
+            mesh = bpy.data.meshes.get(name) or bpy.data.meshes.new(name)
+            self.fill_edges(mesh, level.points, level.connect)
+            self.lodMeshes.append(mesh)
+        self.lodLevel = -1
+        self.lodWindow = None
+        self.show_lod(len(self.lodMeshes) - 1)
+
+    def show_lod(self, level):
+        level = min(max(level, 0), len(self.lodMeshes) - 1)
+        if level != self.lodLevel:
+            self.mesh_object("CNCToolpathLOD", self.lodMeshes[level])
+            self.lodLevel = level
+
+    # Write the toolpath as one loose-edge mesh with the statement of every
+    # edge in its "lineno" attribute. With a bevel it becomes a curve instead,
+    # as only curves can be given a thickness.
+    def build_mesh(self, segs):
+        scene = bpy.context.scene
+        level = lod.chain(segs, scene.CNCDetailTolerance)
+        if scene.CNCBevel > 0:
+            self.build_curve(level.points, level.connect, scene.CNCBevel)
+            return
+        mesh = bpy.data.meshes.get("CNCMesh") or bpy.data.meshes.new("CNCMesh")
+        self.fill_edges(mesh, level.points, level.connect)
+        # Mesh attributes are only there from Blender 2.91
+        if hasattr(mesh, "attributes"):
+            lineno = mesh.attributes.get("lineno") or mesh.attributes.new("lineno", 'INT', 'EDGE')
+            ends = lod.edges(level.connect)[:, 1]
+            lineno.data.foreach_set("value", segs.lineno[level.owner[ends]].astype(numpy.int32))
+            if self.analysis is not None and len(self.analysis.segments) == len(segs):
+                self.color_analysis(mesh, level.owner)
+        self.mesh_object("CNCMesh", mesh)
+
+    # Colour the points of a toolpath mesh from blue to green by the material
+    # removal rate, air cuts red, for display through an attribute node
+    def color_analysis(self, mesh, owner):
+        result = self.analysis
+        rate = result.mrr / max(result.mrr.max(), 1e-9)
+        colors = numpy.stack((numpy.zeros(len(rate)), rate, 1 - rate, numpy.ones(len(rate))), axis=1)
+        colors[result.air] = AIR_COLOR
+        colors[result.segments.rapid] = RAPID_COLOR
+        color = mesh.attributes.get("mrr_color") or mesh.attributes.new("mrr_color", 'FLOAT_COLOR', 'POINT')
+        color.data.foreach_set("color", colors[owner].astype(numpy.float32).ravel())
+
+    # A curve of POLY splines, one per connected run of the points
+    def build_curve(self, points, connect, bevel):
+        co = points / self.segments.scale + numpy.array(self.offset.to_3d())
+        curve = bpy.data.curves.get("CNCMeshCurve") or bpy.data.curves.new("CNCMeshCurve", type='CURVE')
+        curve.splines.clear()
+        curve.dimensions = '3D'
+        curve.bevel_depth = bevel
+        breaks = numpy.nonzero(~connect)[0] + 1
+        for run in numpy.split(numpy.arange(len(co)), breaks):
+            if len(run) < 2:
+                continue
+            spline = curve.splines.new('POLY')
+            spline.points.add(len(run) - 1)
+            spline.points.foreach_set("co", numpy.hstack((co[run], numpy.ones((len(run), 1)))).astype(numpy.float32).ravel())
+        obj = bpy.data.objects.get("CNCMesh")
+        if obj is not None and obj.data != curve:
+            # The mesh of an earlier build, the types can not be swapped
+            bpy.data.objects.remove(obj)
+        if bpy.data.objects.get("CNCMesh") is None:
+            bpy.context.scene.collection.objects.link(bpy.data.objects.new("CNCMesh", curve))
+
+    # Build one object per toolpath layer in the CNCToolpath collection, each
+    # with a per vertex feed rate (mm/min) for colour ramps
+    def build_layers(self):
+        scene = bpy.context.scene
+        collection = bpy.data.collections.get("CNCToolpath")
+        if collection is None:
+            collection = bpy.data.collections.new("CNCToolpath")
+            scene.collection.children.link(collection)
+        layers = self.segments.layers()
+        for (i, name) in enumerate(segments.LAYERS):
+            idx = numpy.nonzero(layers == i)[0]
+            (points, owner, _) = self.segments.tessellate(scene.CNCDetailTolerance, idx)
+            name = "CNC" + name
+            mesh = bpy.data.meshes.get(name) or bpy.data.meshes.new(name)
+            self.fill_edges(mesh, points, owner[1:] == owner[:-1])
+            # Mesh attributes are only there from Blender 2.91
+            if hasattr(mesh, "attributes"):
+                feed = mesh.attributes.get("feed_rate") or mesh.attributes.new("feed_rate", 'FLOAT', 'POINT')
+                feed.data.foreach_set("value", (self.segments.feedRate[owner] * 60).astype(numpy.float32))
+            obj = self.mesh_object(name, mesh, collection)
+            obj.color = LAYER_COLORS[i]
+            obj.hide_viewport = not scene.CNCShowLayers[i]
+
+    # Build one object per kind of change of a comparison of the loaded
+    # program with another version in the CNCDiff collection, the removed
+    # toolpath taken from the loaded program and the rest from the other
+    def build_diff(self, comparison):
+        scene = bpy.context.scene
+        collection = bpy.data.collections.get("CNCDiff")
+        if collection is None:
+            collection = bpy.data.collections.new("CNCDiff")
+            scene.collection.children.link(collection)
+        for status in (compare.REMOVED, compare.ADDED, compare.MODIFIED):
+            segs = comparison.old if status == compare.REMOVED else comparison.new
+            (points, owner, _) = segs.tessellate(scene.CNCDetailTolerance, comparison.indices(status))
+            name = "CNCDiff" + compare.STATUS[status].capitalize()
+            mesh = bpy.data.meshes.get(name) or bpy.data.meshes.new(name)
+            self.fill_edges(mesh, points, owner[1:] == owner[:-1])
+            obj = self.mesh_object(name, mesh, collection)
+            obj.color = DIFF_COLORS[status]
+
+    # Show the part of the toolpath passed between t0 and t1 in full detail
+    def show_detail(self, t0, t1):
+        (points, connect) = self.lod.window(t0, t1)
+        window = (len(points), float(t0), float(t1))
+        if window == self.lodWindow:
+            return
+        mesh = bpy.data.meshes.get("CNCToolpathDetail") or bpy.data.meshes.new("CNCToolpathDetail")
+        self.fill_edges(mesh, points, connect)
+        self.mesh_object("CNCToolpathDetail", mesh)
+        self.lodWindow = window
                         
     def create_polyline(self):
         if not self.polyline:
@@ -81,6 +451,7 @@ class VirtualCNC():
             curve.resolution_u = 2
             polyline = curve.splines.new('POLY')
             self.polyline = polyline
+            self.polylinePoints = 0
             CNCCurve = bpy.data.objects.new('CNCCurve', curve)
             scn =  bpy.context.scene
             self.curve = CNCCurve
@@ -98,74 +469,209 @@ class VirtualCNC():
         scn = bpy.context.scene
         if self.finished:
             return
-        while self.currentline != self.lines:
+        if scn.CNCOutputMode == 'MESH':
+            # Run the rest of the program and write it out in one go
+            self.state.run()
+            segs = segments.from_state(self.state)
+            self.build_mesh(segs)
+            if self.voxels is not None:
+                self.cut_voxels(segs.paths)
+            self.finished = True
+            self.message = "Completed, you have to reset"
+            return
+        while not self.finished and not self.state.finished:
             self.layout_path()
             dg = bpy.context.evaluated_depsgraph_get()
             dg.update()
 
-    def get_intermediates(self, path):
-        if (isinstance(path, gcode.Line)):
-            nb_points = numpy.floor(path.length * (self.resolution * self.state.scale) / path.feedRate)
-            x_spacing = (path.end.x - path.start.x) / (nb_points + 1)
-            y_spacing = (path.end.y - path.start.y) / (nb_points + 1) 
-            z_spacing = (path.end.z - path.start.z) / (nb_points + 1)
-
-            return [Vector([path.start.x + i * x_spacing, 
-                            path.start.y + i * y_spacing, 
-                            path.start.z + i * z_spacing])
-                for i in range(1, int(nb_points + 1))]
-
-        elif (isinstance(path, gcode.Arc)):
-            angle1 = path.angle1
-            angle2 = path.angle2
-
-            # Calculate nr of points needed along the arc
-            nb_points = numpy.floor(path.length * (self.resolution * self.state.scale) / path.feedRate)
-
-            # Make sure there is at least 2 points in the arc
-            if nb_points == 0:
-                nb_points = 2
-
-            arc = abs((angle2 - angle1)) / nb_points
-            if arc == float(0): return []
-            points = []
-            (px, py, pz) = path.center
-            for p in range(1, int(nb_points)):
-                if path.plane == "XY" and path.clockwise:
-                    px = path.center.x + (path.radius * math.cos(angle1 + (arc * p)))
-                    py = path.center.y + (path.radius * math.sin(angle1 + (arc * p)))
-                elif path.plane == "XY":
-                    px = path.center.x + (path.radius * math.sin(angle1 + (arc * p)))
-                    py = path.center.y + (path.radius * math.cos(angle1 + (arc * p)))
-                elif path.plane == "ZX" and path.clockwise:
-                    pz = path.center.z + (path.radius * math.sin(angle1 + (arc * p)))
-                    px = path.center.x + (path.radius * math.cos(angle1 + (arc * p)))
-                elif path.plane == "ZX":
-                    pz = path.center.z + (path.radius * math.cos(angle1 + (arc * p)))
-                    px = path.center.x + (path.radius * math.sin(angle1 + (arc * p)))
-                elif path.plane == "YZ" and path.clockwise:
-                    py = path.center.y + (path.radius * math.sin(angle1 + (arc * p)))
-                    pz = path.center.z + (path.radius * math.cos(angle1 + (arc * p)))
-                elif path.plane == "YZ":
-                    py = path.center.y + (path.radius * math.cos(angle1 + (arc * p)))
-                    pz = path.center.z + (path.radius * math.sin(angle1 + (arc * p)))
-                else:
-                    print("Unknown plane {}".format(self.plane))
-                points.append(Vector([px,py,pz]))
-            return points
-
     def move_object(self, location):
-        adapted_location = self.location.to_3d() + self.offset.to_3d()
+        adapted_location = location.to_3d() + self.offset.to_3d()
         self.CNCObject.location = adapted_location
 
     def draw_line(self, location):
+        self.draw_points([location])
+
+    # Add points (n, 3) to the curve. The points of the spline drawn into are
+    # written again in one go with every batch, so after SPLINE_POINTS the
+    # curve goes on in a new spline.
+    def draw_points(self, points):
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        if not len(points):
+            return
         if not self.polyline:
             self.create_polyline()
-        adapted_location = self.location.to_3d() + self.offset.to_3d()
-        self.polyline.points.add(1)
-        self.polyline.points[-1].co = adapted_location.to_4d()
+        co = numpy.ones((len(points), 4))
+        co[:, :3] = points + numpy.array(self.offset.to_3d())
+        while len(co):
+            if self.polylinePoints >= SPLINE_POINTS:
+                last = tuple(self.polyline.points[-1].co)
+                self.polyline = self.curve.data.splines.new('POLY')
+                self.polyline.points[0].co = last
+                self.polylinePoints = 1
+            spline = self.polyline
+            batch = co[:SPLINE_POINTS - self.polylinePoints]
+            co = co[len(batch):]
+            # A new spline comes with a point not drawn yet
+            old = numpy.zeros(len(spline.points) * 4, dtype=numpy.float32)
+            spline.points.foreach_get("co", old)
+            old = old.reshape(-1, 4)[:self.polylinePoints]
+            spline.points.add(self.polylinePoints + len(batch) - len(spline.points))
+            spline.points.foreach_set("co", numpy.vstack((old, batch)).astype(numpy.float32).ravel())
+            self.polylinePoints += len(batch)
+
+    # The points the paths are drawn with, the arcs within the chord
+    # tolerance of playback
+    def path_points(self, paths):
+        segs = segments.Segments(paths)
+        return segs.tessellate(playback.TOLERANCE / self.state.scale)[0]
+
+    # Draw many paths as one update of the curve, or move the object to
+    # where the last one ends. Playback gives the points, up to where the
+    # tool is within the move under way.
+    def draw_paths(self, paths, points=None):
+        if points is None:
+            points = self.path_points(paths)
+        if len(points):
+            self.location = Vector(points[-1])
+            if self.MoveObject:
+                self.move_object(self.location)
+            else:
+                self.draw_points(points)
+        if self.voxels is not None and paths:
+            self.cut_voxels(paths)
+
+    # Start playing in real time from the current statement
+    def play(self):
+        scene = bpy.context.scene
+        self.player = playback.PlaybackScheduler(self.state, scene.CNCPlaySpeed, scene.CNCTickBudget / 1000.0)
+        self.player.start()
+
+    # Play the machine time passed since the last tick
+    def play_tick(self):
+        if self.player is None or self.finished:
+            return
+        self.player.tick(self.draw_paths)
+        self.currentline = self.state.lineno
+        self.message = "Playing {:.1f} s".format(self.player.time)
+        if self.player.done():
+            self.finished = True
+            self.message = "Completed, you have to reset"
+
+    # Mirror a job streamed by a sender, starting from an empty program
+    def start_live(self, address):
+        scene = bpy.context.scene
+        self.stop_live()
+        feed = live.LiveFeed(scene.CNCLiveQueue)
+        server = live.LiveServer(feed, address)
+        server.start()
+        self.liveServer = server
+        self.live = live.LiveMirror(feed, scene.CNCScale)
+        self.program = self.live.program
+        self.state = self.live.state
+        self.MoveObject = scene.MoveObject
+        self.CNCObject = scene.objects[scene.CNCObject]
+        self.delete_polyline()
+        self.finished = False
+        self.message = "Listening on {}".format(server.ptyName or address)
+
+    def stop_live(self):
+        if self.liveServer is not None:
+            self.liveServer.stop()
+            self.liveServer = None
+        if self.live is not None:
+            self.live.close()
+            self.live = None
+            self.finished = True
+            self.message = "Live stopped"
+
+    # Run and draw what the sender streamed since the last drain, and move
+    # the object to where the sender last reported the machine
+    def live_tick(self):
+        scene = bpy.context.scene
+        records = self.live.drain(scene.CNCLiveBatch, scene.CNCTickBudget / 1000.0)
+        if records:
+            self.draw_paths([path for record in records for path in record.expand()])
+        position = self.live.machine_position()
+        if position is not None:
+            self.location = Vector(position) / self.state.scale
+            self.move_object(self.location)
+        self.currentline = self.state.lineno
+        self.lines = len(self.program.statements)
+        if records:
+            self.message = "Live: {} lines, {} waiting".format(self.live.feed.received, self.live.pending())
+
+    # Simulate the programs of all the machines of the scene on the workers
+    # and play them together once they are ready
+    def start_machines(self):
+        scene = bpy.context.scene
+        names = [settings.name for settings in scene.CNCMachines if settings.filename]
+        if len(set(names)) < len(names):
+            raise ValueError("Every machine needs a name of its own")
+        self.stop_machines()
+        self.machines = machines.MachineScheduler(scene.CNCWorkers, scene.CNCWorkerProcesses)
+        self.machineSplines = {}
+        for settings in scene.CNCMachines:
+            if not settings.filename:
+                continue
+            self.machines.add(machines.Machine(settings.name, bpy.path.abspath(settings.filename),
+                settings.offset, settings.target, scene.CNCPlaySpeed))
+        self.machines.start()
+        self.message = "Simulating {} programs".format(len(self.machines.machines))
+
+    def stop_machines(self):
+        if self.machines is not None:
+            self.machines.shutdown()
+            self.machines = None
+            self.message = "Machines stopped"
+
+    def machines_tick(self):
+        self.machines.tick(self.draw_machine)
+        if not self.machines.ready():
+            return
+        failed = [m.name for m in self.machines.machines.values() if m.error is not None]
+        if failed:
+            self.message = "Failed: {}".format(", ".join(failed))
+        elif self.machines.done():
+            self.message = "Machines completed"
+        else:
+            self.message = "Playing {} machines".format(len(self.machines.machines))
+
+    # The spline a machine draws into, on a curve object of its own emptied
+    # from the last run, and the points written to it
+    def machine_spline(self, name):
+        if name not in self.machineSplines:
+            curveName = MACHINE_CURVE + name
+            curve = bpy.data.curves.get(curveName) or bpy.data.curves.new(curveName, type='CURVE')
+            curve.splines.clear()
+            curve.dimensions = '3D'
+            spline = curve.splines.new('POLY')
+            if bpy.data.objects.get(curveName) is None:
+                bpy.context.scene.collection.objects.link(bpy.data.objects.new(curveName, curve))
+            self.machineSplines[name] = [spline, 0]
+        return self.machineSplines[name]
+
+    # Add the points (mm) a machine finished to its curve and move its object
+    # to where its tool is, both placed at the machine offset
+    def draw_machine(self, machine, points, position):
+        scale = bpy.context.scene.CNCScale
+        offset = numpy.array(machine.offset)
+        if len(points):
+            entry = self.machine_spline(machine.name)
+            (spline, first) = entry
+            co = points / scale + offset
+            # A new spline starts out with one point of its own
+            spline.points.add(first + len(co) - len(spline.points))
+            for (i, point) in enumerate(co):
+                spline.points[first + i].co = (point[0], point[1], point[2], 1.0)
+            entry[1] = first + len(co)
+        target = bpy.context.scene.objects.get(machine.target or "")
+        if target is not None and position is not None:
+            target.location = Vector(position / scale + offset)
 
     def layout_path(self):
+        # The statement about to run, loops and calls jump around so it is
+        # taken from the state rather than counted here
+        self.currentline = self.state.lineno
 
         # Progress the parsing and get next statement
         self.state.step()
@@ -184,62 +690,28 @@ class VirtualCNC():
             self.message = "{}".format(self.program.statements[self.currentline].command)
 
         # If this contains a path, progress
-        try: 
-            path = self.state.paths[self.currentline]
-            self.message = "Drawing path {}".format(self.currentline)
-            if self.debug: print(path)
-        except:
-            self.currentline += 1
+        if not self.state.stepPaths:
             return
+        self.message = "Drawing path {}".format(self.currentline)
+        if self.debug: print(self.state.stepPaths)
 
         if self.finished:
             self.message = "Completed, you have to reset"
             return
 
-        # 
-        if (isinstance(path, gcode.Line)):
-            if self.MoveObject:
-                self.move_object(path.start)
-            else:
-                self.draw_line(path.start)
-            self.location = path.start
-            for nextpoint in self.get_intermediates(path):
-                if nextpoint == path.start or nextpoint == path.end:
-                    next
-                if self.debug: print("Line to {},{},{}".format(nextpoint.x,nextpoint.y,nextpoint.z))
-                if self.MoveObject:
-                    self.move_object(nextpoint)
-                else:
-                    self.draw_line(nextpoint)
-                self.location = nextpoint
-            if self.MoveObject:
-                self.move_object(path.end)
-            else:
-                self.draw_line(path.end)
-            self.location = path.end
-
-        elif (isinstance(path, gcode.Arc)):
-            self.location = path.start
-            for nextpoint in self.get_intermediates(path):
-                if nextpoint == path.start or nextpoint == path.end:
-                    next
-                if self.debug: print("Arc line to {},{},{}".format(nextpoint.x,nextpoint.y,nextpoint.z))
-                if self.MoveObject:
-                    self.move_object(nextpoint)
-                else:
-                    self.draw_line(nextpoint)
-                self.location = nextpoint
-            if self.location != path.start:
-                if self.MoveObject:
-                    self.move_object(nextpoint)
-                else:
-                    self.draw_line(nextpoint)
-                self.location = path.end
+        for path in self.state.stepPaths:
+            # Records like canned cycles are drawn move by move
+            for subpath in path.expand():
+                self.draw_path(subpath)
+
+    def draw_path(self, path):
+        if (isinstance(path, (gcode.Line, gcode.Arc))):
+            if self.debug: print("{} to {},{},{}".format(type(path).__name__, path.end.x, path.end.y, path.end.z))
+            self.draw_paths([path])
+        elif (isinstance(path, (gcode.Dwell, gcode.ToolChange))):
+            pass
         else:        
             print("This class of path is not implemented")
-        self.currentline += 1
-        if self.currentline == self.lines:
-            self.finished = True
 
     def reset(self):
         self.offset = Vector([self.CNCObject.location.x, self.CNCObject.location.y, self.CNCObject.location.z])
@@ -248,6 +720,15 @@ class VirtualCNC():
         self.state.lineno = 0
         self.finished = False
         self.statement = "Offset: {}, {}, {}".format(self.offset.x, self.offset.y, self.offset.y)
+        if self.voxels is not None:
+            self.build_voxels()
+
+# A machine of the scene: its program, where its program zero is and the
+# object following its tool
+class CNCMachineSettings(bpy.types.PropertyGroup):
+    filename: StringProperty(name="Program", subtype='FILE_PATH')
+    target: StringProperty(name="Object")
+    offset: FloatVectorProperty(name="Offset", size=3)
 
 # CNC Operator
 class CNCOperator_OT_Modal(bpy.types.Operator):
@@ -326,8 +807,10 @@ class CNCOperator_OT_Modal(bpy.types.Operator):
                     self.cancel(context)
                     return {'CANCELLED'}
             elif self.dir == 'play':
-                vcnc.layout_path()
-                self.report({'INFO'}, "Line %s, statement: %s" % (vcnc.currentline, vcnc.statement))
+                vcnc.play_tick()
+                if vcnc.finished:
+                    self.cancel(context)
+                    return {'CANCELLED'}
             else:
                 self.cancel(context)
                 return {'CANCELLED'}
@@ -359,10 +842,14 @@ class CNCOperator_OT_Modal(bpy.types.Operator):
             elif self.dir == 'next':
                 vcnc.layout_path() 
                 return {'CANCELLED'}
+            elif self.dir == 'all':
+                vcnc.draw_all()
+                return {'CANCELLED'}
             elif self.dir == 'reset':
                 vcnc.reset()
                 return {'CANCELLED'}
             elif self.dir == 'play':
+                vcnc.play()
                 self.report({'INFO'}, "Line %s, statement: %s" % (vcnc.currentline, vcnc.statement))
             elif self.dir == 'stop':
                 self.report({'INFO'}, "Stopping")
@@ -374,7 +861,7 @@ class CNCOperator_OT_Modal(bpy.types.Operator):
             self.cancel(context)
             return {'CANCELLED'}
         wm = context.window_manager
-        self._timer = wm.event_timer_add(0.1, window=context.window)
+        self._timer = wm.event_timer_add(PLAY_INTERVAL if self.dir == 'play' else 0.1, window=context.window)
         wm.modal_handler_add(self)
         return {'RUNNING_MODAL'}
 
@@ -386,6 +873,465 @@ class CNCOperator_OT_Modal(bpy.types.Operator):
             wm.event_timer_remove(self._timer)
         return {'CANCELLED'}
 
+# Select the statement that drew the toolpath under the mouse
+class CNCOperator_OT_Pick(bpy.types.Operator):
+    """Click on the toolpath to find the statement that produced it"""
+    bl_idname = "cnctool.pick"
+    bl_label = "Pick toolpath statement"
+
+    def modal(self, context, event):
+        if event.type in {'RIGHTMOUSE', 'ESC'}:
+            context.window.cursor_modal_restore()
+            return {'CANCELLED'}
+
+        if event.type == 'LEFTMOUSE' and event.value == 'PRESS':
+            context.window.cursor_modal_restore()
+            vcnc = bpy.types.Scene.VirtualCNC
+            coord = (event.mouse_region_x, event.mouse_region_y)
+            origin = view3d_utils.region_2d_to_origin_3d(context.region, context.region_data, coord)
+            direction = view3d_utils.region_2d_to_vector_3d(context.region, context.region_data, coord)
+            st = vcnc.pick(origin, direction, context.scene.CNCPickRadius)
+            if st is None:
+                self.report({'INFO'}, "No toolpath under the mouse")
+                return {'CANCELLED'}
+            vcnc.statement = "Picked line {}: {}".format(st.lineNumber, st.command)
+            self.report({'INFO'}, vcnc.statement)
+            return {'FINISHED'}
+
+        return {'RUNNING_MODAL'}
+
+    def invoke(self, context, event):
+        if context.area.type != 'VIEW_3D':
+            self.report({'WARNING'}, "Pick from the 3D viewport")
+            return {'CANCELLED'}
+        if not bpy.types.Scene.VirtualCNC.index:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+        context.window.cursor_modal_set('EYEDROPPER')
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+# Verify the loaded program against the machine travel and keep-out boxes
+class CNCOperator_OT_CheckLimits(bpy.types.Operator):
+    """Check the program against the machine envelope and the CNCKeepOut collection"""
+    bl_idname = "cnctool.check_limits"
+    bl_label = "Check machine limits"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        env = envelope.Envelope(scene.CNCEnvelopeMin, scene.CNCEnvelopeMax)
+        # Objects in the keep-out collection are converted to machine
+        # coordinates through their world space bounding boxes
+        if 'CNCKeepOut' in bpy.data.collections:
+            scale = vcnc.segments.scale
+            for obj in bpy.data.collections['CNCKeepOut'].all_objects:
+                corners = numpy.array([obj.matrix_world @ Vector(c) for c in obj.bound_box])
+                corners = (corners - numpy.array(vcnc.offset.to_3d())) * scale
+                env.add_keepout(corners.min(axis=0), corners.max(axis=0))
+
+        report = env.check(vcnc.segments)
+        lines = report.lines()
+        if len(lines):
+            vcnc.message = "Limits: {} bad moves, lines {}".format(len(report.violations()), ", ".join(str(n) for n in lines[:10]))
+            self.report({'WARNING'}, vcnc.message)
+        else:
+            vcnc.message = "Limits OK, extents {} to {}".format(numpy.round(report.lo, 3), numpy.round(report.hi, 3))
+            self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Look for rapids travelling through the stock left by the earlier cuts
+class CNCOperator_OT_CheckRapids(bpy.types.Operator):
+    """Check every rapid move against a box stock cut down by the program"""
+    bl_idname = "cnctool.check_rapids"
+    bl_label = "Check rapids against stock"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        radius = scene.CNCToolDiameter / 2
+        heightmap = collision.box_stock(vcnc.segments, radius, scene.CNCStockCell, scene.CNCStockTop)
+        report = collision.RapidChecker(heightmap, radius).check(vcnc.segments)
+        lines = report.lines()
+        if len(lines):
+            vcnc.message = "Rapid collisions on lines {}".format(", ".join(str(n) for n in lines[:10]))
+            self.report({'WARNING'}, vcnc.message)
+        else:
+            vcnc.message = "No rapid collisions"
+            self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Measure the material every move removes and find the air cuts
+class CNCOperator_OT_AnalyseMaterial(bpy.types.Operator):
+    """Work out the material removal rate of every move and the time spent cutting air"""
+    bl_idname = "cnctool.analyse_material"
+    bl_label = "Analyse material removal"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        vcnc.analysis = analysis.analyse(vcnc.segments, scene.CNCToolDiameter / 2,
+            scene.CNCStockCell, scene.CNCStockTop)
+        lines = vcnc.analysis.report()
+        for line in lines:
+            print(line)
+        if bpy.data.objects.get("CNCMesh"):
+            vcnc.build_mesh(vcnc.segments)
+        vcnc.message = lines[0]
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Replace the feed rate based timeline with a kinematic plan of the program
+class CNCOperator_OT_PlanTime(bpy.types.Operator):
+    """Estimate the cycle time with the machine velocity and acceleration limits"""
+    bl_idname = "cnctool.plan_time"
+    bl_label = "Estimate cycle time"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.simulation:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        profile = planner.MachineProfile(scene.CNCMaxVelocity, scene.CNCMaxAcceleration,
+            scene.CNCJunctionDeviation, scene.CNCJerk if scene.CNCJerk > 0 else None)
+        planner.Planner(profile).apply(vcnc.simulation)
+        vcnc.segments = segments.from_state(vcnc.simulation)
+        vcnc.profile = profile
+        seconds = int(round(vcnc.simulation.time))
+        vcnc.message = "Cycle time {}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Build the simplified toolpath meshes switched by the zoom level
+class CNCOperator_OT_BuildLOD(bpy.types.Operator):
+    """Build a toolpath overview that follows the zoom level of the 3D view"""
+    bl_idname = "cnctool.build_lod"
+    bl_label = "Build toolpath overview"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        vcnc.build_lod()
+        vcnc.message = "Toolpath overview with {} levels".format(len(vcnc.lod.levels))
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Build the toolpath as separately colored objects for rapids, cuts and so on
+class CNCOperator_OT_BuildLayers(bpy.types.Operator):
+    """Build the toolpath as one object per move type, with feed rates per vertex"""
+    bl_idname = "cnctool.build_layers"
+    bl_label = "Build toolpath layers"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        vcnc.build_layers()
+        vcnc.message = "Toolpath layers built from {} segments".format(len(vcnc.segments))
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Show or hide the layer objects without building them again
+def update_layers(self, context):
+    for (i, name) in enumerate(segments.LAYERS):
+        obj = bpy.data.objects.get("CNC" + name)
+        if obj:
+            obj.hide_viewport = not self.CNCShowLayers[i]
+
+# World size of a pixel in the first 3D view, None without one
+def view_pixel_size():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type != 'VIEW_3D':
+                continue
+            region = next((r for r in area.regions if r.type == 'WINDOW'), None)
+            if region is None or not region.width:
+                continue
+            space = area.spaces.active
+            # The visible width at the view center, 36 mm being the sensor
+            width = space.region_3d.view_distance * 36.0 / space.lens
+            return width / region.width
+    return None
+
+# Timer keeping the toolpath overview matched to the zoom, or to the level
+# set in the panel, and the full detail part to the time being played
+def update_lod():
+    vcnc = bpy.types.Scene.VirtualCNC
+    scene = bpy.context.scene
+    if vcnc.lod is None or not vcnc.lodMeshes:
+        return LOD_INTERVAL
+    try:
+        level = scene.CNCDetailLevel
+        if level < 0:
+            size = view_pixel_size()
+            if size is None:
+                return LOD_INTERVAL
+            level = vcnc.lod.level_for(size * vcnc.segments.scale)
+        vcnc.show_lod(level)
+        if vcnc.state:
+            vcnc.show_detail(vcnc.state.time - scene.CNCDetailWindow, vcnc.state.time)
+    except ReferenceError:
+        # The meshes were deleted by the user
+        vcnc.lod = None
+    return LOD_INTERVAL
+
+# Build the volumetric stock, cut as the program is drawn from then on
+class CNCOperator_OT_BuildVoxels(bpy.types.Operator):
+    """Build a voxel stock that the moves cut as they are drawn, arcs in any plane included"""
+    bl_idname = "cnctool.build_voxels"
+    bl_label = "Build voxel stock"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.segments:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        vcnc.build_voxels()
+        vcnc.message = "Voxel stock of {} blocks".format(vcnc.voxels.slots.size)
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Load the program again, simulating only from the first changed statement
+class CNCOperator_OT_Reload(bpy.types.Operator):
+    """Load the changes to the file, running and drawing again only from the first changed statement"""
+    bl_idname = "cnctool.reload"
+    bl_label = "Reload file"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.filename:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        vcnc.reload_program()
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Write a copy of the program with the cutting chains in a shorter order
+class CNCOperator_OT_OptimizeRapids(bpy.types.Operator):
+    """Reorder the cutting chains to shorten the rapid moves between them, writing a copy of the file"""
+    bl_idname = "cnctool.optimize_rapids"
+    bl_label = "Optimize rapids"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.filename:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        optimizer = optimize.RapidOptimizer(reverse=scene.CNCReverseChains, timeLimit=scene.CNCOptimizeTime)
+        result = optimizer.optimize(vcnc.filename)
+        (name, extension) = os.path.splitext(vcnc.filename)
+        result.write(name + "_optimized" + extension, compact=scene.CNCCompactOutput)
+        vcnc.message = "Rapids {:.0f} -> {:.0f} mm, {:.1f} s saved".format(
+            result.rapidBefore, result.rapidAfter, result.saved())
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Write a copy of the program without the words the controller would not miss
+class CNCOperator_OT_WriteCompact(bpy.types.Operator):
+    """Write a copy of the file leaving out repeated modal codes, unchanged coordinates and feed rates"""
+    bl_idname = "cnctool.write_compact"
+    bl_label = "Write compact copy"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.filename:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        (name, extension) = os.path.splitext(vcnc.filename)
+        path = name + "_compact" + extension
+        writer.write_program(gcode.parse_program(vcnc.filename), path, context.scene.CNCPrecision)
+        vcnc.message = "Wrote {} ({} -> {} bytes)".format(os.path.basename(path),
+            os.path.getsize(vcnc.filename), os.path.getsize(path))
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Compare the loaded program with another version of it
+class CNCOperator_OT_Compare(bpy.types.Operator):
+    """Match the toolpath of the loaded program with another version and show what was added, removed and modified"""
+    bl_idname = "cnctool.compare"
+    bl_label = "Compare programs"
+
+    def execute(self, context):
+        scene = context.scene
+        vcnc = bpy.types.Scene.VirtualCNC
+        if vcnc.segments is None:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+        if not scene.CNCCompareFile:
+            self.report({'WARNING'}, "Choose the program to compare with")
+            return {'CANCELLED'}
+
+        # Timed like the loaded program, planned or not
+        other = compare.simulate(bpy.path.abspath(scene.CNCCompareFile), vcnc.simulation.scale, vcnc.profile)
+        comparer = compare.SegmentComparer(tolerance=scene.CNCCompareTolerance)
+        comparison = comparer.compare(vcnc.segments, other)
+        vcnc.build_diff(comparison)
+        report = comparison.report()
+        for line in report:
+            print(line)
+        vcnc.message = report[1]
+        self.report({'INFO'}, report[0])
+        return {'FINISHED'}
+
+# Preview images of all the programs next to the loaded one
+class CNCOperator_OT_BuildPreviews(bpy.types.Operator):
+    """Render top, side and iso previews of every program in the folder of the loaded file"""
+    bl_idname = "cnctool.build_previews"
+    bl_label = "Build previews"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if not vcnc.filename:
+            self.report({'WARNING'}, "Load a program first")
+            return {'CANCELLED'}
+
+        directory = os.path.dirname(vcnc.filename)
+        (previews, failed) = preview.render_directory(directory, size=context.scene.CNCPreviewSize,
+            workers=context.scene.CNCWorkers, processes=context.scene.CNCWorkerProcesses)
+        for path in sorted(failed):
+            self.report({'WARNING'}, "No preview of {}: {}".format(os.path.basename(path), failed[path]))
+        vcnc.message = "Previews of {} programs in {}".format(len(previews), preview.CACHE_DIR)
+        if failed:
+            vcnc.message += ", {} failed".format(len(failed))
+            self.report({'ERROR'}, vcnc.message)
+        else:
+            self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Mirror a job streamed over a socket or a pty, or stop mirroring it
+class CNCOperator_OT_Live(bpy.types.Operator):
+    """Follow a job streamed by a sender (tcp:host:port, unix:path or pty) as it runs"""
+    bl_idname = "cnctool.live"
+    bl_label = "Live mirroring"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if vcnc.live is not None:
+            vcnc.stop_live()
+            self.report({'INFO'}, vcnc.message)
+            return {'FINISHED'}
+
+        try:
+            vcnc.start_live(context.scene.CNCLiveAddress)
+        except (OSError, ValueError) as error:
+            self.report({'ERROR'}, "Cannot listen: {}".format(error))
+            return {'CANCELLED'}
+        if not bpy.app.timers.is_registered(drain_live):
+            bpy.app.timers.register(drain_live)
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Add a machine with its own program, offset and object to the scene
+class CNCOperator_OT_AddMachine(bpy.types.Operator):
+    """Add a machine running a program of its own"""
+    bl_idname = "cnctool.add_machine"
+    bl_label = "Add machine"
+
+    def execute(self, context):
+        scene = context.scene
+        names = set(settings.name for settings in scene.CNCMachines)
+        number = len(scene.CNCMachines) + 1
+        while "Machine{}".format(number) in names:
+            number += 1
+        settings = scene.CNCMachines.add()
+        settings.name = "Machine{}".format(number)
+        scene.CNCMachineIndex = len(scene.CNCMachines) - 1
+        return {'FINISHED'}
+
+class CNCOperator_OT_RemoveMachine(bpy.types.Operator):
+    """Remove the selected machine"""
+    bl_idname = "cnctool.remove_machine"
+    bl_label = "Remove machine"
+
+    def execute(self, context):
+        scene = context.scene
+        if not 0 <= scene.CNCMachineIndex < len(scene.CNCMachines):
+            return {'CANCELLED'}
+        scene.CNCMachines.remove(scene.CNCMachineIndex)
+        scene.CNCMachineIndex = min(scene.CNCMachineIndex, len(scene.CNCMachines) - 1)
+        return {'FINISHED'}
+
+# Play all the machines together, or stop them
+class CNCOperator_OT_RunMachines(bpy.types.Operator):
+    """Simulate the programs of all the machines on a pool of workers and play them side by side"""
+    bl_idname = "cnctool.run_machines"
+    bl_label = "Run machines"
+
+    def execute(self, context):
+        vcnc = bpy.types.Scene.VirtualCNC
+        if vcnc.machines is not None:
+            vcnc.stop_machines()
+            self.report({'INFO'}, vcnc.message)
+            return {'FINISHED'}
+
+        if not any(settings.filename for settings in context.scene.CNCMachines):
+            self.report({'WARNING'}, "Add a machine with a program first")
+            return {'CANCELLED'}
+        try:
+            vcnc.start_machines()
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        if not bpy.app.timers.is_registered(tick_machines):
+            bpy.app.timers.register(tick_machines)
+        self.report({'INFO'}, vcnc.message)
+        return {'FINISHED'}
+
+# Timer playing all the machines, stopping once they are done
+def tick_machines():
+    vcnc = bpy.types.Scene.VirtualCNC
+    if vcnc.machines is None:
+        return None
+    vcnc.machines_tick()
+    if vcnc.machines.ready() and vcnc.machines.done():
+        vcnc.machines.shutdown()
+        vcnc.machines = None
+        return None
+    return PLAY_INTERVAL
+
+# Timer running the live feed on the main thread, in batches
+def drain_live():
+    vcnc = bpy.types.Scene.VirtualCNC
+    if vcnc.live is None:
+        return None
+    vcnc.live_tick()
+    return LIVE_INTERVAL
+
+# Timer reloading the program when the file changes on disk
+def watch_file():
+    vcnc = bpy.types.Scene.VirtualCNC
+    if not bpy.context.scene.CNCWatchFile or vcnc.fileStamp is None:
+        return WATCH_INTERVAL
+    stamp = vcnc.file_stamp()
+    # Missing while the CAM system writes it again
+    if stamp is not None and stamp != vcnc.fileStamp:
+        vcnc.reload_program()
+    return WATCH_INTERVAL
+
 # File browser
 class OT_TestOpenFilebrowser(bpy.types.Operator, ImportHelper): 
     bl_idname = "cnctool.open_filebrowser" 
@@ -450,11 +1396,21 @@ class CNCEMU_PT_Panel(bpy.types.Panel):
         box = layout.box()#put something in a box
         row = box.row()
         box.operator("cnctool.mod", text="Next").dir = 'next' 
+        box.operator("cnctool.mod", text="Draw all").dir = 'all'
+        box.prop(context.scene, "CNCOutputMode")
+        box.prop(context.scene, "CNCBevel")
         box.operator("cnctool.mod", text="Reset").dir = 'reset' 
         row = box.row()
         box.operator("cnctool.mod", icon="PLAY", text="").dir = 'play' 
         row = box.row()
         box.operator("cnctool.mod", icon="PAUSE", text="").dir = 'stop' 
+        box.prop(context.scene, "CNCPlaySpeed")
+        box.prop(context.scene, "CNCTickBudget")
+        row = box.row()
+        row.prop(context.scene, "CNCLiveAddress")
+        vcnc = bpy.types.Scene.VirtualCNC
+        row.operator("cnctool.live", icon="LINKED" if vcnc.live else "UNLINKED",
+            text="Stop live" if vcnc.live else "Start live")
 
         row = box.row()
         layout.separator() #Get some space
@@ -483,19 +1439,128 @@ class CNCEMU_PT_Panel(bpy.types.Panel):
         row = box.row()
         box.operator("cnctool.open_filebrowser", icon="FILE", text="Load file")
         row = box.row()
+        row.prop(scene, "CNCWatchFile")
+        row.operator("cnctool.reload", icon="FILE_REFRESH", text="Reload")
+        row = box.row()
         row.label(text="Loaded: %s paths" % vcnc.lines)
         row = box.row()
+        box.operator("cnctool.pick", icon="EYEDROPPER", text="Pick statement")
+        row = box.row()
+        row.prop(scene, "CNCPickRadius")
+        row = box.row()
+        row.prop(scene, "CNCEnvelopeMin")
+        row = box.row()
+        row.prop(scene, "CNCEnvelopeMax")
+        row = box.row()
+        box.operator("cnctool.check_limits", icon="CHECKMARK", text="Check limits")
+        row = box.row()
+        row.prop(scene, "CNCToolDiameter")
+        row = box.row()
+        row.prop(scene, "CNCStockTop")
+        row = box.row()
+        row.prop(scene, "CNCStockCell")
+        row = box.row()
+        box.operator("cnctool.check_rapids", icon="ERROR", text="Check rapids")
+        row = box.row()
+        box.operator("cnctool.analyse_material", icon="MOD_BOOLEAN", text="Analyse material removal")
+        row = box.row()
+        row.prop(scene, "CNCReverseChains")
+        row = box.row()
+        row.prop(scene, "CNCOptimizeTime")
+        row = box.row()
+        box.operator("cnctool.optimize_rapids", icon="SORTSIZE", text="Optimize rapids")
+        row = box.row()
+        row.prop(scene, "CNCCompactOutput")
+        row = box.row()
+        row.prop(scene, "CNCPrecision")
+        row = box.row()
+        box.operator("cnctool.write_compact", icon="EXPORT", text="Write compact copy")
+        row = box.row()
+        row.prop(scene, "CNCPreviewSize")
+        row = box.row()
+        box.operator("cnctool.build_previews", icon="IMAGE_DATA", text="Build folder previews")
+        row = box.row()
+        row.prop(scene, "CNCCompareFile")
+        row = box.row()
+        row.prop(scene, "CNCCompareTolerance")
+        row = box.row()
+        box.operator("cnctool.compare", icon="ARROW_LEFTRIGHT", text="Compare programs")
+        row = box.row()
+        row.prop(scene, "CNCVoxelSize")
+        row = box.row()
+        row.prop(scene, "CNCToolLength")
+        row = box.row()
+        box.operator("cnctool.build_voxels", icon="MESH_CUBE", text="Build voxel stock")
+        row = box.row()
+        row.prop(scene, "CNCMaxVelocity")
+        row = box.row()
+        row.prop(scene, "CNCMaxAcceleration")
+        row = box.row()
+        row.prop(scene, "CNCJunctionDeviation")
+        row = box.row()
+        row.prop(scene, "CNCJerk")
+        row = box.row()
+        box.operator("cnctool.plan_time", icon="TIME", text="Estimate cycle time")
+        row = box.row()
+        row.prop(scene, "CNCDetailTolerance")
+        row = box.row()
+        box.operator("cnctool.build_lod", icon="MOD_DECIM", text="Build toolpath overview")
+        row = box.row()
+        row.prop(scene, "CNCDetailLevel")
+        row = box.row()
+        row.prop(scene, "CNCDetailWindow")
+        row = box.row()
+        box.operator("cnctool.build_layers", icon="OUTLINER_COLLECTION", text="Build toolpath layers")
+        row = box.row()
+        row.prop(scene, "CNCShowLayers")
+        row = box.row()
         row.prop(scene, "CNCDebug")
         row = box.row()
         row.prop(scene, "CNCScale")
         row = box.row()
+        box.label(text="Machines")
+        row = box.row()
+        row.template_list("UI_UL_list", "CNCMachines", scene, "CNCMachines", scene, "CNCMachineIndex", rows=3)
+        column = row.column(align=True)
+        column.operator("cnctool.add_machine", icon="ADD", text="")
+        column.operator("cnctool.remove_machine", icon="REMOVE", text="")
+        if 0 <= scene.CNCMachineIndex < len(scene.CNCMachines):
+            settings = scene.CNCMachines[scene.CNCMachineIndex]
+            box.prop(settings, "name")
+            box.prop(settings, "filename")
+            box.prop_search(settings, "target", scene, "objects")
+            box.prop(settings, "offset")
+        row = box.row()
+        row.prop(scene, "CNCWorkers")
+        row.prop(scene, "CNCWorkerProcesses")
+        box.operator("cnctool.run_machines", icon="PAUSE" if vcnc.machines else "PLAY",
+            text="Stop machines" if vcnc.machines else "Run machines")
+        row = box.row()
         box.label(text="%s" % vcnc.message)
         row = box.row()
         box.label(text="%s" % vcnc.statement)
         row = box.row()
 
-classlist = [ CNCEMU_PT_Panel, 
+classlist = [ CNCMachineSettings,
+              CNCEMU_PT_Panel, 
               CNCOperator_OT_Modal,
+              CNCOperator_OT_Pick,
+              CNCOperator_OT_CheckLimits,
+              CNCOperator_OT_CheckRapids,
+              CNCOperator_OT_AnalyseMaterial,
+              CNCOperator_OT_PlanTime,
+              CNCOperator_OT_BuildLOD,
+              CNCOperator_OT_BuildLayers,
+              CNCOperator_OT_Reload,
+              CNCOperator_OT_BuildVoxels,
+              CNCOperator_OT_OptimizeRapids,
+              CNCOperator_OT_WriteCompact,
+              CNCOperator_OT_BuildPreviews,
+              CNCOperator_OT_Compare,
+              CNCOperator_OT_Live,
+              CNCOperator_OT_AddMachine,
+              CNCOperator_OT_RemoveMachine,
+              CNCOperator_OT_RunMachines,
               OT_TestOpenFilebrowser
             ]
 
@@ -511,11 +1576,61 @@ def register():
     bpy.types.Scene.CNCSpeed = bpy.props.FloatProperty(name = "CNC Speed", default=0.1, min=0.0001, max=10)
     bpy.types.Scene.CNCScale = bpy.props.FloatProperty(name = "CNC Scale", default=1000, min=1, max=1000)
     bpy.types.Scene.CNCDebug = bpy.props.BoolProperty(name = "debug", default=False)
+    bpy.types.Scene.CNCPickRadius = bpy.props.FloatProperty(name = "Pick radius", default=0.002, min=0.00001, max=1)
+    bpy.types.Scene.CNCEnvelopeMin = bpy.props.FloatVectorProperty(name = "Travel min", default=(0, 0, -100), size=3)
+    bpy.types.Scene.CNCEnvelopeMax = bpy.props.FloatVectorProperty(name = "Travel max", default=(300, 300, 50), size=3)
+    bpy.types.Scene.CNCToolDiameter = bpy.props.FloatProperty(name = "Tool diameter", default=6, min=0.01, max=100)
+    bpy.types.Scene.CNCStockTop = bpy.props.FloatProperty(name = "Stock top", default=0)
+    bpy.types.Scene.CNCStockCell = bpy.props.FloatProperty(name = "Stock cell", default=0.5, min=0.01, max=10)
+    bpy.types.Scene.CNCMaxVelocity = bpy.props.FloatVectorProperty(name = "Max velocity", default=(100, 100, 50), min=0.01, size=3)
+    bpy.types.Scene.CNCMaxAcceleration = bpy.props.FloatVectorProperty(name = "Max acceleration", default=(500, 500, 200), min=0.01, size=3)
+    bpy.types.Scene.CNCJunctionDeviation = bpy.props.FloatProperty(name = "Junction deviation", default=0.02, min=0.0001, max=10)
+    bpy.types.Scene.CNCJerk = bpy.props.FloatProperty(name = "Jerk (0 = off)", default=0, min=0)
+    bpy.types.Scene.CNCDetailTolerance = bpy.props.FloatProperty(name = "Detail tolerance", default=0.01, min=0.0001, max=10)
+    bpy.types.Scene.CNCDetailLevel = bpy.props.IntProperty(name = "Detail level (-1 = zoom)", default=-1, min=-1, max=lod.LEVELS - 1)
+    bpy.types.Scene.CNCDetailWindow = bpy.props.FloatProperty(name = "Full detail seconds", default=10, min=0)
+    bpy.types.Scene.CNCPlaySpeed = bpy.props.FloatProperty(name = "Playback speed", default=1, min=0.01, max=10000)
+    bpy.types.Scene.CNCTickBudget = bpy.props.FloatProperty(name = "Tick budget (ms)", default=20, min=1, max=1000)
+    bpy.types.Scene.CNCOutputMode = bpy.props.EnumProperty(name = "Output", default='CURVE',
+        items=[('CURVE', "Curve", "Draw the toolpath point by point into a curve"),
+               ('MESH', "Mesh", "Write the whole toolpath as a loose-edge mesh at once")])
+    bpy.types.Scene.CNCBevel = bpy.props.FloatProperty(name = "Mesh bevel (0 = mesh)", default=0, min=0, max=1)
+    bpy.types.Scene.CNCShowLayers = bpy.props.BoolVectorProperty(name = "Show layers", size=len(segments.LAYERS),
+        default=(True,) * len(segments.LAYERS), update=update_layers)
+    bpy.types.Scene.CNCVoxelSize = bpy.props.FloatProperty(name = "Voxel size", default=0.5, min=0.01, max=10)
+    bpy.types.Scene.CNCToolLength = bpy.props.FloatProperty(name = "Tool length", default=30, min=0.1, max=500)
+    bpy.types.Scene.CNCWatchFile = bpy.props.BoolProperty(name = "Watch file", default=False)
+    bpy.types.Scene.CNCReverseChains = bpy.props.BoolProperty(name = "Reverse chains", default=False)
+    bpy.types.Scene.CNCOptimizeTime = bpy.props.FloatProperty(name = "Optimize time (s)", default=2, min=0.1, max=600)
+    bpy.types.Scene.CNCCompactOutput = bpy.props.BoolProperty(name = "Compact output", default=True)
+    bpy.types.Scene.CNCLiveAddress = bpy.props.StringProperty(name = "Sender", default=live.DEFAULT_ADDRESS)
+    bpy.types.Scene.CNCLiveBatch = bpy.props.IntProperty(name = "Live batch (lines)", default=2000, min=1, max=100000)
+    bpy.types.Scene.CNCLiveQueue = bpy.props.IntProperty(name = "Live queue (lines)", default=live.MAX_PENDING, min=1, max=1000000)
+    bpy.types.Scene.CNCPrecision = bpy.props.IntProperty(name = "Decimals", default=writer.PRECISION, min=0, max=9)
+    bpy.types.Scene.CNCCompareFile = bpy.props.StringProperty(name = "Compare with", subtype='FILE_PATH')
+    bpy.types.Scene.CNCCompareTolerance = bpy.props.FloatProperty(name = "Moved tolerance (mm)", default=compare.TOLERANCE, min=0.001, max=100)
+    bpy.types.Scene.CNCPreviewSize = bpy.props.IntProperty(name = "Preview size", default=preview.SIZE, min=16, max=4096)
+    bpy.types.Scene.CNCMachines = bpy.props.CollectionProperty(type=CNCMachineSettings)
+    bpy.types.Scene.CNCMachineIndex = bpy.props.IntProperty(name = "Machine", default=0)
+    bpy.types.Scene.CNCWorkers = bpy.props.IntProperty(name = "Workers", default=machines.WORKERS, min=1, max=64)
+    bpy.types.Scene.CNCWorkerProcesses = bpy.props.BoolProperty(name = "Processes", default=False)
+    bpy.app.timers.register(update_lod, persistent=True)
+    bpy.app.timers.register(watch_file, persistent=True)
 
     
 def unregister():
     for cls in classlist:
         bpy.utils.unregister_class(cls)
+    if bpy.app.timers.is_registered(update_lod):
+        bpy.app.timers.unregister(update_lod)
+    if bpy.app.timers.is_registered(watch_file):
+        bpy.app.timers.unregister(watch_file)
+    if bpy.app.timers.is_registered(drain_live):
+        bpy.app.timers.unregister(drain_live)
+    if bpy.app.timers.is_registered(tick_machines):
+        bpy.app.timers.unregister(tick_machines)
+    bpy.types.Scene.VirtualCNC.stop_live()
+    bpy.types.Scene.VirtualCNC.stop_machines()
 
 if __name__ == "__main__":
     register()
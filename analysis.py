@@ -0,0 +1,133 @@
+# Material removal rate and air cut analysis
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import collision
+
+###########
+# Globals #
+###########
+
+# Feed moves going no deeper than this into the material cut air
+AIR_DEPTH = 1e-3
+
+#############
+# Functions #
+#############
+
+# Cut the segments in timeline order out of a box stock around the program
+# and measure what every one of them removed
+def analyse(segs, toolRadius, cellSize, top=0.0, airDepth=AIR_DEPTH):
+    heightmap = collision.box_stock(segs, toolRadius, cellSize, top)
+    return MaterialAnalyser(heightmap, toolRadius, airDepth).analyse(segs)
+
+###########
+# Classes #
+###########
+
+# What every segment removed from the stock. Rapids are not cut and have
+# zero everywhere.
+class Analysis(object):
+    segments = None
+    # Removed volume (mm^3), how deep the tool went into the material
+    # (axial depth, mm), the average width of the cut (radial depth, mm)
+    # and that width as a fraction of the tool diameter
+    volume = None
+    depth = None
+    width = None
+    engagement = None
+    # Material removal rate in mm^3/s
+    mrr = None
+    # Feed moves removing nothing
+    air = None
+
+    # Seconds spent on air cuts
+    def air_time(self):
+        return self.segments.duration[self.air].sum()
+
+    # Per statement (lineno, volume, time, air time) arrays, in line order
+    def lines(self):
+        (lineno, group) = numpy.unique(self.segments.lineno, return_inverse=True)
+        n = len(lineno)
+        volume = numpy.bincount(group, self.volume, n)
+        time = numpy.bincount(group, self.segments.duration, n)
+        airTime = numpy.bincount(group, numpy.where(self.air, self.segments.duration, 0), n)
+        return (lineno, volume, time, airTime)
+
+    # The statements wasting the most time on air cuts, one text line each
+    def report(self, limit=10):
+        (lineno, volume, time, airTime) = self.lines()
+        worst = numpy.argsort(-airTime, kind="stable")[:limit]
+        result = ["Air cuts {:.1f} s of {:.1f} s".format(self.air_time(), self.segments.duration.sum())]
+        for i in worst:
+            if (airTime[i] <= 0):
+                break
+            result.append("Line {}: {:.1f} s in air, {:.1f} mm3 removed in {:.1f} s".format(
+                lineno[i], airTime[i], volume[i], time[i]))
+        return result
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({1} segments, {2} air cuts)'
+        return template.format(self, len(self.volume), int(self.air.sum()))
+
+# Replays the segments over a heightmap in timeline order. All the feed
+# moves are sampled and cut in one batch, the heightmap crediting the
+# material of every cell to the sample that reached it first.
+class MaterialAnalyser(object):
+    stock = None
+    toolRadius = 0
+    airDepth = AIR_DEPTH
+
+    def __init__(self, heightmap, toolRadius, airDepth=AIR_DEPTH):
+        self.stock = heightmap
+        self.toolRadius = toolRadius
+        self.airDepth = airDepth
+
+    def analyse(self, segs):
+        n = len(segs)
+        result = Analysis()
+        result.segments = segs
+        result.volume = numpy.zeros(n)
+        result.depth = numpy.zeros(n)
+        idx = numpy.nonzero(~segs.rapid)[0]
+        if (len(idx)):
+            (points, owner) = segs.sample(idx, self.stock.cellSize*0.5)
+            (removed, depth) = self.stock.cut(points, self.toolRadius, depths=True)
+            result.volume = numpy.bincount(owner, removed, n)
+            numpy.maximum.at(result.depth, owner, depth)
+            # Moves going down cut a little at every sample, their depth is
+            # the height they went down while in the material
+            engaged = (removed > 0)
+            (low, high) = (numpy.full(n, numpy.inf), numpy.full(n, -numpy.inf))
+            numpy.minimum.at(low, owner[engaged], points[engaged, 2])
+            numpy.maximum.at(high, owner[engaged], points[engaged, 2])
+            result.depth += numpy.where(high > low, high - low, 0)
+
+        # The removed cross section spread over the depth of the cut
+        length = numpy.where(segs.length > 0, segs.length, 1)
+        area = result.volume/length
+        result.width = numpy.where(result.depth > 0, area/numpy.where(result.depth > 0, result.depth, 1), 0)
+        result.width = numpy.minimum(result.width, 2*self.toolRadius)
+        result.engagement = result.width/(2*self.toolRadius)
+        result.mrr = numpy.where(segs.duration > 0, result.volume/numpy.where(segs.duration > 0, segs.duration, 1), 0)
+        result.air = ~segs.rapid & (result.depth <= self.airDepth)
+        return result
@@ -0,0 +1,111 @@
+# Rapid move collision detection against the simulated stock
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import stock
+
+#############
+# Functions #
+#############
+
+# A box stock covering every cutting move, its top at the given height
+def box_stock(segs, toolRadius, cellSize, top=0.0):
+    (lo, hi) = segs.bounds()
+    cuts = ~segs.rapid
+    if (cuts.any()):
+        (lo, hi) = (lo[cuts], hi[cuts])
+    lo = lo.min(axis=0)
+    hi = hi.max(axis=0)
+    lo[:2] -= toolRadius
+    hi[:2] += toolRadius
+    return stock.Heightmap(lo, hi, cellSize, top, bottom=min(lo[2], top))
+
+# Returns the start index and length of every run of equal values
+def _runs(values):
+    if (not len(values)):
+        return ([], [])
+    change = numpy.nonzero(values[1:] != values[:-1])[0] + 1
+    starts = numpy.concatenate(([0], change))
+    ends = numpy.concatenate((change, [len(values)]))
+    return (starts, ends)
+
+###########
+# Classes #
+###########
+
+# The rapids found travelling through material
+class Report(object):
+    # Indices of the colliding rapid segments
+    collisions = None
+    # How deep each of them goes into the stock
+    depth = None
+    segments = None
+
+    # Sorted statement numbers of the colliding rapids
+    def lines(self):
+        return numpy.unique(self.segments.lineno[self.collisions])
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({1} collisions)'
+        return template.format(self, len(self.collisions))
+
+# Replays the segments in timeline order. Every run of cutting moves is
+# stamped into the heightmap in one go, and every run of rapids is checked
+# against the stock as it is at that moment.
+class RapidChecker(object):
+    stock = None
+    toolRadius = 0
+    # Material thinner than this is not reported
+    tolerance = 1e-3
+
+    def __init__(self, heightmap, toolRadius, tolerance=1e-3):
+        self.stock = heightmap
+        self.toolRadius = toolRadius
+        self.tolerance = tolerance
+
+    def check(self, segs):
+        report = Report()
+        report.segments = segs
+        found = []
+        depths = []
+        (starts, ends) = _runs(segs.rapid)
+        for (first, last) in zip(starts, ends):
+            idx = numpy.arange(first, last)
+            if (segs.rapid[first]):
+                (points, owner) = segs.sample(idx, self.stock.cellSize*0.5)
+                depth = self.stock.penetration(points, self.toolRadius)
+                worst = numpy.zeros(len(idx))
+                numpy.maximum.at(worst, owner - first, depth)
+                hit = (worst > self.tolerance)
+                found.append(idx[hit])
+                depths.append(worst[hit])
+            else:
+                # The tool disks overlap heavily, a cell apart is plenty
+                (points, owner) = segs.sample(idx, self.stock.cellSize)
+                self.stock.cut(points, self.toolRadius)
+        if (found):
+            report.collisions = numpy.concatenate(found)
+            report.depth = numpy.concatenate(depths)
+        else:
+            report.collisions = numpy.zeros(0, dtype=numpy.int64)
+            report.depth = numpy.zeros(0)
+        return report
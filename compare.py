@@ -0,0 +1,365 @@
+# Structural comparison of two versions of a program
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import gcode
+import planner
+import segments
+
+###########
+# Globals #
+###########
+
+# Grid (mm) the geometry is rounded to before hashing. Coarser than the
+# decimals of any post, so a change of number formatting changes nothing.
+QUANTUM = 1e-3
+
+# Segments moved by at most this much (mm) are the same move modified
+TOLERANCE = 0.1
+
+# Status of every segment of either program
+SAME = 0
+REMOVED = 1
+ADDED = 2
+MODIFIED = 3
+STATUS = ("same", "removed", "added", "modified")
+
+# Multiplier of the hash folding the quantized coordinates together
+HASH_PRIME = numpy.uint64(0x100000001b3)
+
+# Relative difference of feed rates counted as a change
+FEED_TOLERANCE = 1e-6
+
+# Times the nearby segments are paired up, every round pairing those that
+# lost their nearest partner to a closer segment in the last
+NEAR_ROUNDS = 4
+
+# The cells next to and including a grid cell
+NEIGHBOURS = numpy.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])
+
+#############
+# Functions #
+#############
+
+# One 64 bit hash per row of an integer array
+def hash_rows(rows):
+    rows = rows.astype(numpy.uint64)
+    h = numpy.zeros(len(rows), dtype=numpy.uint64)
+    for column in range(rows.shape[1]):
+        h = h*HASH_PRIME ^ rows[:, column]
+    return h
+
+# The direction of every arc, the axis walked by cos() which tells G02
+# from G03 within a plane, 0 for lines
+def direction(segs):
+    return numpy.where(segs.kind == segments.ARC, segs.cosAxis + 1, 0)
+
+# The geometry of every segment rounded to the quantum: kind, plane and
+# direction of arcs, start, end and arc centre
+def quantize(segs, quantum=QUANTUM):
+    center = numpy.where((segs.kind == segments.ARC)[:, None], segs.center, 0)
+    coords = numpy.rint(numpy.hstack((segs.start, segs.end, center))/quantum).astype(numpy.int64)
+    arcs = (segs.kind == segments.ARC)
+    shape = numpy.column_stack((segs.kind, numpy.where(arcs, segs.plane, 0), direction(segs))).astype(numpy.int64)
+    return numpy.hstack((shape, coords))
+
+# Pairs up the rows with equal keys. A key repeated, eg. by passes over
+# the same spot, pairs the first with the first and so on in program order.
+def match_keys(keysA, keysB):
+    def ranked(keys):
+        order = numpy.argsort(keys, kind="stable")
+        ordered = keys[order]
+        first = numpy.ones(len(keys), dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        starts = numpy.maximum.accumulate(numpy.where(first, numpy.arange(len(keys)), 0))
+        rank = numpy.empty(len(keys), dtype=numpy.uint64)
+        rank[order] = numpy.arange(len(keys)) - starts
+        return hash_rows(numpy.column_stack((keys, rank)))
+    (common, a, b) = numpy.intersect1d(ranked(keysA), ranked(keysB), return_indices=True)
+    return (a, b)
+
+# Pairs up the segments of A and B within tolerance of each other. The
+# segments are hashed into a grid of the tolerance by their midpoints, so
+# the candidates of a segment are those of the cells around its own. Every
+# segment of A is paired with the nearest of B not taken by a nearer one.
+# Returns the pairs and their distances.
+def match_near(segsA, idxA, segsB, idxB, tolerance=TOLERANCE):
+    if (not len(idxA) or not len(idxB)):
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, numpy.zeros(0))
+    midA = (segsA.start[idxA] + segsA.end[idxA])*0.5
+    midB = (segsB.start[idxB] + segsB.end[idxB])*0.5
+    cellsA = numpy.floor(midA/tolerance).astype(numpy.int64)
+    keysB = hash_rows(numpy.floor(midB/tolerance).astype(numpy.int64))
+    order = numpy.argsort(keysB, kind="stable")
+    keysB = keysB[order]
+
+    (a, b) = ([], [])
+    for offset in NEIGHBOURS:
+        keys = hash_rows(cellsA + offset)
+        lo = numpy.searchsorted(keysB, keys, side="left")
+        counts = numpy.searchsorted(keysB, keys, side="right") - lo
+        owner = numpy.repeat(numpy.arange(len(idxA)), counts)
+        step = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        a.append(owner)
+        b.append(order[numpy.repeat(lo, counts) + step])
+    a = numpy.concatenate(a)
+    b = numpy.concatenate(b)
+    (ia, ib) = (idxA[a], idxB[b])
+
+    # The farthest of the ends apart, either way round, and the arc centres
+    def gap(p, q):
+        return numpy.linalg.norm(p - q, axis=1)
+    forward = numpy.maximum(gap(segsA.start[ia], segsB.start[ib]), gap(segsA.end[ia], segsB.end[ib]))
+    backward = numpy.maximum(gap(segsA.start[ia], segsB.end[ib]), gap(segsA.end[ia], segsB.start[ib]))
+    distance = numpy.maximum(numpy.minimum(forward, backward), gap(segsA.center[ia], segsB.center[ib]))
+    keep = ((segsA.kind[ia] == segsB.kind[ib]) & (direction(segsA)[ia] == direction(segsB)[ib]) &
+            (segsA.plane[ia] == segsB.plane[ib]) & (distance <= tolerance))
+    (a, b, distance) = (a[keep], b[keep], distance[keep])
+
+    (pairA, pairB, pairDistance) = ([], [], [])
+    takenA = numpy.zeros(len(idxA), dtype=bool)
+    takenB = numpy.zeros(len(idxB), dtype=bool)
+    for i in range(NEAR_ROUNDS):
+        free = ~takenA[a] & ~takenB[b]
+        (a, b, distance) = (a[free], b[free], distance[free])
+        if (not len(a)):
+            break
+        # The nearest B of every A, then the nearest of those A for every B
+        order = numpy.lexsort((distance, a))
+        first = numpy.unique(a[order], return_index=True)[1]
+        best = order[first]
+        order = best[numpy.lexsort((distance[best], b[best]))]
+        first = numpy.unique(b[order], return_index=True)[1]
+        best = order[first]
+        takenA[a[best]] = True
+        takenB[b[best]] = True
+        pairA.append(a[best])
+        pairB.append(b[best])
+        pairDistance.append(distance[best])
+    if (not pairA):
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, numpy.zeros(0))
+    return (idxA[numpy.concatenate(pairA)], idxB[numpy.concatenate(pairB)], numpy.concatenate(pairDistance))
+
+# The runs of segments following each other with the same status, other
+# than SAME, as (status, first, stop) tuples
+def runs(status):
+    if (not len(status)):
+        return []
+    starts = numpy.concatenate(([0], numpy.nonzero(status[1:] != status[:-1])[0] + 1))
+    stops = numpy.append(starts[1:], len(status))
+    return [(int(status[i]), int(i), int(j)) for (i, j) in zip(starts, stops) if status[i] != SAME]
+
+# The segments of a program run on a state of its own at the given scale,
+# timed by the planner when given a machine profile. Both programs of a
+# comparison are to be timed the same way, or the time deltas mix up two
+# timing models.
+def simulate(path, scale=1, profile=None):
+    state = gcode.parse_program(path).start()
+    state.scale = scale
+    state.run()
+    if (profile is not None):
+        planner.Planner(profile).apply(state)
+    return segments.from_state(state)
+
+# Compare two versions of a program, simulating both
+def compare_files(pathA, pathB, quantum=QUANTUM, tolerance=TOLERANCE, profile=None):
+    segsA = simulate(pathA, profile=profile)
+    segsB = simulate(pathB, profile=profile)
+    return SegmentComparer(quantum, tolerance).compare(segsA, segsB)
+
+###########
+# Classes #
+###########
+
+# A run of segments added, removed or modified, in the new program for
+# added and modified ones and in the old for removed ones
+class Region(object):
+    status = SAME
+    # The segments, stop not included, and the lines they come from
+    first = 0
+    stop = 0
+    lines = (0, 0)
+    lo = None
+    hi = None
+    # Length (mm) and time (s) of the region, and how much longer they are
+    # than what they replaced
+    length = 0
+    time = 0
+    lengthDelta = 0
+    timeDelta = 0
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({1}, lines {0.lines[0]}-{0.lines[1]}, {2} segments)'
+        return template.format(self, STATUS[self.status], self.stop - self.first)
+
+# The segments of two programs matched up. Every segment of the old program
+# is the same, removed or modified, every segment of the new the same, added
+# or modified.
+class Comparison(object):
+    old = None
+    new = None
+    oldStatus = None
+    newStatus = None
+    # The segment of the new program matched to every segment of the old,
+    # -1 when removed
+    match = None
+    regions = None
+
+    def time_delta(self):
+        return self.new.duration.sum() - self.old.duration.sum()
+
+    def length_delta(self):
+        return self.new.length.sum() - self.old.length.sum()
+
+    # Regions of a status
+    def of(self, status):
+        return [region for region in self.regions if region.status == status]
+
+    # The segments of the new program (of the old for REMOVED) with a status
+    def indices(self, status):
+        if (status == REMOVED):
+            return numpy.nonzero(self.oldStatus == REMOVED)[0]
+        return numpy.nonzero(self.newStatus == status)[0]
+
+    def changed(self):
+        return bool(self.regions)
+
+    # A summary and the regions changing the time the most, one text line each
+    def report(self, limit=10):
+        result = ["Time {:.1f} s -> {:.1f} s ({:+.1f} s), length {:.0f} mm -> {:.0f} mm ({:+.0f} mm)".format(
+                      self.old.duration.sum(), self.new.duration.sum(), self.time_delta(),
+                      self.old.length.sum(), self.new.length.sum(), self.length_delta()),
+                  "{} removed, {} added, {} modified regions".format(
+                      len(self.of(REMOVED)), len(self.of(ADDED)), len(self.of(MODIFIED)))]
+        worst = sorted(self.regions, key=lambda region: -abs(region.timeDelta))[:limit]
+        for region in worst:
+            result.append("{} lines {}-{}: {} segments, {:.1f} mm ({:+.1f} mm), {:.1f} s ({:+.1f} s)".format(
+                STATUS[region.status].capitalize(), region.lines[0], region.lines[1], region.stop - region.first,
+                region.length, region.lengthDelta, region.time, region.timeDelta))
+        return result
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({1} removed, {2} added, {3} modified regions)'
+        return template.format(self, len(self.of(REMOVED)), len(self.of(ADDED)), len(self.of(MODIFIED)))
+
+# Matches the segments of two programs by their geometry, whatever the
+# lines and the number formatting that made them. The segments are first
+# paired by a hash of their quantized geometry, in one sort of both
+# programs. Those left are paired with what lies within the tolerance
+# through a grid over their midpoints, and the rest were added or removed.
+# Matched segments with another feed rate, spindle state or rapid flag, or
+# paired by the grid, are modified.
+class SegmentComparer(object):
+    quantum = QUANTUM
+    tolerance = TOLERANCE
+
+    def __init__(self, quantum=QUANTUM, tolerance=TOLERANCE):
+        self.quantum = quantum
+        self.tolerance = tolerance
+
+    def compare(self, old, new):
+        result = Comparison()
+        result.old = old
+        result.new = new
+        result.match = numpy.full(len(old), -1, dtype=numpy.int64)
+
+        rowsA = quantize(old, self.quantum)
+        rowsB = quantize(new, self.quantum)
+        (a, b) = match_keys(hash_rows(rowsA), hash_rows(rowsB))
+        # Leave out the pairs only sharing a hash
+        equal = numpy.all(rowsA[a] == rowsB[b], axis=1)
+        (a, b) = (a[equal], b[equal])
+        moved = numpy.zeros(len(a), dtype=bool)
+
+        leftA = numpy.ones(len(old), dtype=bool)
+        leftB = numpy.ones(len(new), dtype=bool)
+        leftA[a] = False
+        leftB[b] = False
+        (nearA, nearB, distance) = match_near(old, numpy.nonzero(leftA)[0], new, numpy.nonzero(leftB)[0], self.tolerance)
+        # Rounded into neighbouring cells of the quantum is still the same.
+        # Arc centres are off by the rounding of both the start and the
+        # centre offset.
+        a = numpy.concatenate((a, nearA))
+        b = numpy.concatenate((b, nearB))
+        # A move run the other way round is modified too
+        backward = (numpy.linalg.norm(old.start[nearA] - new.start[nearB], axis=1) >
+                    numpy.linalg.norm(old.start[nearA] - new.end[nearB], axis=1))
+        moved = numpy.concatenate((moved, (distance > 2*self.quantum) | backward))
+        result.match[a] = b
+
+        feed = numpy.abs(old.feedRate[a] - new.feedRate[b]) > FEED_TOLERANCE*numpy.maximum(old.feedRate[a], 1)
+        modified = (moved | feed | (old.rapid[a] != new.rapid[b]) | (old.spindleOn[a] != new.spindleOn[b]))
+        result.oldStatus = numpy.full(len(old), REMOVED, dtype=numpy.int8)
+        result.newStatus = numpy.full(len(new), ADDED, dtype=numpy.int8)
+        result.oldStatus[a] = numpy.where(modified, MODIFIED, SAME)
+        result.newStatus[b] = numpy.where(modified, MODIFIED, SAME)
+        result.regions = self.regions(result)
+        return result
+
+    # The runs of the changed segments of both programs, in the order of the
+    # new program with the removed ones after
+    def regions(self, result):
+        (old, new) = (result.old, result.new)
+        # What every modified segment of the new program replaced
+        replaced = numpy.full(len(new), -1, dtype=numpy.int64)
+        matched = numpy.nonzero(result.match >= 0)[0]
+        replaced[result.match[matched]] = matched
+        (lo, hi) = new.bounds()
+        (oldLo, oldHi) = old.bounds()
+
+        regions = []
+        for (status, first, stop) in runs(result.newStatus) + [(REMOVED, i, j) for (s, i, j) in runs(result.oldStatus) if s == REMOVED]:
+            segs = old if status == REMOVED else new
+            region = Region()
+            region.status = status
+            region.first = first
+            region.stop = stop
+            region.lines = (int(segs.lineno[first:stop].min()), int(segs.lineno[first:stop].max()))
+            (boxLo, boxHi) = (oldLo, oldHi) if status == REMOVED else (lo, hi)
+            region.lo = boxLo[first:stop].min(axis=0)
+            region.hi = boxHi[first:stop].max(axis=0)
+            region.length = segs.length[first:stop].sum()
+            region.time = segs.duration[first:stop].sum()
+            if (status == MODIFIED):
+                before = replaced[first:stop]
+                region.lengthDelta = region.length - old.length[before].sum()
+                region.timeDelta = region.time - old.duration[before].sum()
+            elif (status == ADDED):
+                region.lengthDelta = region.length
+                region.timeDelta = region.time
+            else:
+                region.lengthDelta = -region.length
+                region.timeDelta = -region.time
+            regions.append(region)
+        return regions
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 3:
+        print('Usage: compare.py <old G-code file> <new G-code file> [tolerance]')
+        sys.exit(1)
+    tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else TOLERANCE
+    for line in compare_files(sys.argv[1], sys.argv[2], tolerance=tolerance).report():
+        print(line)
@@ -0,0 +1,223 @@
+# Cutter radius compensation (G41/G42)
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# The side of the programmed path the tool runs on, G41 and G42
+LEFT = 1
+RIGHT = -1
+
+# How the tool gets from one move to the next
+CORNER_NONE = 0
+CORNER_ARC = 1
+CORNER_LINE = 2
+
+# Moves shorter than this in the plane only travel along its normal
+EPSILON = 1e-9
+
+# For every plane the two axes in it and its normal, ordered so that arcs
+# turn counter-clockwise (G03) from the first axis towards the second
+PLANE_AXES = {
+    "XY": (0, 1, 2),
+    "ZX": (2, 0, 1),
+    "YZ": (1, 2, 0),
+}
+
+#############
+# Functions #
+#############
+
+def _cross(a, b):
+    return a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0]
+
+def _dot(a, b):
+    return numpy.einsum("ij,ij->i", a, b)
+
+# The vectors turned a quarter counter-clockwise, ie. to their left
+def _left(v):
+    return numpy.stack((-v[:, 1], v[:, 0]), axis=1)
+
+def _unit(v):
+    norm = numpy.linalg.norm(v, axis=1)
+    return v/numpy.where(norm > 0, norm, 1)[:, None]
+
+# Of two candidate points, the one closest to the reference point
+def _closest(p1, p2, ref):
+    first = numpy.linalg.norm(p1 - ref, axis=1) <= numpy.linalg.norm(p2 - ref, axis=1)
+    return numpy.where(first[:, None], p1, p2)
+
+# Unit tangents at the start and at the end of every move
+def tangents(start, end, center, arcs, direction):
+    chord = _unit(end - start)
+    tin = chord.copy()
+    tout = chord.copy()
+    if (arcs.any()):
+        turn = direction[arcs][:, None]
+        tin[arcs] = _left(_unit(start[arcs] - center[arcs]))*turn
+        tout[arcs] = _left(_unit(end[arcs] - center[arcs]))*turn
+    return (tin, tout)
+
+def _line_line(p1, d1, p2, d2):
+    denom = _cross(d1, d2)
+    ok = numpy.abs(denom) > EPSILON
+    t = _cross(p2 - p1, d2)/numpy.where(ok, denom, 1)
+    return (p1 + t[:, None]*d1, ok)
+
+def _line_circle(p, d, c, r, ref):
+    f = p - c
+    b = _dot(f, d)
+    disc = b*b - (_dot(f, f) - r*r)
+    ok = (disc >= 0)
+    root = numpy.sqrt(numpy.maximum(disc, 0))
+    p1 = p + (-b - root)[:, None]*d
+    p2 = p + (-b + root)[:, None]*d
+    return (_closest(p1, p2, ref), ok)
+
+def _circle_circle(c1, r1, c2, r2, ref):
+    delta = c2 - c1
+    dist = numpy.linalg.norm(delta, axis=1)
+    ok = (dist > EPSILON) & (dist <= r1 + r2) & (dist >= numpy.abs(r1 - r2))
+    dist = numpy.where(ok, dist, 1)
+    a = (r1*r1 - r2*r2 + dist*dist)/(2*dist)
+    h = numpy.sqrt(numpy.maximum(r1*r1 - a*a, 0))[:, None]
+    u = delta/dist[:, None]
+    mid = c1 + a[:, None]*u
+    return (_closest(mid + h*_left(u), mid - h*_left(u), ref), ok)
+
+# Where the offset of move a (at its end) crosses the offset of move b (at
+# its start). Lines are given by a point and direction, arcs by their
+# center and offset radius; the crossing closest to ref is taken.
+def _intersect(pa, da, ca, ra, arcA, pb, db, cb, rb, arcB, ref):
+    point = ref.copy()
+    ok = numpy.zeros(len(ref), dtype=bool)
+    cases = (
+        (~arcA & ~arcB, lambda m : _line_line(pa[m], da[m], pb[m], db[m])),
+        (~arcA & arcB, lambda m : _line_circle(pa[m], da[m], cb[m], rb[m], ref[m])),
+        (arcA & ~arcB, lambda m : _line_circle(pb[m], db[m], ca[m], ra[m], ref[m])),
+        (arcA & arcB, lambda m : _circle_circle(ca[m], ra[m], cb[m], rb[m], ref[m])),
+    )
+    for (mask, solve) in cases:
+        if (mask.any()):
+            (point[mask], ok[mask]) = solve(mask)
+    return (point, ok)
+
+# The tool center path of a chain of moves in a plane, in one batch. All
+# points are (N,2) arrays of in-plane coordinates, arcs marks the arcs and
+# direction is +1 for counter-clockwise and -1 for clockwise ones. The
+# first move is the entry move: a line there starts from the uncompensated
+# position. With exit, a final line ends on its programmed point instead.
+def offset_chain(start, end, center, arcs, direction, radius, side, entry=True, exit=False):
+    n = len(start)
+    result = Offset()
+    result.start = start.astype(float)
+    result.end = end.astype(float)
+    result.center = center.astype(float)
+    result.radius = numpy.linalg.norm(start - center, axis=1)
+    result.corner = numpy.zeros(n, dtype=numpy.int8)
+    result.cornerStart = result.start.copy()
+    result.cornerDirection = -side
+    result.gouges = numpy.zeros(n, dtype=bool)
+
+    valid = numpy.linalg.norm(end - start, axis=1) > EPSILON
+    idx = numpy.nonzero(valid)[0]
+    if (len(idx)):
+        (s, e, c) = (start[idx], end[idx], center[idx])
+        (va, vd) = (arcs[idx], direction[idx])
+        (tin, tout) = tangents(s, e, c, va, vd)
+        offset = side*radius
+        s = s + offset*_left(tin)
+        e = e + offset*_left(tout)
+        # Arcs keep their center, the tool runs inside or outside of them
+        r = numpy.linalg.norm(start[idx] - c, axis=1) - offset*vd
+        collapsed = va & (r <= EPSILON)
+        s[collapsed] = c[collapsed]
+        e[collapsed] = c[collapsed]
+        r = numpy.where(va, numpy.maximum(r, 0), 0)
+        if (entry and not va[0]):
+            s[0] = start[idx[0]]
+        if (exit and not va[-1]):
+            e[-1] = end[idx[-1]]
+
+        # Corners between consecutive moves. The tool goes around the
+        # outside ones on an arc and the inside ones are trimmed back to
+        # where the offset moves cross.
+        cross = _cross(tout[:-1], tin[1:])
+        smooth = (numpy.abs(cross) <= EPSILON) & (_dot(tout[:-1], tin[1:]) > 0)
+        outside = ~smooth & (side*cross <= 0)
+        inside = ~smooth & ~outside
+        direct = _unit(e - s)
+        lineDir = numpy.where(va[:, None], tin, direct)
+        outDir = numpy.where(va[:, None], tout, direct)
+        k = numpy.nonzero(inside)[0]
+        if (len(k)):
+            ref = (e[k] + s[k + 1])*0.5
+            (point, ok) = _intersect(e[k], outDir[k], c[k], r[k], va[k],
+                s[k + 1], lineDir[k + 1], c[k + 1], r[k + 1], va[k + 1], ref)
+            e[k[ok]] = point[ok]
+            s[k[ok] + 1] = point[ok]
+        # Inside corners without a crossing are joined by a line. A trimmed
+        # line running backwards means the tool cannot get in there.
+        result.gouges[idx] = collapsed | (~va & (_dot(e - s, direct) < -EPSILON))
+
+        joined = numpy.linalg.norm(e[:-1] - s[1:], axis=1) <= EPSILON
+        corner = numpy.where(joined, CORNER_NONE, numpy.where(outside, CORNER_ARC, CORNER_LINE))
+        # Corner arcs go around the programmed corner at the tool radius,
+        # only when the offset points really are that far from it
+        around = numpy.abs(numpy.linalg.norm(e[:-1] - end[idx[:-1]], axis=1) - radius) <= 1e-6*max(radius, 1)
+        corner[(corner == CORNER_ARC) & ~around] = CORNER_LINE
+        result.corner[idx[1:]] = corner
+        result.cornerStart[idx[1:]] = e[:-1]
+        result.start[idx] = s
+        result.end[idx] = e
+        result.radius[idx] = r
+
+    # Moves along the plane normal only stay where the tool center is
+    last = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(n), -1))
+    still = numpy.nonzero(~valid & (last >= 0))[0]
+    result.start[still] = result.end[last[still]]
+    result.end[still] = result.end[last[still]]
+    return result
+
+###########
+# Classes #
+###########
+
+# The tool center path of a compensated chain, one row per programmed move
+class Offset(object):
+    # Tool center start and end of every move, (N,2)
+    start = None
+    end = None
+    # Arc centers and the radius the tool center runs at
+    center = None
+    radius = None
+    # How the tool reaches the start of every move from the previous one
+    # (CORNER_*), and where that corner starts. Corner arcs are centered on
+    # the programmed start of the move.
+    corner = None
+    cornerStart = None
+    # Turn of the corner arcs, +1 for counter-clockwise
+    cornerDirection = 1
+    # Moves the tool cannot follow without cutting into the contour
+    gouges = None
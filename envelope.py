@@ -0,0 +1,136 @@
+# Machine envelope and soft limit checking
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import segments
+
+###########
+# Globals #
+###########
+
+# Number of chords used when testing arcs against keep-out boxes
+ARC_CHORDS = 32
+
+#############
+# Functions #
+#############
+
+# Whether the segments p0-p1 pass through the boxes lo-hi, one box per segment
+def segments_hit_boxes(p0, p1, lo, hi):
+    d = p1 - p0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t1 = (lo - p0)/d
+        t2 = (hi - p0)/d
+    # Segments parallel to a slab only hit when they lie within it
+    parallel = (d == 0)
+    inSlab = (p0 >= lo) & (p0 <= hi)
+    tmin = numpy.where(parallel, numpy.where(inSlab, -numpy.inf, numpy.inf), numpy.minimum(t1, t2))
+    tmax = numpy.where(parallel, numpy.where(inSlab, numpy.inf, -numpy.inf), numpy.maximum(t1, t2))
+    enter = numpy.maximum(tmin.max(axis=-1), 0)
+    leave = numpy.minimum(tmax.min(axis=-1), 1)
+    return (enter <= leave)
+
+###########
+# Classes #
+###########
+
+# The outcome of Envelope.check
+class Report(object):
+    # Exact (lo, hi) extents of the whole program
+    lo = None
+    hi = None
+    # Per segment mask of moves leaving the machine travel
+    outside = None
+    # (N, K) mask of segments entering each keep-out box
+    keepout = None
+    segments = None
+
+    # Indices of every offending segment
+    def violations(self):
+        bad = self.outside.copy()
+        if (self.keepout.size):
+            bad |= self.keepout.any(axis=1)
+        return numpy.nonzero(bad)[0]
+
+    # Sorted statement numbers of every offending segment
+    def lines(self):
+        return numpy.unique(self.segments.lineno[self.violations()])
+
+    def ok(self):
+        return len(self.violations()) == 0
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({1} violations, {0.lo}, {0.hi})'
+        return template.format(self, len(self.violations()))
+
+# A machine travel envelope with optional keep-out boxes around fixtures,
+# all in machine units
+class Envelope(object):
+    lo = None
+    hi = None
+    keepouts = None
+
+    def __init__(self, lo=None, hi=None):
+        inf = numpy.inf
+        self.lo = numpy.array(lo if lo is not None else (-inf, -inf, -inf), dtype=float)
+        self.hi = numpy.array(hi if hi is not None else (inf, inf, inf), dtype=float)
+        self.keepouts = []
+
+    def add_keepout(self, lo, hi):
+        self.keepouts.append((numpy.array(lo, dtype=float), numpy.array(hi, dtype=float)))
+
+    def check(self, segs):
+        report = Report()
+        report.segments = segs
+        (lo, hi) = segs.bounds()
+        n = len(segs)
+        if (n):
+            report.lo = lo.min(axis=0)
+            report.hi = hi.max(axis=0)
+        report.outside = numpy.any((lo < self.lo) | (hi > self.hi), axis=1)
+        report.keepout = numpy.zeros((n, len(self.keepouts)), dtype=bool)
+        if (not self.keepouts or not n):
+            return report
+
+        klo = numpy.array([box[0] for box in self.keepouts])
+        khi = numpy.array([box[1] for box in self.keepouts])
+        # Cheap box against box rejection for every segment and keep-out at once
+        near = numpy.all((lo[:, None] <= khi[None]) & (hi[:, None] >= klo[None]), axis=2)
+        (si, ki) = numpy.nonzero(near)
+
+        lines = (segs.kind[si] == segments.LINE)
+        report.keepout[si[lines], ki[lines]] = segments_hit_boxes(
+            segs.start[si[lines]], segs.end[si[lines]], klo[ki[lines]], khi[ki[lines]])
+
+        # Arcs are tested chord by chord with the boxes grown by the sagitta,
+        # so a chord can never miss what the arc itself touches
+        (si, ki) = (si[~lines], ki[~lines])
+        if (len(si)):
+            t = numpy.linspace(0, 1, ARC_CHORDS + 1)
+            pts = segs.arc_points(numpy.repeat(si, len(t)), numpy.tile(t, len(si)))
+            pts = pts.reshape(len(si), len(t), 3)
+            half = numpy.abs(segs.sweep[si])/ARC_CHORDS/2
+            sagitta = (segs.radius[si]*(1 - numpy.cos(half)))[:, None, None]
+            hit = segments_hit_boxes(pts[:, :-1], pts[:, 1:],
+                                     klo[ki][:, None] - sagitta, khi[ki][:, None] + sagitta)
+            report.keepout[si, ki] = hit.any(axis=1)
+        return report
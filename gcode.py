@@ -21,7 +21,10 @@
 from __future__ import absolute_import, division, print_function
 
 import sys
+import copy
 import math
+import re
+import itertools
 try:
     import numpy
 except ImportError:
@@ -31,33 +34,318 @@ except ImportError:
 # Get mathutils in from Blender and skip intermediate location handling
 from mathutils import Vector
 
+import compensation
+
 ###########
 # Globals #
 ###########
 
 OPERATIONS = {
+    "**" : lambda a, b : a**b,
     "*" : lambda a, b : a*b,
     "/" : lambda a, b : a/float(b),
+    "MOD" : lambda a, b : a % b,
     "+" : lambda a, b : a+b,
     "-" : lambda a, b : a-b,
+    "EQ" : lambda a, b : float(a == b),
+    "NE" : lambda a, b : float(a != b),
+    "GT" : lambda a, b : float(a > b),
+    "GE" : lambda a, b : float(a >= b),
+    "LT" : lambda a, b : float(a < b),
+    "LE" : lambda a, b : float(a <= b),
+    "AND" : lambda a, b : float(bool(a) and bool(b)),
+    "OR" : lambda a, b : float(bool(a) or bool(b)),
+    "XOR" : lambda a, b : float(bool(a) != bool(b)),
+}
+
+# The binary operators from the loosest to the tightest binding
+PRECEDENCE = (
+    ("AND", "OR", "XOR"),
+    ("EQ", "NE", "GT", "GE", "LT", "LE"),
+    ("+", "-"),
+    ("*", "/", "MOD"),
+    ("**",),
+)
+
+# Functions of a bracketed value, angles are in degrees
+FUNCTIONS = {
+    "ABS" : abs,
+    "ACOS" : lambda a : math.degrees(math.acos(a)),
+    "ASIN" : lambda a : math.degrees(math.asin(a)),
+    "COS" : lambda a : math.cos(math.radians(a)),
+    "EXP" : math.exp,
+    "FIX" : lambda a : float(math.floor(a)),
+    "FUP" : lambda a : float(math.ceil(a)),
+    "LN" : math.log,
+    "ROUND" : lambda a : math.copysign(math.floor(abs(a) + 0.5), a),
+    "SIN" : lambda a : math.sin(math.radians(a)),
+    "SQRT" : math.sqrt,
+    "TAN" : lambda a : math.tan(math.radians(a)),
 }
 
+# The tokens of an expression: operators, brackets, "#", "<name>", numbers and words
+EXPRESSION_TOKEN = re.compile(r"\s*(\*\*|[-+*/\[\]#]|<[^>]*>|\d+\.?\d*|\.\d+|[A-Za-z_]+)")
+
+# Variables #1-#30 are local to a subroutine call
+LOCAL_VARIABLES = ["#%d" % n for n in range(1, 31)]
+
+# Compiled expressions by their text
+EXPRESSIONS = {}
+
+# O-word keywords and the keyword opening their block
+BLOCK_ENDS = {"endsub": "sub", "endif": "if", "endwhile": "while", "endrepeat": "repeat"}
+
+# O-word keywords that continue somewhere else than the next statement
+JUMP_KEYWORDS = ("sub", "endwhile", "while", "repeat", "endrepeat", "if", "elseif", "else",
+                 "break", "continue", "call")
+
 # The rapid speed rate in mm/s
 RAPID_SPEED_MM = 25.0
 
+# Millimeters per inch
+INCH = 25.4
+
+# Canned drilling cycles
+CANNED_CYCLES = ("G73", "G81", "G82", "G83", "G84", "G85", "G86", "G87", "G88", "G89")
+
+# Codes that stay in effect for the following lines holding only axis words
+MOTION_CODES = ("G00", "G01", "G02", "G03") + CANNED_CYCLES
+
+# Codes using the axis words for something else than a move
+AXIS_CODES = ("G10", "G28", "G30", "G92")
+
+# Work coordinate systems G54-G59.3 and their index in the offset table
+COORDINATE_SYSTEMS = {
+    "G54": 1, "G55": 2, "G56": 3, "G57": 4, "G58": 5, "G59": 6,
+    "G59.1": 7, "G59.2": 8, "G59.3": 9,
+}
+
+# Steps between the checkpoints a reloaded program restarts from
+CHECKPOINT_INTERVAL = 500
+
+# State attributes not saved in checkpoints: the program, and the growing
+# records that are cut back instead
+CHECKPOINT_SKIP = ("program", "paths", "visits", "stepPaths", "checkpoints", "trace")
+
 #############
 # Functions #
 #############
 
+# Normalize a G or M word, eg. "G1" -> "G01" and "G90.1" stays "G90.1".
+# Returns None if it is not a valid code.
+def format_code(code):
+    letter = code[0]
+    (num, dot, fraction) = code[1:].partition(".")
+    try:
+        num = int(num)
+        if (dot):
+            int(fraction)
+    except ValueError:
+        return None
+    code = "%s%02d" % (letter, num)
+    if (dot):
+        code += "." + fraction
+    return code
+
+# Split a line on the white space outside of brackets, eg.
+# "G01 X [#1 * 2] Y0" -> ["G01", "X", "[#1 * 2]", "Y0"]
+def split_words(line):
+    words = []
+    word = ""
+    depth = 0
+    for c in line:
+        if (c == "["):
+            depth += 1
+        elif (c == "]"):
+            depth -= 1
+        if (c.isspace() and depth <= 0):
+            if (word):
+                words.append(word)
+            word = ""
+        else:
+            word += c
+    if (word):
+        words.append(word)
+    return words
+
+def tokenize_expression(exp):
+    tokens = []
+    exp = exp.strip()
+    pos = 0
+    while pos < len(exp):
+        match = EXPRESSION_TOKEN.match(exp, pos)
+        if (not match):
+            raise ValueError("bad expression: %s" % repr(exp))
+        token = match.group(1)
+        if (token.startswith("<")):
+            token = token.lower()
+        else:
+            token = token.upper()
+        tokens.append(token)
+        pos = match.end()
+    return tokens
+
+# Compile an expression into a function of the variable table. The result
+# is cached by the text so statements in a loop are only parsed once.
+def compile_expression(exp):
+    try:
+        return EXPRESSIONS[exp]
+    except KeyError:
+        pass
+    tokens = tokenize_expression(exp)
+    (func, n) = _parse_binary(tokens, 0, 0)
+    if (n != len(tokens)):
+        raise ValueError("bad expression: %s" % repr(exp))
+    EXPRESSIONS[exp] = func
+    return func
+
+def _expect(tokens, n, token):
+    if (n >= len(tokens) or tokens[n] != token):
+        raise ValueError("expected %s in %s" % (token, " ".join(tokens)))
+    return n + 1
+
+def _binary(func, left, right):
+    return lambda variables : func(left(variables), right(variables))
+
+# Binary operators of the given precedence level and tighter
+def _parse_binary(tokens, n, level):
+    if (level == len(PRECEDENCE)):
+        return _parse_unary(tokens, n)
+    (left, n) = _parse_binary(tokens, n, level + 1)
+    while n < len(tokens) and tokens[n] in PRECEDENCE[level]:
+        func = OPERATIONS[tokens[n]]
+        (right, n) = _parse_binary(tokens, n + 1, level + 1)
+        left = _binary(func, left, right)
+    return (left, n)
+
+# Numbers, variables, bracketed expressions, functions and signs
+def _parse_unary(tokens, n):
+    if (n >= len(tokens)):
+        raise ValueError("unexpected end of %s" % " ".join(tokens))
+    token = tokens[n]
+    if (token == "-"):
+        (arg, n) = _parse_unary(tokens, n + 1)
+        return (lambda variables : -arg(variables), n)
+    if (token == "+"):
+        return _parse_unary(tokens, n + 1)
+    if (token == "["):
+        (inner, n) = _parse_binary(tokens, n + 1, 0)
+        return (inner, _expect(tokens, n, "]"))
+    if (token == "#"):
+        if (n + 1 < len(tokens) and tokens[n + 1].startswith("<")):
+            # Named variable, eg. #<depth>
+            name = "#" + tokens[n + 1]
+            return (lambda variables : variables.get(name, 0.0), n + 2)
+        # Numbered variable, the number may itself be computed (eg. ##1)
+        (index, n) = _parse_unary(tokens, n + 1)
+        return (lambda variables : variables.get("#%d" % round(index(variables)), 0.0), n)
+    if (token == "ATAN"):
+        # Two argument arc tangent, ATAN[y]/[x]
+        (y, n) = _parse_unary(tokens, _expect(tokens, n + 1, "[") - 1)
+        (x, n) = _parse_unary(tokens, _expect(tokens, _expect(tokens, n, "/"), "[") - 1)
+        return (lambda variables : math.degrees(math.atan2(y(variables), x(variables))), n)
+    if (token in FUNCTIONS):
+        func = FUNCTIONS[token]
+        (arg, n) = _parse_unary(tokens, _expect(tokens, n + 1, "[") - 1)
+        return (lambda variables : func(arg(variables)), n)
+    try:
+        value = float(token)
+    except ValueError:
+        raise ValueError("unknown word %s in %s" % (token, " ".join(tokens)))
+    return (lambda variables : value, n + 1)
+
+# The innermost open block with the given label and one of the keywords
+def _find_block(blocks, label, keywords):
+    for block in reversed(blocks):
+        if (block[0] == label and block[1] in keywords):
+            return block
+    return None
+
+# Match the O-word blocks of the program once and store where each of their
+# statements continues in prog.jumps (and the endif of every if branch in
+# prog.ends), so running a loop never has to search for its end
+def resolve_blocks(prog):
+    prog.jumps = {}
+    prog.ends = {}
+    prog.subroutines = {}
+    # Open blocks as [label, keyword, statement, branches]
+    blocks = []
+    calls = []
+    for (i, st) in enumerate(prog.statements):
+        if (st.code != "O"):
+            continue
+        label = st.args[0]
+        keyword = st.args[1] if len(st.args) > 1 else ""
+        top = blocks[-1] if blocks else None
+        if (keyword == "while" and top and top[0] == label and top[1] == "do"):
+            # The condition closing a do-while loop
+            blocks.pop()
+            prog.jumps[top[2]] = i
+            prog.jumps[i] = top[2]
+        elif (keyword in ("sub", "if", "do", "while", "repeat")):
+            blocks.append([label, keyword, i, []])
+        elif (keyword in ("elseif", "else")):
+            if (top and top[0] == label and top[1] == "if"):
+                top[3].append(i)
+            else:
+                print("unmatched %s: %s" % (keyword, st.command))
+                prog.invalidLines.append(st.command)
+        elif (keyword in BLOCK_ENDS):
+            if (not top or top[0] != label or top[1] != BLOCK_ENDS[keyword]):
+                print("unmatched %s: %s" % (keyword, st.command))
+                prog.invalidLines.append(st.command)
+                continue
+            blocks.pop()
+            start = top[2]
+            if (keyword == "endsub"):
+                prog.subroutines[label] = start
+                prog.jumps[start] = i
+            elif (keyword == "endif"):
+                # Every branch continues with the next one when its condition fails
+                branches = [start] + top[3]
+                for (branch, following) in zip(branches, branches[1:] + [i]):
+                    prog.jumps[branch] = following
+                    prog.ends[branch] = i
+            else:
+                prog.jumps[start] = i
+                prog.jumps[i] = start
+        elif (keyword in ("break", "continue")):
+            loop = _find_block(blocks, label, ("while", "do", "repeat"))
+            if (loop is None):
+                print("%s outside of a loop: %s" % (keyword, st.command))
+                prog.invalidLines.append(st.command)
+            else:
+                prog.jumps[i] = loop[2]
+        elif (keyword == "call"):
+            calls.append(i)
+
+    for block in blocks:
+        st = prog.statements[block[2]]
+        print("unclosed %s: %s" % (block[1], st.command))
+        prog.invalidLines.append(st.command)
+    # Subroutines may be defined after they are called
+    for i in calls:
+        st = prog.statements[i]
+        if (st.args[0] in prog.subroutines):
+            prog.jumps[i] = prog.subroutines[st.args[0]]
+        else:
+            print("unknown subroutine: %s" % st.command)
+            prog.invalidLines.append(st.command)
+
 def parse_program(path):
-    fd = open(path, "r")
-    lastG = None
-
-    prog = Program()
-    while 1:
-        line = fd.readline()
-        if (not line): 
-            break
+    with open(path, "r") as fd:
+        return parse_lines(fd)
+
+# Parse the statements of any iterable of lines, eg. an open file or a list
+# of strings. Given a program, the statements are added to the end of it as
+# the lines following its text, eg. for a program streamed line by line.
+def parse_lines(lines, prog=None):
+    if (prog is None):
+        prog = Program()
+    lastG = prog.lastMotion
+    first = len(prog.statements)
+
+    for line in lines:
         line = line.strip()
 
         try:
@@ -68,53 +356,58 @@ def parse_program(path):
             comment = line[i:]
             line = line[:i].strip()
 
-        args = line.split()
+        args = split_words(line)
 
         statement = Statement()
         statement.command = line.strip() + " " + comment
         statement.lineNumber = len(prog.statements)
         if (line.startswith("#")):
-            # Assignment statement
-            if (len(args) != 3):
+            # Assignment statement, eg. "#1 = [#1 + 2]"
+            (name, op, exp) = line.partition("=")
+            (name, exp) = (name.strip(), exp.strip())
+            if (not op or not name or not exp):
                 print("bad line: %s" % repr(line))
                 prog.invalidLines.append(line)
                 continue
 
-            name = args[0]
-            op = args[1]
-            exp = args[2]
-
-            if (op != "="):
-                print("bad line: %s" % repr(line))
-                continue
-
             statement.code = op
             statement.args = (name, exp)
 
+        elif (line[:1] in ("O", "o")):
+            # Control flow, eg. "O100 while [#1 LT 10]". The label and the
+            # keyword are lower case, the rest are the bracketed values.
+            statement.code = "O"
+            statement.args = [args[0].lower()] + [word.lower() for word in args[1:2]] + args[2:]
+
         elif (not line):
             pass
 
         else:
+            if (args[0].startswith("N") and args[0][1:].isdigit()):
+                # Drop the block number
+                args = args[1:]
             code = args[0]
             args = args[1:]
+            codes = []
+            # A word leading the codes, eg. "T1 M06", "S1000 M03" or
+            # "F300 G01 X5"
+            leading = None
             if (code.startswith("G") or code.startswith("M")):
                 # Format as a two digit number to make things standard (M2 -> M02)
-                letter = code[0]
-                try:
-                    num = int(code[1:])
-                except ValueError:
+                code = format_code(code)
+                if (code is None):
                     prog.invalidLines.append(line)
                     continue
-                code = "%s%02d" % (letter, num)
-                lastG = code
+                codes.append(code)
 
             else:
                 if (code.startswith("X") or code.startswith("Y") or code.startswith("Z")):
                     # Continuation, some gcode doesn't reiterate the command if next line is the same
                     args = [code] + args[0:]
-                    code = lastG
+                    code = lastG or ""
+                else:
+                    leading = code
 
-            statement.code = code
             statement.args = args
 
             # Parse the arguments for self statement. Each parameter has a letter associated
@@ -136,14 +429,55 @@ def parse_program(path):
                     # The parameter and value come as a single token (eg "X123.4")
                     key = arg[0]
                     value = arg[1:]
+                if (key == "G" or key == "M"):
+                    # More codes on the same line (eg "G90 G54 G00 X0")
+                    extra = format_code(key + value)
+                    if (extra is not None):
+                        codes.append(extra)
+                    continue
                 statement.params[key] = value
 
+            if (codes):
+                if (leading):
+                    # The leading word is kept as a parameter of the line
+                    statement.params[leading[0]] = leading[1:]
+                motion = [c for c in codes if c in MOTION_CODES]
+                if (motion):
+                    code = motion[-1]
+                elif (lastG and not set(codes) & set(AXIS_CODES) and
+                      ("X" in statement.params or "Y" in statement.params or "Z" in statement.params)):
+                    # Axis words without a motion code keep moving in the current motion mode
+                    code = lastG
+                else:
+                    code = codes[0]
+                statement.modes = [c for c in codes if c != code]
+                if (code in MOTION_CODES):
+                    lastG = code
+                elif ("G80" in codes):
+                    lastG = None
+
+            statement.code = code
+
         statement.comment = comment
         prog.statements.append(statement)
+        prog.hashes.append(hash(statement.command))
 
-    fd.close()
+    prog.lastMotion = lastG
+    # Only the O-words have blocks to match
+    if (first == 0 or any(st.code == "O" for st in prog.statements[first:])):
+        resolve_blocks(prog)
     return prog
 
+# The number of the first statement that differs between two versions of a
+# program, None when they are the same
+def first_change(old, new):
+    for (i, (a, b)) in enumerate(zip(old.hashes, new.hashes)):
+        if (a != b):
+            return i
+    if (len(old.hashes) == len(new.hashes)):
+        return None
+    return min(len(old.hashes), len(new.hashes))
+
 def distance_from_point_to_line(pt, p1, p2):
     return abs( (p2[0]-p1[0])*(p1[1]-pt[1]) - (p1[0]-pt[0])*(p2[1]-p1[1]) ) / numpy.linalg.norm(p2-p1)
 
@@ -161,7 +495,7 @@ def reduce_paths(paths, tolerance):
                 for p in running:
                     dist = distance_from_point_to_line(p.end, start, end)
                     if (dist > tolerance):
-                        line = Line(start, running[-1].end, running[0].feedRate)
+                        line = Line(start, running[-1].end, running[0].feedRate, running[0].scale)
                         lst.append(line)
                         running = [path]
                         break
@@ -169,7 +503,7 @@ def reduce_paths(paths, tolerance):
                 running.append(path)
         else:
             if (running):
-                line = Line(running[0].start, running[-1].end, running[0].feedRate)
+                line = Line(running[0].start, running[-1].end, running[0].feedRate, running[0].scale)
                 lst.append(line)
                 running = []
             lst.append(path)
@@ -183,10 +517,25 @@ def reduce_paths(paths, tolerance):
 class Program(object):
     statements = None
     invalidLines = None
+    # Where the O-word statements continue, by statement index, and the
+    # endif closing every if/elseif/else branch
+    jumps = None
+    ends = None
+    # The sub statement of every subroutine by its label
+    subroutines = None
+    # Hash of the text of every statement, to find what changed on a reload
+    hashes = None
+    # The motion mode at the end of the text, which lines added later
+    # continue in
+    lastMotion = None
 
     def __init__(self):
         self.statements = []
         self.invalidLines = []
+        self.jumps = {}
+        self.ends = {}
+        self.subroutines = {}
+        self.hashes = []
 
     def start(self):
         return State(self)
@@ -197,6 +546,8 @@ class Statement(object):
     comment = None
     command = None
     params = None
+    # Further G/M codes on the same line, executed before the main code
+    modes = ()
     lineNumber = 0
 
     def __init__(self):
@@ -215,14 +566,21 @@ class Path(object):
     statement = None
     # The command that generated self path
     command = ""
-    # The length of the path in machine units
+    # The length of the path in scene units
     length = 0
-    # The rate which we move along the path, in machine units
+    # The rate which we move along the path, in machine units per second
     feedRate = 1
+    # Machine units per scene unit, which the duration is worked out with
+    scale = 1
     # When self path is traversed in the job timeline
     startTime = 0
     duration = 0
 
+    # The simple paths making up self one, for records standing in for many
+    # moves (eg. canned cycles) that are only expanded when drawn
+    def expand(self):
+        return [self]
+
 # A path between two points
 class Line(Path):
     start = None
@@ -231,12 +589,13 @@ class Line(Path):
     # a linear interpolation (G01)
     rapid = False
 
-    def __init__(self, start, end, feedRate):
+    def __init__(self, start, end, feedRate, scale=1):
         self.start = start.copy()
         self.end = end.copy()
         self.feedRate = feedRate
+        self.scale = scale
         self.length = numpy.linalg.norm(self.end-self.start)
-        self.duration = self.length/float(self.feedRate)
+        self.duration = self.length*scale/float(self.feedRate)
 
     def __repr__(self):
         template = '{0.__class__.__name__}({0.start}, {0.end}, {0.feedRate})'
@@ -252,11 +611,12 @@ class Arc(Path):
     diff = 0
     plane = "XY"
 
-    def __init__(self, start, end, center, feedRate, clockwise=True, plane="XY"):
+    def __init__(self, start, end, center, feedRate, clockwise=True, plane="XY", scale=1):
         self.start = start.copy()
         self.end = end.copy()
         self.center = center.copy()
         self.feedRate = feedRate
+        self.scale = scale
         self.clockwise = clockwise
         self.plane = plane
 
@@ -301,7 +661,7 @@ class Arc(Path):
 
         self.diff = diff
         self.length = self.radius * diff
-        self.duration = self.length/float(self.feedRate)
+        self.duration = self.length*scale/float(self.feedRate)
 
     def __repr__(self):
         template = ('{0.__class__.__name__}({0.start}, {0.end}, {0.center}, '
@@ -319,6 +679,162 @@ class Dwell(Path):
     def __repr__(self):
         return self.__class__.__name__ + '()'
 
+# A canned drilling cycle (G73, G81-G89) over one or more holes, kept as a
+# single record. The individual moves are only created by expand(). Holes
+# are drilled along Z.
+class CannedCycle(Path):
+    code = "G81"
+    # Where the tool was when the cycle started
+    start = None
+    # First hole, at the start height, and the offset between repeated holes
+    position = None
+    step = None
+    count = 1
+    # Heights in scene units: the R plane, the bottom and the retract height
+    rPlane = 0
+    depth = 0
+    retract = 0
+    # Peck depth (0 for none) and the back off between pecks, scene units
+    peck = 0
+    clearance = 0
+    # Dwell at the bottom in seconds
+    dwell = 0
+    rapidSpeed = RAPID_SPEED_MM
+    # The duration of every move as a planner timed it, None until then
+    durations = None
+
+    def __init__(self, code, start, position, feedRate, rapidSpeed):
+        self.code = code
+        self.start = start.copy()
+        self.position = position.copy()
+        self.step = Vector([0.0, 0.0, 0.0])
+        self.feedRate = feedRate
+        self.rapidSpeed = rapidSpeed
+
+    # Yields (kind, position) for every move of the cycle where kind is one
+    # of "rapid", "feed" or "dwell"
+    def moves(self):
+        pecking = (self.code in ("G73", "G83") and self.peck > 0)
+        # Boring and reaming cycles feed back out of the hole
+        feedOut = (self.code in ("G84", "G85", "G89"))
+        z = self.start.z
+        for n in range(self.count):
+            (x, y) = (self.position.x + n*self.step.x, self.position.y + n*self.step.y)
+            yield ("rapid", (x, y, z))
+            yield ("rapid", (x, y, self.rPlane))
+            if (pecking):
+                bottom = self.rPlane
+                while (bottom > self.depth):
+                    bottom = max(bottom - self.peck, self.depth)
+                    yield ("feed", (x, y, bottom))
+                    if (bottom <= self.depth):
+                        break
+                    if (self.code == "G83"):
+                        # Full retract to clear the chips, then back down
+                        yield ("rapid", (x, y, self.rPlane))
+                        yield ("rapid", (x, y, bottom + self.clearance))
+                    else:
+                        # Chip breaking, back off a little
+                        yield ("rapid", (x, y, bottom + self.clearance))
+            else:
+                yield ("feed", (x, y, self.depth))
+            if (self.dwell > 0 and self.code in ("G82", "G86", "G89")):
+                yield ("dwell", (x, y, self.depth))
+            z = self.retract
+            yield ("feed" if feedOut else "rapid", (x, y, z))
+
+    def end(self):
+        n = self.count - 1
+        return Vector([self.position.x + n*self.step.x, self.position.y + n*self.step.y, self.retract])
+
+    # Work out the length and duration without creating any path
+    def measure(self):
+        self.length = 0
+        self.duration = 0
+        pos = (self.start.x, self.start.y, self.start.z)
+        for (kind, target) in self.moves():
+            if (kind == "dwell"):
+                self.duration += self.dwell
+                continue
+            length = math.sqrt(sum((a - b)**2 for (a, b) in zip(target, pos)))
+            rate = self.rapidSpeed if kind == "rapid" else self.feedRate
+            self.length += length
+            self.duration += length*self.scale/float(rate)
+            pos = target
+
+    def expand(self):
+        paths = []
+        pos = self.start.copy()
+        for (kind, target) in self.moves():
+            if (kind == "dwell"):
+                path = Dwell()
+                path.duration = self.dwell
+            else:
+                target = Vector(target)
+                path = Line(pos, target, self.rapidSpeed if kind == "rapid" else self.feedRate, self.scale)
+                path.rapid = (kind == "rapid")
+                pos = target
+            path.spindleOn = self.spindleOn
+            path.statement = self.statement
+            paths.append(path)
+
+        if (self.durations is not None and len(self.durations) == len(paths)):
+            # Each move takes the time the planner gave it
+            for (path, duration) in zip(paths, self.durations):
+                path.duration = duration
+        else:
+            # Fit the moves into the time given to the cycle
+            total = sum(path.duration for path in paths)
+            ratio = self.duration/total if total > 0 else 0
+            for path in paths:
+                path.duration *= ratio
+        time = self.startTime
+        for path in paths:
+            path.startTime = time
+            time += path.duration
+        return paths
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({0.code}, {0.position}, {0.count}, {0.rPlane}, {0.depth})'
+        return template.format(self)
+
+# A move made under cutter compensation. It stands in for the tool center
+# paths found when its whole block is offset, and expands to nothing until
+# then.
+class Compensated(Path):
+    # The move as programmed
+    programmed = None
+    children = None
+
+    def __init__(self, path):
+        self.programmed = path
+        self.statement = path.statement
+        self.spindleOn = path.spindleOn
+        self.feedRate = path.feedRate
+        self.startTime = path.startTime
+        self.duration = path.duration
+        self.length = path.length
+
+    def expand(self):
+        if (self.children is None):
+            return []
+        return self.children
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({0.programmed}, {0.children})'
+        return template.format(self)
+
+# The state of a simulation between two steps
+class Checkpoint(object):
+    # Steps run and paths recorded up to here
+    steps = 0
+    paths = 0
+    # The highest statement number the state depends on. A reload changing
+    # nothing up to it can restart from here.
+    lastLine = -1
+    # Copies of the other state attributes
+    values = None
+
 class State(object):
     variables = None
     lineno = 0
@@ -334,61 +850,295 @@ class State(object):
     pos = None
     scale = 1000 # Blender standard is m which needs to be mm to match CNC format (not counting inches)
     spindleOn = True
+    # Spindle speed (rpm) set by the last S word
+    spindleSpeed = 0
     # The paths cut by the laser
     paths = None
-    # The units are mm by default
+    # The units are mm by default. Coordinates in inches are converted so
+    # the positions are always in mm.
     units = "mm"
+    unitScale = 1.0
     rapidSpeed = RAPID_SPEED_MM
+    # G90/G91 for the axes and G90.1/G91.1 for the arc centers
+    distanceMode = "absolute"
+    arcDistanceMode = "incremental"
+    # Active work coordinate system, 1-9 for G54-G59.3, and the table of
+    # their offsets in mm
+    coordSystem = 1
+    workOffsets = None
+    # The G92 offset in mm, and whether it is applied
+    axisOffset = None
+    axisOffsetOn = True
+    # Program zero in machine coordinates (mm), kept up to date from the
+    # work and G92 offsets so a move only adds it
+    origin = None
+    # Set by G53 for the rest of the current line
+    machineCoords = False
+    # Sticky canned cycle words (R, Z, Q, P), the height the cycle started
+    # from (None when no cycle is active) and G98/G99
+    cycle = None
+    cycleInitialZ = None
+    retractMode = "initial"
     # The list of not-implemented codes in self program
     unknownCodes = None
+    # The statement to run next when it is not the following one, set by
+    # the O-words
+    nextLine = None
+    # Return statement and saved local variables of every active call
+    callStack = None
+    # Passes left of the active repeat loops by their repeat statement
+    repeatCounts = None
+    # Set to the elseif/else a failed condition jumped to
+    branchJump = None
+    # How many times every statement ran, and the paths of the last step
+    visits = None
+    stepPaths = None
+    # The selected tool and the tool radii in mm set by G10 L1
+    tool = 0
+    toolRadii = None
+    # Cutter compensation side (compensation.LEFT/RIGHT or None), tool
+    # radius and plane. While it is on the paths are collected in compBlock
+    # and the moves among them in compMoves, and compExit is set by G40 for
+    # the exit move that ends the block.
+    compSide = None
+    compRadius = 0
+    compPlane = "XY"
+    compBlock = None
+    compMoves = None
+    compExit = False
+    # Checkpoints to restart from on a reload, the statement run by every
+    # step and the highest statement number run
+    checkpoints = None
+    trace = None
+    lastLine = -1
+    # Set while statements are still being added to the program, running
+    # out of them then only waits for more instead of finishing
+    streaming = False
 
     def __init__(self, program):
         self.variables = {}
         self.program = program
         self.paths = {}
+        self.visits = {}
+        self.checkpoints = []
+        self.trace = []
+        self.stepPaths = []
+        self.callStack = []
+        self.repeatCounts = {}
+        self.toolRadii = {}
         # Note it is important to pass floats to make self a float array (otherwise it uses ints)
         self.pos = Vector([0.0, 0.0, 0.0])
         self.unknownCodes = []
+        self.reset_modes()
 
     def reset(self):
         self.variables = {}
         self.paths = {}
+        self.visits = {}
+        self.checkpoints = []
+        self.trace = []
+        self.lastLine = -1
+        self.stepPaths = []
+        self.callStack = []
+        self.repeatCounts = {}
+        self.nextLine = None
+        self.branchJump = None
+        self.toolRadii = {}
         # Note it is important to pass floats to make self a float array (otherwise it uses ints)
         self.pos = Vector([0.0, 0.0, 0.0])
         self.unknownCodes = []
         self.lineno = 0
+        self.reset_modes()
+
+    def reset_modes(self):
+        self.units = "mm"
+        self.unitScale = 1.0
+        self.distanceMode = "absolute"
+        self.arcDistanceMode = "incremental"
+        self.coordSystem = 1
+        self.workOffsets = dict((n, [0.0, 0.0, 0.0]) for n in COORDINATE_SYSTEMS.values())
+        self.axisOffset = [0.0, 0.0, 0.0]
+        self.axisOffsetOn = True
+        self.cycle = {}
+        self.cycleInitialZ = None
+        self.retractMode = "initial"
+        self.compSide = None
+        self.compBlock = None
+        self.compMoves = None
+        self.compExit = False
+        self.update_origin()
+
+    def update_origin(self):
+        work = self.workOffsets[self.coordSystem]
+        if (self.axisOffsetOn):
+            self.origin = [work[i] + self.axisOffset[i] for i in range(3)]
+        else:
+            self.origin = list(work)
+
+    # Returns the position the X/Y/Z words of a move go to, honoring the
+    # distance mode, the units and the offsets
+    def target(self, params):
+        newpos = self.pos.copy()
+        for (i, axis) in enumerate("XYZ"):
+            if (not axis in params):
+                continue
+            value = params[axis]*self.unitScale
+            if (self.distanceMode == "incremental"):
+                newpos[i] = self.pos[i] + value/self.scale
+            elif (self.machineCoords):
+                newpos[i] = value/self.scale
+            else:
+                newpos[i] = (value + self.origin[i])/self.scale
+        return newpos
+
+    # Returns the arc center given by the I/J/K words of a move
+    def arc_center(self, params):
+        center = self.pos.copy()
+        for (i, axis) in enumerate("IJK"):
+            if (not axis in params):
+                continue
+            value = params[axis]*self.unitScale
+            if (self.arcDistanceMode == "incremental"):
+                center[i] = self.pos[i] + value/self.scale
+            else:
+                center[i] = (value + self.origin[i])/self.scale
+        return center
+
+    # Current position in program coordinates, ie. what G92 X.. refers to
+    def program_position(self):
+        return [(self.pos[i]*self.scale - self.origin[i])/self.unitScale for i in range(3)]
 
     # Returns the length of the job
     def get_run_length(self):
         total = 0
-        for path in self.paths:
+        for path in self.paths.values():
             total += path.duration
         return total
 
     def eval_expression(self, exp):
-        if (exp.startswith("[")):
-            # Calculated value
-            exp = exp[1:-1]
-
         if (not exp): 
             return 0
 
-        for op in ("*", "/", "+", "-"):
-            try:
-                i = exp.index(op)
-            except ValueError:
-                pass
-            else:
-                (left, right) = (exp[:i], exp[i+1:])
-                left = self.eval_expression(left)
-                right = self.eval_expression(right)
-                func = OPERATIONS[op]
-                return func(left, right)
-
-        if (exp.startswith("#")):
-            return self.variables[exp]
+        try:
+            return float(exp)
+        except ValueError:
+            # Calculated value
+            return compile_expression(exp)(self.variables)
+
+    # The key of the variable an assignment sets, eg. "#<depth>" or "#3"
+    def variable_key(self, name):
+        if (name.startswith("#<")):
+            return name.lower()
+        return "#%d" % round(self.eval_expression(name[1:]))
+
+    # Record a path made by the current statement. It is keyed by the
+    # statement number, and by (number, pass) when loops or calls run the
+    # statement again.
+    def add_path(self, path):
+        iteration = self.visits.get(self.lineno, 0)
+        path.iteration = iteration
+        key = (self.lineno, iteration) if iteration else self.lineno
+        # More records of the same line, eg. the tool change and the move
+        # of "M06 G00 X0", are numbered after the first
+        extra = 0
+        while (key in self.paths):
+            extra += 1
+            key = (self.lineno, iteration, extra)
+        self.paths[key] = path
+        self.stepPaths.append(path)
+        if (self.compBlock is not None):
+            self.compBlock.append(path)
+
+    # Record a move. Under cutter compensation it is held back until the
+    # block it belongs to is complete.
+    def add_move(self, path):
+        if (self.compBlock is None):
+            self.add_path(path)
+            return
+        record = Compensated(path)
+        self.add_path(record)
+        self.compMoves.append(record)
+        if (self.compExit):
+            # This was the exit move
+            self.flush_compensation()
+
+    # Offset the moves collected since G41/G42 as one batch, fill in their
+    # tool center paths and retime the block
+    def flush_compensation(self):
+        if (self.compBlock is None):
+            return
+        (block, moves, side, exit) = (self.compBlock, self.compMoves, self.compSide, self.compExit)
+        self.compSide = None
+        self.compBlock = None
+        self.compMoves = None
+        self.compExit = False
+        if (not block):
+            return
 
-        return float(exp)
+        if (moves):
+            axes = compensation.PLANE_AXES[self.compPlane]
+            paths = [record.programmed for record in moves]
+            arcs = numpy.array([isinstance(path, Arc) for path in paths])
+            start = numpy.array([[path.start[axes[0]], path.start[axes[1]]] for path in paths])
+            end = numpy.array([[path.end[axes[0]], path.end[axes[1]]] for path in paths])
+            center = numpy.array([[path.center[axes[0]], path.center[axes[1]]] if isinstance(path, Arc) else [0.0, 0.0]
+                                  for path in paths])
+            direction = numpy.array([-1.0 if isinstance(path, Arc) and path.clockwise else 1.0 for path in paths])
+            offset = compensation.offset_chain(start, end, center, arcs, direction,
+                                               self.compRadius, side, exit=exit)
+            for (i, record) in enumerate(moves):
+                record.children = self.compensated_paths(record.programmed, offset, i, axes)
+                if (offset.gouges[i]):
+                    print("Cutter compensation gouges on line %d" % record.statement.lineNumber)
+            # The moves of earlier steps can only be drawn now
+            current = set(id(path) for path in self.stepPaths)
+            self.stepPaths = [record for record in moves if id(record) not in current] + self.stepPaths
+
+        # The tool center paths take their own time
+        time = block[0].startTime
+        for record in block:
+            record.startTime = time
+            if (isinstance(record, Compensated)):
+                for path in record.children:
+                    path.startTime = time
+                    time += path.duration
+                record.duration = time - record.startTime
+            else:
+                time += record.duration
+        self.time = time
+
+    # The tool center paths of move i of a compensated block
+    def compensated_paths(self, path, offset, i, axes):
+        def point(uv, w):
+            p = Vector([0.0, 0.0, 0.0])
+            p[axes[0]] = uv[0]
+            p[axes[1]] = uv[1]
+            p[axes[2]] = w
+            return p
+
+        start = point(offset.start[i], path.start[axes[2]])
+        end = point(offset.end[i], path.end[axes[2]])
+        children = []
+        if (offset.corner[i] != compensation.CORNER_NONE):
+            cornerStart = point(offset.cornerStart[i], path.start[axes[2]])
+            if (offset.corner[i] == compensation.CORNER_ARC):
+                corner = Arc(cornerStart, start, path.start, path.feedRate,
+                             clockwise=(offset.cornerDirection < 0), plane=self.compPlane, scale=self.scale)
+            else:
+                corner = Line(cornerStart, start, path.feedRate, self.scale)
+                corner.rapid = getattr(path, "rapid", False)
+            children.append(corner)
+        if (isinstance(path, Arc)):
+            center = point(offset.center[i], path.center[axes[2]])
+            move = Arc(start, end, center, path.feedRate, clockwise=path.clockwise, plane=path.plane, scale=self.scale)
+        else:
+            move = Line(start, end, path.feedRate, self.scale)
+            move.rapid = path.rapid
+        children.append(move)
+        for child in children:
+            child.spindleOn = path.spindleOn
+            child.statement = path.statement
+        return children
 
     def eval_coords(self, args):
         lst = {}
@@ -403,48 +1153,53 @@ class State(object):
         return lst
 
     def handle_statement(self, st):
-        if (st.code == ""):
+        # Feed rate, spindle speed and tool words sharing the line with other
+        # codes, eg. "T1 M06" or "S1000 M03"
+        if (st.code not in ("O", "=")):
+            for key in ("F", "S", "T"):
+                if (key in st.params):
+                    self.handle_code(key + st.params[key], st)
+        # Modal codes sharing the line go first, eg. "G91 G01 X10"
+        for code in st.modes:
+            self.handle_code(code, st)
+        self.handle_code(st.code, st)
+        self.machineCoords = False
+
+    def handle_code(self, code, st):
+        if (code == ""):
             # Noop
             pass
 
-        elif (st.code == "%"):
+        elif (code == "%"):
             pass
 
-        elif (st.code == "="):
+        elif (code == "="):
             # Variable assignment
             (name, exp) = st.args
-            self.variables[name] = self.eval_expression(exp)
+            self.variables[self.variable_key(name)] = self.eval_expression(exp)
 
-        elif (st.code == "G01" or st.code == "G00"):
+        elif (code == "O"):
+            # Subroutines, loops and conditions
+            self.handle_flow(st)
+
+        elif (code == "G01" or code == "G00"):
             # Linear interpolation / rapid positioning
+            self.cycleInitialZ = None
             params = self.eval_params(st.params)
             try:
                 # The feed rate is supplied per minute
-                self.feedRate = params["F"]/60.0
+                self.feedRate = params["F"]*self.unitScale/60.0
             except KeyError:
                 pass
 
             if (self.pos is None):
                 # Use self move to define the starting position
-                self.pos = Vector([params["X"]/self.scale, 
-                                   params["Y"]/self.scale, 
-                                   params["Z"]/self.scale])
+                self.pos = Vector([0.0, 0.0, 0.0])
+                self.pos = self.target(params)
                 return
 
             if ("X" in params or "Y" in params or "Z" in params):
-                newpos = self.pos.copy()
-                try:
-                    newpos.x = params["X"]/self.scale
-                except KeyError:
-                    pass
-                try:
-                    newpos.y = params["Y"]/self.scale
-                except KeyError:
-                    pass
-                try:
-                    newpos.z = params["Z"]/self.scale
-                except KeyError:
-                    pass
+                newpos = self.target(params)
 
                 if (self.spindleOn):
                     # The spindle is on, move at the feed rate
@@ -454,137 +1209,450 @@ class State(object):
                     feedRate = self.rapidSpeed
 
                 # Create a line connecting our position to the target position
-                line = Line(self.pos, newpos, feedRate)
+                line = Line(self.pos, newpos, feedRate, self.scale)
                 line.startTime = self.time
                 line.spindleOn = self.spindleOn
-                line.rapid = (st.code == "G00")
+                line.rapid = (code == "G00")
                 line.statement = st
-                self.paths[self.lineno] = line
+                self.add_move(line)
                 # Advance the timeline
                 self.time += line.duration
                 # Jump to the end position
                 self.pos = newpos.copy()
 
-        elif (st.code == "G02" or st.code == "G03"):
+        elif (code == "G02" or code == "G03"):
             # Circle interpolation, clockwise or couter-clockwise
+            self.cycleInitialZ = None
             params = self.eval_params(st.params)
 
             try:
                 # The feed rate is supplied per minute
-                self.feedRate = params["F"]/60.0
+                self.feedRate = params["F"]*self.unitScale/60.0
             except KeyError:
                 pass
 
-            end = self.pos.copy()
-            if "X" in params: end.x = params["X"]/self.scale
-            if "Y" in params: end.y = params["Y"]/self.scale
-            if "Z" in params: end.z = params["Z"]/self.scale
-            i = params["I"]/self.scale if "I" in params else 0
-            j = params["J"]/self.scale if "J" in params else 0
-            k = params["K"]/self.scale if "K" in params else 0
-            
+            end = self.target(params)
+
             if (self.spindleOn):
-                center = self.pos + Vector([i,j,k])
-                # center = Vector([self.pos.x + i, self.pos.y + j, self.pos.z + k])
+                center = self.arc_center(params)
 
-                arc = Arc(self.pos, end, center, self.feedRate, clockwise=(st.code=="G02"), plane=self.plane)
+                arc = Arc(self.pos, end, center, self.feedRate, clockwise=(code=="G02"), plane=self.plane, scale=self.scale)
                 arc.startTime = self.time
                 arc.spindleOn = self.spindleOn
                 arc.statement = st
-                self.paths[self.lineno] = arc
+                self.add_move(arc)
                 # Advance the timeline
                 self.time += arc.duration
 
             self.pos = end.copy()
 
-        elif (st.code == "M02"):
+        elif (code in CANNED_CYCLES):
+            self.handle_cycle(code, st)
+
+        elif (code in ("G41", "G42", "G41.1", "G42.1")):
+            # Cutter compensation, D is the tool number or with G41.1/G42.1
+            # the tool diameter
+            params = self.eval_params(st.params)
+            if (code.endswith(".1")):
+                radius = params.get("D", 0)*self.unitScale/2.0
+            else:
+                radius = self.toolRadii.get(int(params.get("D", self.tool)), 0)
+            self.flush_compensation()
+            self.compSide = compensation.LEFT if code.startswith("G41") else compensation.RIGHT
+            self.compRadius = radius/self.scale
+            self.compPlane = self.plane
+            self.compBlock = []
+            self.compMoves = []
+
+        elif (code == "G40"):
+            # Cancel the cutter compensation after the exit move
+            if (self.compBlock is not None):
+                self.compExit = True
+
+        elif (code == "G80"):
+            # Cancel the canned cycle
+            self.cycleInitialZ = None
+
+        elif (code == "G98"):
+            # Canned cycles retract to the height they started from
+            self.retractMode = "initial"
+
+        elif (code == "G99"):
+            # Canned cycles retract to the R plane
+            self.retractMode = "r"
+
+        elif (code == "M02" or code == "M30"):
             # End of program
             self.finished = True
 
-        elif (st.code == "M03"):
+        elif (code == "M03" or code == "M04"):
             self.spindleOn = True
 
-        elif (st.code == "M05"):
+        elif (code == "M05"):
             self.spindleOn = False
 
-        elif (st.code == "G96"):
+        elif (code == "G96"):
             # Constant surface speed
             pass
 
-        elif (st.code == "G21"):
-            # Assumed to be in mm
-            pass
+        elif (code == "G21"):
+            # Programming in mm
+            self.units = "mm"
+            self.unitScale = 1.0
 
-        elif (st.code == "G20"):
-            # Programming in inches
+        elif (code == "G20"):
+            # Programming in inches, converted to mm as they are read
             self.units = "in"
-            self.rapidSpeed = RAPID_SPEED_MM/25.4
+            self.unitScale = INCH
 
-        elif (st.code == "G90"):
-            print("G90: absolute distance mode")
+        elif (code == "G90"):
+            if (self.debug): print("G90: absolute distance mode")
+            self.distanceMode = "absolute"
+
+        elif (code == "G91"):
+            if (self.debug): print("G91: incremental distance mode")
+            self.distanceMode = "incremental"
+
+        elif (code == "G90.1"):
+            # I/J/K are absolute arc centers
+            self.arcDistanceMode = "absolute"
+
+        elif (code == "G91.1"):
+            # I/J/K are relative to the arc start
+            self.arcDistanceMode = "incremental"
+
+        elif (code in COORDINATE_SYSTEMS):
+            # Select a work coordinate system
+            self.coordSystem = COORDINATE_SYSTEMS[code]
+            self.update_origin()
+
+        elif (code == "G53"):
+            # Machine coordinates for the move on self line
+            self.machineCoords = True
+
+        elif (code == "G10"):
+            # Set the work offsets of a coordinate system. L2 gives the offset,
+            # L20 the offset that makes the current position read as given.
+            params = self.eval_params(st.params)
+            if (int(params.get("L", 2)) in (1, 10)):
+                # Tool table entry, P is the tool and R its radius
+                self.toolRadii[int(params.get("P", 0))] = params.get("R", 0)*self.unitScale
+                return
+            system = int(params.get("P", 0)) or self.coordSystem
+            offset = self.workOffsets[system]
+            for (i, axis) in enumerate("XYZ"):
+                if (not axis in params):
+                    continue
+                value = params[axis]*self.unitScale
+                if (int(params.get("L", 2)) == 20):
+                    axisOffset = self.axisOffset[i] if self.axisOffsetOn else 0
+                    offset[i] = self.pos[i]*self.scale - axisOffset - value
+                else:
+                    offset[i] = value
+            self.update_origin()
 
-        elif (st.code == "G17"):
-            print("G17: Switching to XY plane")
+        elif (code == "G92"):
+            # Offset the axes so the current position reads as given
+            params = self.eval_params(st.params)
+            work = self.workOffsets[self.coordSystem]
+            for (i, axis) in enumerate("XYZ"):
+                if (axis in params):
+                    self.axisOffset[i] = self.pos[i]*self.scale - work[i] - params[axis]*self.unitScale
+            self.axisOffsetOn = True
+            self.update_origin()
+
+        elif (code == "G92.1"):
+            # Clear the axis offsets
+            self.axisOffset = [0.0, 0.0, 0.0]
+            self.update_origin()
+
+        elif (code == "G92.2"):
+            # Suspend the axis offsets
+            self.axisOffsetOn = False
+            self.update_origin()
+
+        elif (code == "G92.3"):
+            # Restore the suspended axis offsets
+            self.axisOffsetOn = True
+            self.update_origin()
+
+        elif (code == "G17"):
+            if (self.debug): print("G17: Switching to XY plane")
             # Switch to XY plane selection
             self.plane = "XY"
 
-        elif (st.code == "G18"):
-            print("G18: Switching to ZX plane")
+        elif (code == "G18"):
+            if (self.debug): print("G18: Switching to ZX plane")
             # Switch to ZX plane selection
             self.plane = "ZX"
 
-        elif (st.code == "G19"):
-            print("G19: Switching to YZ plane")
+        elif (code == "G19"):
+            if (self.debug): print("G19: Switching to YZ plane")
             # Switch to YZ plane selection
             self.plane = "YZ"
 
-        elif (st.code.startswith("F")):
-            # Feed rate definition
-            rate = self.eval_expression(st.code[1:])
-            self.feedRate = float(rate)
+        elif (code.startswith("F")):
+            # Feed rate definition, supplied per minute
+            rate = self.eval_expression(code[1:])
+            self.feedRate = float(rate)*self.unitScale/60.0
 
-        elif (st.code == "M06" or st.code == "M6"):
+        elif (code == "M06" or code == "M6"):
             # Tool change operation
             change = ToolChange()
             change.duration = 3
             change.startTime = self.time
             change.statement = st
-            self.paths[self.lineno] = change
+            if ("T" in st.params):
+                self.tool = int(self.eval_expression(st.params["T"]))
+            self.add_path(change)
             self.time += change.duration
 
-        elif (st.code.startswith("T")):
+        elif (code.startswith("S")):
+            # Spindle speed, in rpm
+            try:
+                self.spindleSpeed = float(self.eval_expression(code[1:]))
+            except ValueError:
+                pass
+
+        elif (code.startswith("T")):
             # Tool selection operation
-            pass
+            try:
+                self.tool = int(self.eval_expression(code[1:]))
+            except ValueError:
+                pass
 
-        elif (st.code == "G04"):
+        elif (code == "G04"):
             # Dwell operation
             params = self.eval_params(st.params)
             dwell = Dwell()
             dwell.startTime = self.time
             dwell.statement = st
             dwell.duration = params.get("P", 0)
-            self.paths[self.lineno] = dwell
+            self.add_path(dwell)
             self.time += dwell.duration
 
         else:
-            print("Unknown code: %s" % st.code)
-            if (not st.code in self.unknownCodes):
-                self.unknownCodes.append(st.code)
+            print("Unknown code: %s" % code)
+            if (not code in self.unknownCodes):
+                self.unknownCodes.append(code)
+
+    def handle_cycle(self, code, st):
+        params = self.eval_params(st.params)
+        try:
+            self.feedRate = params["F"]*self.unitScale/60.0
+        except KeyError:
+            pass
+        # R, Z, Q and P carry over to the following holes of the cycle
+        for key in ("R", "Z", "Q", "P"):
+            if (key in params):
+                self.cycle[key] = params[key]
+        if (self.cycleInitialZ is None):
+            self.cycleInitialZ = self.pos.z
+
+        initial = self.cycleInitialZ
+        r = self.cycle.get("R", 0)*self.unitScale
+        z = self.cycle.get("Z", 0)*self.unitScale
+        if (self.distanceMode == "incremental"):
+            # R is relative to the start height and Z to the R plane
+            rPlane = initial + r/self.scale
+            depth = rPlane + z/self.scale
+        else:
+            rPlane = (r + self.origin[2])/self.scale
+            depth = (z + self.origin[2])/self.scale
+
+        # The hole position, the Z word is the depth and not a move
+        xy = dict((key, params[key]) for key in ("X", "Y") if key in params)
+        position = self.target(xy)
+        position.z = self.pos.z
+
+        cycle = CannedCycle(code, self.pos, position, self.feedRate, self.rapidSpeed)
+        cycle.scale = self.scale
+        cycle.rPlane = rPlane
+        cycle.depth = depth
+        cycle.retract = max(initial, rPlane) if self.retractMode == "initial" else rPlane
+        cycle.peck = abs(self.cycle.get("Q", 0))*self.unitScale/self.scale
+        cycle.clearance = min(0.5/self.scale, cycle.peck) if cycle.peck else 0
+        cycle.dwell = self.cycle.get("P", 0)
+        if (self.distanceMode == "incremental"):
+            # L repeats the hole at the same incremental spacing
+            cycle.count = max(int(params.get("L", 1)), 1)
+            cycle.step = position - self.pos
+            cycle.step.z = 0
+        cycle.spindleOn = self.spindleOn
+        cycle.statement = st
+        cycle.startTime = self.time
+        cycle.measure()
+        self.add_path(cycle)
+        self.time += cycle.duration
+        self.pos = cycle.end()
+
+    # Run an O-word statement, setting nextLine when the program goes on
+    # somewhere else than the following statement
+    def handle_flow(self, st):
+        i = self.lineno
+        keyword = st.args[1] if len(st.args) > 1 else ""
+        values = st.args[2:]
+        jumps = self.program.jumps
+        jumped = (self.branchJump == i)
+        self.branchJump = None
+        if (keyword in JUMP_KEYWORDS and not i in jumps):
+            # The block did not match up when parsing, run on
+            return
+
+        if (keyword == "sub"):
+            # The definition is skipped, the body only runs when called
+            self.nextLine = jumps[i] + 1
+
+        elif (keyword == "call"):
+            args = [self.eval_expression(value) for value in values]
+            saved = dict((key, self.variables.pop(key)) for key in LOCAL_VARIABLES if key in self.variables)
+            self.callStack.append((i + 1, saved))
+            for (n, value) in enumerate(args):
+                self.variables["#%d" % (n + 1)] = value
+            self.nextLine = jumps[i] + 1
+
+        elif (keyword in ("endsub", "return")):
+            if (not self.callStack):
+                return
+            (returnLine, saved) = self.callStack.pop()
+            for key in LOCAL_VARIABLES:
+                self.variables.pop(key, None)
+            self.variables.update(saved)
+            self.nextLine = returnLine
+
+        elif (keyword == "while"):
+            condition = self.eval_expression(" ".join(values))
+            if (jumps[i] < i):
+                # The end of a do-while loop
+                if (condition):
+                    self.nextLine = jumps[i] + 1
+            elif (not condition):
+                self.nextLine = jumps[i] + 1
+
+        elif (keyword == "endwhile"):
+            self.nextLine = jumps[i]
+
+        elif (keyword == "repeat"):
+            count = int(self.eval_expression(" ".join(values)))
+            if (count > 0):
+                self.repeatCounts[i] = count
+            else:
+                self.nextLine = jumps[i] + 1
+
+        elif (keyword == "endrepeat"):
+            start = jumps[i]
+            self.repeatCounts[start] = self.repeatCounts.get(start, 1) - 1
+            if (self.repeatCounts[start] > 0):
+                self.nextLine = start + 1
+            else:
+                del self.repeatCounts[start]
+
+        elif (keyword in ("if", "elseif", "else")):
+            if (keyword != "if" and not jumped):
+                # The branch before this one ran, skip to the endif
+                self.nextLine = self.program.ends[i] + 1
+            elif (keyword != "else" and not self.eval_expression(" ".join(values))):
+                following = jumps[i]
+                if (following == self.program.ends[i]):
+                    self.nextLine = following + 1
+                else:
+                    self.nextLine = following
+                    self.branchJump = following
+
+        elif (keyword in ("break", "continue")):
+            start = jumps[i]
+            if (keyword == "break"):
+                self.repeatCounts.pop(start, None)
+                self.nextLine = jumps[start] + 1
+            elif (self.program.statements[start].args[1] == "while"):
+                self.nextLine = start
+            else:
+                # The do-while condition or the endrepeat
+                self.nextLine = jumps[start]
+
+        elif (keyword not in ("", "do", "endif")):
+            print("Unknown code: O %s" % keyword)
+            if (not "O " + keyword in self.unknownCodes):
+                self.unknownCodes.append("O " + keyword)
+
+    # Save the state before the next step. Not within a cutter compensation
+    # block, whose paths are still changed when it ends.
+    def checkpoint(self):
+        if (self.compBlock is not None):
+            return None
+        checkpoint = Checkpoint()
+        checkpoint.steps = len(self.trace)
+        checkpoint.paths = len(self.paths)
+        checkpoint.lastLine = self.lastLine
+        if (self.trace and self.lineno != self.trace[-1] + 1):
+            # Jumped to with the block structure of this version
+            checkpoint.lastLine = max(self.lastLine, self.lineno)
+        checkpoint.values = copy.deepcopy(dict((key, value) for (key, value) in self.__dict__.items()
+                                               if key not in CHECKPOINT_SKIP))
+        self.checkpoints.append(checkpoint)
+        return checkpoint
+
+    # Go back to a checkpoint, dropping everything done after it
+    def restore(self, checkpoint):
+        kept = dict((key, self.__dict__[key]) for key in CHECKPOINT_SKIP if key in self.__dict__)
+        self.__dict__.clear()
+        self.__dict__.update(copy.deepcopy(checkpoint.values))
+        self.__dict__.update(kept)
+        self.paths = dict(itertools.islice(self.paths.items(), checkpoint.paths))
+        del self.trace[checkpoint.steps:]
+        self.visits = {}
+        for lineno in self.trace:
+            self.visits[lineno] = self.visits.get(lineno, 0) + 1
+        self.stepPaths = []
+        self.checkpoints = [c for c in self.checkpoints if c.steps <= checkpoint.steps]
+
+    # Switch to a new version of the program. The state goes back to the
+    # last checkpoint before it ran any changed statement, the paths up to
+    # there are kept. Returns how many, or None when nothing changed.
+    def reload(self, program):
+        change = first_change(self.program, program)
+        self.program = program
+        if (change is None):
+            return None
+        checkpoint = None
+        for candidate in self.checkpoints:
+            if (candidate.lastLine < change):
+                checkpoint = candidate
+            else:
+                break
+        if (checkpoint is None):
+            # Nothing has run yet
+            return 0
+        self.restore(checkpoint)
+        return checkpoint.paths
 
     def step(self):
         # Execute the current statement
         try:
             st = self.program.statements[self.lineno]
         except IndexError:
-            self.finished = True
+            self.finished = not self.streaming
             return False
+        if (not self.checkpoints or len(self.trace) - self.checkpoints[-1].steps >= CHECKPOINT_INTERVAL):
+            self.checkpoint()
+        self.stepPaths = []
+        self.nextLine = None
         self.handle_statement(st)
-
-        # Increment to the next statement
-        self.lineno += 1
+        self.visits[self.lineno] = self.visits.get(self.lineno, 0) + 1
+        self.trace.append(self.lineno)
+        self.lastLine = max(self.lastLine, self.lineno)
+        if (self.finished):
+            self.flush_compensation()
+
+        # Continue with the next statement, or where a jump goes
+        if (self.nextLine is None):
+            self.lineno += 1
+        else:
+            self.lineno = self.nextLine
         # Check if the program is finished
-        if (self.lineno >= len(self.program.statements)):
+        if (self.lineno >= len(self.program.statements) and not self.streaming):
             self.finished = True
+            self.flush_compensation()
 
         if (self.pos is None):
             return
@@ -595,12 +1663,20 @@ class State(object):
         else:
             self.minPos[0] = min(self.pos[0], self.minPos[0])
             self.minPos[1] = min(self.pos[1], self.minPos[1])
+            self.minPos[2] = min(self.pos[2], self.minPos[2])
         # Update the max position too
         if (self.maxPos is None):
             self.maxPos = self.pos.copy()
         else:
             self.maxPos[0] = max(self.pos[0], self.maxPos[0])
             self.maxPos[1] = max(self.pos[1], self.maxPos[1])
+            self.maxPos[2] = max(self.pos[2], self.maxPos[2])
+
+    # Runs the program to the end
+    def run(self):
+        while not self.finished:
+            self.step()
+        return self
 
 
 def dump_parse():
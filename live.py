@@ -0,0 +1,334 @@
+# Live machine mirroring from a streaming G-code sender
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import collections
+import os
+import re
+import threading
+from time import perf_counter
+
+import gcode
+
+###########
+# Globals #
+###########
+
+# Lines received but not run yet. Reading stops while this many wait, which
+# holds the sender back through the socket and the acknowledgements.
+MAX_PENDING = 5000
+
+# Seconds between the checks of a full queue
+POLL_INTERVAL = 0.005
+
+# Seconds to wait for the server to start listening
+START_TIMEOUT = 5.0
+
+DEFAULT_ADDRESS = "tcp:127.0.0.1:5007"
+
+# The reply to every line, as with a controller streamed line by line
+ACK = b"ok\n"
+
+# Status reports, eg. "<Run|MPos:1.000,2.000,3.000|FS:500,0>"
+STATUS_REPORT = re.compile(r"^<([^|>]*)((?:\|[^>]*)?)>$")
+
+#############
+# Functions #
+#############
+
+# The machine state and the fields of a status report, the numeric fields as
+# tuples of floats. None when the line is not one.
+def parse_status(line):
+    match = STATUS_REPORT.match(line.strip())
+    if (match is None):
+        return None
+    fields = {}
+    for field in match.group(2).split("|")[1:]:
+        (name, colon, value) = field.partition(":")
+        try:
+            fields[name] = tuple(float(v) for v in value.split(","))
+        except ValueError:
+            fields[name] = value
+    return (match.group(1), fields)
+
+# The kind and the parts of an address: "tcp:host:port", "unix:path" or
+# "pty" (the device is made up by the server)
+def parse_address(address):
+    (kind, colon, rest) = address.partition(":")
+    if (kind == "tcp"):
+        (host, colon, port) = rest.rpartition(":")
+        return (kind, host or "127.0.0.1", int(port))
+    if (kind in ("unix", "pty")):
+        # Neither is there on Windows
+        if (kind == "unix" and not hasattr(asyncio, "start_unix_server") or
+                kind == "pty" and not hasattr(os, "openpty")):
+            raise ValueError("%s addresses are not supported here" % kind)
+        return (kind, rest)
+    raise ValueError("unknown address: %s" % address)
+
+# Stream the lines of a file to a server one at a time, waiting for every
+# acknowledgement. As a stand-in for a real sender it runs the program
+# itself and reports where the machine is after every move, at the given
+# speed relative to the programmed feed rates (0 for as fast as it goes).
+async def send_file(path, address, speed=0.0):
+    address = parse_address(address)
+    if (address[0] == "pty"):
+        # Only imported here, tty needs termios which Windows does not have
+        import tty
+        device = os.open(address[1], os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(device)
+        reader = asyncio.StreamReader()
+        (transport, protocol) = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(device, "rb", 0))
+        # Lines are short, the terminal takes them without blocking
+        async def send(data):
+            os.write(device, data)
+        close = transport.close
+    else:
+        if (address[0] == "tcp"):
+            (reader, writer) = await asyncio.open_connection(address[1], address[2])
+        else:
+            (reader, writer) = await asyncio.open_unix_connection(address[1])
+        async def send(data):
+            writer.write(data)
+            await writer.drain()
+        close = writer.close
+
+    with open(path, "r") as fd:
+        lines = [line.rstrip("\r\n") for line in fd]
+    state = gcode.parse_lines(lines).start()
+    state.scale = 1
+    sent = 0
+    for (lineno, line) in enumerate(lines):
+        await send(line.encode() + b"\n")
+        await reader.readline()
+        sent += 1
+        # Run the statements up to here for the report
+        time = state.time
+        while (not state.finished and state.lineno <= lineno):
+            state.step()
+        if (state.time > time):
+            if (speed > 0):
+                await asyncio.sleep((state.time - time)/speed)
+            report = "<Run|MPos:%.3f,%.3f,%.3f>" % tuple(state.pos)
+            await send(report.encode() + b"\n")
+    close()
+    return sent
+
+###########
+# Classes #
+###########
+
+# The lines and the latest status report received, handed from the server
+# thread to the main thread. Only the last status counts, so reports never
+# queue up.
+class LiveFeed(object):
+    maxPending = MAX_PENDING
+    lines = None
+    status = None
+    # Lines received in all
+    received = 0
+    lock = None
+
+    def __init__(self, maxPending=MAX_PENDING):
+        self.maxPending = maxPending
+        self.lines = collections.deque()
+        self.lock = threading.Lock()
+
+    def full(self):
+        return len(self.lines) >= self.maxPending
+
+    def put(self, line):
+        with self.lock:
+            self.lines.append(line)
+            self.received += 1
+
+    def set_status(self, status):
+        with self.lock:
+            self.status = status
+
+    # Up to limit of the waiting lines, oldest first
+    def take(self, limit):
+        with self.lock:
+            count = min(limit, len(self.lines))
+            return [self.lines.popleft() for i in range(count)]
+
+# Listens for a sender on a TCP socket, a Unix socket or a pty, on an
+# asyncio loop of its own thread. Every line is acknowledged once it is
+# queued in the feed, and nothing is read while the feed is full.
+class LiveServer(object):
+    feed = None
+    address = None
+    loop = None
+    thread = None
+    server = None
+    # The device a sender opens with a pty server
+    ptyName = None
+    # The slave end of the pty, kept open so it lives between senders
+    slave = None
+    receiver = None
+    # Senders connected now
+    clients = 0
+    error = None
+
+    def __init__(self, feed, address=DEFAULT_ADDRESS):
+        self.feed = feed
+        self.address = address
+
+    def start(self):
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait(START_TIMEOUT)
+        if (self.error is not None):
+            raise self.error
+
+    def stop(self):
+        if (self.loop is None):
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._listen())
+        except Exception as error:
+            self.error = error
+            started.set()
+            return
+        started.set()
+        self.loop.run_forever()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        if (self.server is not None):
+            self.server.close()
+        if (self.slave is not None):
+            os.close(self.slave)
+        self.loop.close()
+
+    async def _listen(self):
+        address = parse_address(self.address)
+        if (address[0] == "tcp"):
+            self.server = await asyncio.start_server(self._connected, address[1], address[2])
+        elif (address[0] == "unix"):
+            if (os.path.exists(address[1])):
+                os.unlink(address[1])
+            self.server = await asyncio.start_unix_server(self._connected, address[1])
+        else:
+            import tty
+            (master, slave) = os.openpty()
+            tty.setraw(slave)
+            self.ptyName = os.ttyname(slave)
+            reader = asyncio.StreamReader()
+            await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(master, "rb", 0))
+            self.slave = slave
+            # The loop only keeps a weak reference to the task
+            self.receiver = self.loop.create_task(self._receive(reader, lambda: os.write(master, ACK)))
+
+    async def _connected(self, reader, writer):
+        self.clients += 1
+        try:
+            await self._receive(reader, lambda: writer.write(ACK))
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _receive(self, reader, ack):
+        while True:
+            while (self.feed.full()):
+                await asyncio.sleep(POLL_INTERVAL)
+            data = await reader.readline()
+            if (not data):
+                return
+            line = data.decode(errors="replace").rstrip("\r\n")
+            status = parse_status(line)
+            if (status is not None):
+                self.feed.set_status(status)
+                continue
+            self.feed.put(line)
+            ack()
+
+# Runs the lines of a feed as they come, on a program that grows with them.
+# Every drain parses a batch, steps the state as far as the time allows and
+# returns the paths of the steps.
+class LiveMirror(object):
+    feed = None
+    program = None
+    state = None
+
+    def __init__(self, feed, scale=1):
+        self.feed = feed
+        self.program = gcode.Program()
+        self.state = self.program.start()
+        self.state.scale = scale
+        self.state.streaming = True
+
+    # Statements received but not run yet
+    def pending(self):
+        return len(self.program.statements) - self.state.lineno
+
+    def drain(self, limit=MAX_PENDING, budget=0.01):
+        start = perf_counter()
+        # New lines only once the state caught up with the last batch
+        if (self.pending() < limit):
+            lines = self.feed.take(limit - self.pending())
+            if (lines):
+                gcode.parse_lines(lines, self.program)
+        paths = []
+        while (self.pending() > 0 and not self.state.finished):
+            self.state.step()
+            paths.extend(self.state.stepPaths)
+            if (perf_counter() - start > budget):
+                break
+        return paths
+
+    # Where the sender last reported the machine, in machine coordinates
+    # (mm), None without a report
+    def machine_position(self):
+        status = self.feed.status
+        if (status is None):
+            return None
+        fields = status[1]
+        if ("MPos" in fields):
+            return fields["MPos"][:3]
+        if ("WPos" in fields):
+            return tuple(fields["WPos"][i] + self.state.origin[i] for i in range(3))
+        return None
+
+    # The sender is done, the rest of the program is run as a whole
+    def close(self):
+        self.state.streaming = False
+        while not self.state.finished:
+            self.state.step()
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 3:
+        print('Usage: live.py <G-code file> <tcp:host:port | unix:path | pty:device> [speed]')
+        sys.exit(1)
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    print("Sent %d lines" % asyncio.run(send_file(sys.argv[1], sys.argv[2], speed)))
@@ -0,0 +1,132 @@
+# Level of detail toolpath display
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# Number of levels kept, and how much coarser every level is than the last
+LEVELS = 8
+LEVEL_FACTOR = 4.0
+
+# Levels with fewer points than this are not simplified any further
+MIN_POINTS = 1000
+
+#############
+# Functions #
+#############
+
+# The (M,2) vertex index pairs of the edges joining consecutive points
+def edges(connect):
+    i = numpy.nonzero(connect)[0]
+    return numpy.stack((i, i + 1), axis=1)
+
+# The whole toolpath of a segment array as one polyline following the arcs
+# within the tolerance. The edge ending on point i+1 belongs to the segment
+# owner[i+1].
+def chain(segs, tolerance):
+    (pts, owner, t) = segs.tessellate(tolerance)
+    # Segments following each other share their joint, drop the start
+    # points repeating the previous end
+    gap = numpy.ones(len(pts))*numpy.inf
+    gap[1:] = numpy.linalg.norm(pts[1:] - pts[:-1], axis=1)
+    keep = (t > 0) | (gap > tolerance*1e-3)
+    (pts, owner, t, gap) = (pts[keep], owner[keep], t[keep], gap[keep])
+
+    level = Level()
+    level.tolerance = tolerance
+    level.points = pts
+    level.owner = owner
+    level.times = segs.startTime[owner] + t*segs.duration[owner]
+    # A segment starting further away than the tolerance does not continue
+    # the previous one
+    level.connect = (t[1:] > 0) | (gap[1:] <= tolerance)
+    return level
+
+###########
+# Classes #
+###########
+
+# One simplified copy of the toolpath: a polyline where connect tells
+# whether point i is joined to point i+1, so rapids between separate
+# paths keep their gaps
+class Level(object):
+    tolerance = 0
+    points = None
+    connect = None
+    # The segment every point comes from and when the tool passes it
+    owner = None
+    times = None
+
+    def __len__(self):
+        return len(self.points)
+
+    # Merge the runs of consecutive points falling in the same grid cell into
+    # their first point. Every point stays within a cell diagonal of the
+    # path, and the points on both sides of a gap are kept.
+    def coarsen(self, tolerance):
+        key = numpy.floor(self.points/tolerance).astype(numpy.int64)
+        first = numpy.ones(len(key), dtype=bool)
+        first[1:] = numpy.any(key[1:] != key[:-1], axis=1) | ~self.connect
+        last = numpy.ones(len(key), dtype=bool)
+        last[:-1] = ~self.connect
+        idx = numpy.nonzero(first | last)[0]
+
+        level = Level()
+        level.tolerance = tolerance
+        level.points = self.points[idx]
+        level.owner = self.owner[idx]
+        level.times = self.times[idx]
+        # Only neighbours in the old level can be apart
+        level.connect = numpy.where(idx[1:] == idx[:-1] + 1, self.connect[idx[:-1]], True)
+        return level
+
+# A stack of ever coarser copies of the toolpath of a segment array. Level 0
+# follows the arcs within the tolerance, every following level is built
+# from the one before with LEVEL_FACTOR times its tolerance.
+class ToolpathLOD(object):
+    segments = None
+    levels = None
+
+    def __init__(self, segs, tolerance=0.01, levels=LEVELS):
+        self.segments = segs
+        self.levels = [chain(segs, tolerance)]
+        while len(self.levels) < levels and len(self.levels[-1]) > MIN_POINTS:
+            self.levels.append(self.levels[-1].coarsen(self.levels[-1].tolerance*LEVEL_FACTOR))
+
+    # The coarsest level still showing details of the given size, eg. the
+    # width of a pixel
+    def level_for(self, size):
+        level = 0
+        for (i, candidate) in enumerate(self.levels):
+            if (candidate.tolerance <= size):
+                level = i
+        return level
+
+    # The full detail points passed between the times t0 and t1 as (points,
+    # connect), starting from the point before so the window joins up
+    def window(self, t0, t1):
+        base = self.levels[0]
+        first = max(numpy.searchsorted(base.times, t0) - 1, 0)
+        last = numpy.searchsorted(base.times, t1, side="right")
+        return (base.points[first:last], base.connect[first:max(last - 1, first)])
@@ -0,0 +1,212 @@
+# Several machines simulated side by side
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import concurrent.futures
+import os
+from time import perf_counter
+
+import numpy
+
+import gcode
+import segments
+
+###########
+# Globals #
+###########
+
+# Workers simulating the programs, leaving a core to the UI
+WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+# Chord tolerance (mm) of the arcs handed out for drawing
+TOLERANCE = 0.01
+
+#############
+# Functions #
+#############
+
+# Parse and run a program on a state of its own. This runs in the workers,
+# so it only takes and returns plain values: the segment arrays in mm, the
+# length of the job in seconds and the codes not understood.
+def simulate(path):
+    prog = gcode.parse_program(path)
+    state = prog.start()
+    state.scale = 1
+    state.run()
+    return (segments.from_state(state).arrays(), state.time, state.unknownCodes)
+
+###########
+# Classes #
+###########
+
+# One machine or spindle running its own program, with its own program zero
+# in the scene and the object following its tool. The program is simulated
+# as a whole by a worker, and played from the segment arrays after that.
+class Machine(object):
+    name = ""
+    filename = None
+    # Where the program zero is in the scene, and the name of the object
+    # following the tool
+    offset = (0.0, 0.0, 0.0)
+    target = None
+    # Machine seconds per scene second
+    speed = 1.0
+    # The simulated program, when the worker is done
+    segments = None
+    ends = None
+    duration = 0
+    unknownCodes = None
+    error = None
+    future = None
+    # The machine time played up to and the segments handed out until then
+    time = 0
+    drawn = 0
+
+    def __init__(self, name, filename, offset=(0.0, 0.0, 0.0), target=None, speed=1.0):
+        self.name = name
+        self.filename = filename
+        self.offset = tuple(offset)
+        self.target = target
+        self.speed = speed
+
+    # Take the result of the worker once it is there. Returns whether the
+    # program is ready to play.
+    def collect(self):
+        if (self.segments is not None):
+            return True
+        if (self.future is None or not self.future.done()):
+            return False
+        try:
+            (arrays, duration, unknownCodes) = self.future.result()
+        except Exception as error:
+            self.error = error
+            return False
+        finally:
+            self.future = None
+        self.segments = segments.from_arrays(arrays)
+        self.ends = self.segments.startTime + self.segments.duration
+        self.duration = duration
+        self.unknownCodes = unknownCodes
+        return True
+
+    def done(self):
+        return self.error is not None or (self.segments is not None and self.time >= self.duration)
+
+    # Where the tool is at the time played up to, in mm. The tool waits at
+    # the end of a move through the dwells and tool changes after it.
+    def position(self):
+        segs = self.segments
+        if (not len(segs)):
+            return None
+        i = min(numpy.searchsorted(self.ends, self.time, side="right"), len(segs) - 1)
+        t = 1.0
+        if (segs.duration[i] > 0):
+            t = min(max((self.time - segs.startTime[i])/segs.duration[i], 0.0), 1.0)
+        if (segs.kind[i] == segments.ARC):
+            return segs.arc_points([i], [t])[0]
+        return segs.start[i] + (segs.end[i] - segs.start[i])*t
+
+    # Play the machine time on by dt wall seconds. Returns the points (mm)
+    # of the moves finished since the last call and where the tool is now.
+    def advance(self, dt, tolerance=TOLERANCE):
+        self.time = min(self.time + dt*self.speed, self.duration)
+        # The job time is summed up in another order than the ends, the
+        # last ones may be a rounding error past it
+        last = numpy.searchsorted(self.ends, self.time, side="right")
+        if (self.time >= self.duration):
+            last = len(self.segments)
+        points = numpy.zeros((0, 3))
+        if (last > self.drawn):
+            (points, owner, t) = self.segments.tessellate(tolerance, numpy.arange(self.drawn, last))
+            self.drawn = last
+        return (points, self.position())
+
+    # Back to the start of the program
+    def rewind(self):
+        self.time = 0
+        self.drawn = 0
+
+# Plays many machines from one timer. The programs are simulated on a pool
+# of workers, threads or processes, and the playing only starts once all of
+# them are ready so the jobs run side by side as they would in the shop.
+# Every tick then moves all the machines on by the same wall time; the work
+# per machine is a binary search and the points of the moves it finished.
+class MachineScheduler(object):
+    machines = None
+    pool = None
+    lastTick = None
+    clock = None
+
+    def __init__(self, workers=WORKERS, processes=False, clock=perf_counter):
+        self.machines = collections.OrderedDict()
+        if (processes):
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.clock = clock
+
+    # Machines are known by name, a second one of a name is refused
+    def add(self, machine):
+        if (machine.name in self.machines):
+            raise ValueError("machine name used twice: %s" % machine.name)
+        machine.future = self.pool.submit(simulate, machine.filename)
+        self.machines[machine.name] = machine
+
+    def remove(self, name):
+        machine = self.machines.pop(name, None)
+        if (machine is not None and machine.future is not None):
+            machine.future.cancel()
+        return machine
+
+    # Start counting the wall time, eg. after a pause
+    def start(self):
+        self.lastTick = self.clock()
+
+    # Whether every program is simulated
+    def ready(self):
+        # Every machine collects its result, not just the first missing one
+        return all([machine.collect() or machine.error is not None for machine in self.machines.values()])
+
+    def done(self):
+        return all(machine.done() for machine in self.machines.values())
+
+    # Move every machine on by the wall time since the last tick, calling
+    # draw(machine, points, position) for the ones still running
+    def tick(self, draw):
+        now = self.clock()
+        if (self.lastTick is None or not self.ready()):
+            self.lastTick = now
+            return
+        dt = now - self.lastTick
+        self.lastTick = now
+        for machine in self.machines.values():
+            if (machine.error is not None or machine.time >= machine.duration):
+                continue
+            (points, position) = machine.advance(dt)
+            draw(machine, points, position)
+
+    # Stop the workers, the programs still waiting are not simulated.
+    # Cancelled here as shutdown() only does it from Python 3.9.
+    def shutdown(self):
+        for machine in self.machines.values():
+            if (machine.future is not None):
+                machine.future.cancel()
+        self.pool.shutdown(wait=isinstance(self.pool, concurrent.futures.ProcessPoolExecutor))
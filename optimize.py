@@ -0,0 +1,433 @@
+# Rapid move ordering optimizer
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+from time import perf_counter
+
+import numpy
+
+import gcode
+import spatial
+import writer
+
+###########
+# Globals #
+###########
+
+# What a statement does as far as the ordering goes
+RAPID = 0
+FEED = 1
+OTHER = 2
+BARRIER = 3
+
+# Codes changing the machine or the meaning of the coordinates. Chains are
+# only reordered between them.
+BARRIER_CODES = set((
+    "M00", "M01", "M02", "M03", "M04", "M05", "M06", "M30",
+    "G10", "G17", "G18", "G19", "G20", "G21", "G28", "G30",
+    "G40", "G41", "G42", "G41.1", "G42.1", "G43", "G49", "G53", "G80",
+    "G90", "G91", "G90.1", "G91.1", "G92", "G92.1", "G92.2", "G92.3",
+    "G98", "G99", "O", "=",
+)) | set(gcode.COORDINATE_SYSTEMS) | set(gcode.CANNED_CYCLES)
+
+# Decimals of the coordinates written
+PRECISION = writer.PRECISION
+
+#############
+# Functions #
+#############
+
+# The words of a parsed statement again, with the motion mode spelt out so
+# it does not depend on the line before it
+def format_statement(st):
+    words = list(st.modes) + [st.code] + [key + value for (key, value) in st.params.items()]
+    if (st.comment):
+        words.append(st.comment)
+    return " ".join(word for word in words if word)
+
+# Run the program and classify every statement. Returns the program, the
+# state and per statement (kind, start, end, paths) lists, positions in mm.
+def classify(path):
+    prog = gcode.parse_program(path)
+    state = prog.start()
+    state.scale = 1
+    n = len(prog.statements)
+    kinds = [BARRIER]*n
+    starts = [None]*n
+    ends = [None]*n
+    paths = [None]*n
+    context = [None]*n
+    while not state.finished:
+        lineno = state.lineno
+        start = state.pos.copy()
+        state.step()
+        if (lineno >= n or state.visits.get(lineno, 0) > 1):
+            # Run again by a loop or a call
+            if (lineno < n):
+                kinds[lineno] = BARRIER
+            continue
+        st = prog.statements[lineno]
+        records = state.stepPaths
+        moves = [p for p in records if isinstance(p, (gcode.Line, gcode.Arc))]
+        if ((set(st.modes) | set((st.code,))) & BARRIER_CODES or st.code.startswith("T")
+            or len(moves) != len(records) or len(moves) > 1 or state.distanceMode != "absolute"):
+            kinds[lineno] = BARRIER
+        elif (not moves):
+            kinds[lineno] = OTHER
+        elif (getattr(moves[0], "rapid", False)):
+            kinds[lineno] = RAPID
+        else:
+            kinds[lineno] = FEED
+        starts[lineno] = numpy.array(start)
+        ends[lineno] = numpy.array(state.pos)
+        paths[lineno] = moves
+        context[lineno] = (list(state.origin), state.unitScale, state.feedRate, state.rapidSpeed,
+                           state.arcDistanceMode)
+    return (prog, state, kinds, starts, ends, paths, context)
+
+# The travel from the end of one chain to the start of the next over the
+# clearance height, as the XY distances between every exit and entry
+def _distance(a, b):
+    return numpy.linalg.norm(a[..., :2] - b[..., :2], axis=-1)
+
+# Visit the chains nearest first from the start point. With reverse, a
+# chain may be entered from either end. Returns the order and whether each
+# chain is run backwards.
+def nearest_neighbour(start, entries, exits, reverse=False):
+    n = len(entries)
+    points = numpy.concatenate((entries, exits)) if reverse else entries
+    items = numpy.arange(len(points))
+    visited = numpy.zeros(n, dtype=bool)
+    order = []
+    flipped = []
+    current = numpy.asarray(start, dtype=float)
+    tree = None
+    while (len(order) < n):
+        if (tree is None):
+            # Built again on what is left once most of it is visited
+            items = items[~visited[items % n]]
+            flat = points[items].copy()
+            flat[:, 2] = 0
+            tree = spatial.BoxTree(flat, flat)
+        k = 1
+        while True:
+            candidates = items[tree.query_nearest_candidates((current[0], current[1], 0.0), k)]
+            candidates = candidates[~visited[candidates % n]]
+            if (len(candidates) or k >= len(items)):
+                break
+            k *= 4
+        best = candidates[numpy.argmin(_distance(points[candidates], current))]
+        chain = best % n
+        visited[chain] = True
+        order.append(chain)
+        flipped.append(best >= n)
+        current = entries[chain] if best >= n else exits[chain]
+        if (visited[items % n].sum()*2 > len(items)):
+            tree = None
+    return (numpy.array(order, dtype=numpy.int64), numpy.array(flipped, dtype=bool))
+
+# The entry and exit points of the chains in tour order
+def _ends(order, flipped, entries, exits):
+    e = numpy.where(flipped[:, None], exits[order], entries[order])
+    x = numpy.where(flipped[:, None], entries[order], exits[order])
+    return (e, x)
+
+# Improve a tour of reversible chains by reversing stretches of it, each
+# chain in the stretch turning around with it, until nothing improves or
+# the time is up. The distances between all the positions after i are
+# tried in one go.
+def two_opt(start, order, flipped, entries, exits, deadline):
+    improved = True
+    while (improved and perf_counter() < deadline):
+        improved = False
+        for i in range(len(order) - 1):
+            if (perf_counter() >= deadline):
+                break
+            (e, x) = _ends(order, flipped, entries, exits)
+            before = x[i - 1] if i else numpy.asarray(start, dtype=float)
+            j = numpy.arange(i + 1, len(order))
+            after = numpy.zeros(len(j))
+            gain = numpy.zeros(len(j))
+            inner = (j + 1 < len(order))
+            after[inner] = _distance(x[j[inner]], e[j[inner] + 1])
+            gain[inner] = _distance(e[i], e[j[inner] + 1])
+            delta = _distance(before, x[j]) + gain - _distance(before, e[i]) - after
+            best = numpy.argmin(delta)
+            if (delta[best] < -1e-9):
+                k = j[best]
+                order[i:k + 1] = order[i:k + 1][::-1].copy()
+                flipped[i:k + 1] = ~flipped[i:k + 1][::-1]
+                improved = True
+    return (order, flipped)
+
+# Improve a tour of chains that keep their direction by moving single
+# chains to where they fit best, until nothing improves or the time is up
+def or_opt(start, order, entries, exits, deadline):
+    start = numpy.asarray(start, dtype=float)
+    improved = True
+    while (improved and perf_counter() < deadline):
+        improved = False
+        for chain in list(order):
+            if (perf_counter() >= deadline):
+                break
+            i = int(numpy.nonzero(order == chain)[0][0])
+            e = entries[order]
+            x = exits[order]
+            before = x[i - 1] if i else start
+            removed = _distance(before, e[i])
+            if (i + 1 < len(order)):
+                removed += _distance(x[i], e[i + 1]) - _distance(before, e[i + 1])
+            rest = numpy.delete(order, i)
+            (e, x) = (entries[rest], exits[rest])
+            # Inserted in front of position k of the rest, or at the end
+            prev = numpy.concatenate(([start], x))
+            cost = _distance(prev, entries[chain])
+            cost[:-1] += _distance(exits[chain], e) - _distance(prev[:-1], e)
+            k = int(numpy.argmin(cost))
+            if (cost[k] < removed - 1e-9):
+                order = numpy.insert(rest, k, chain)
+                improved = True
+    return order
+
+###########
+# Classes #
+###########
+
+# A run of cutting moves with the statements between them, moved as one
+class Chain(object):
+    statements = None
+    # Tool position before and after it, in mm
+    entry = None
+    exit = None
+    # The moves of the statements, for running it backwards
+    moves = None
+    reversible = False
+    # Programmed feed rate (mm/s) when it starts
+    feedRate = 0
+
+# The program with its rapids reordered
+class Optimization(object):
+    lines = None
+    chains = 0
+    # Rapid travel in mm, and its time in seconds, before and after
+    rapidBefore = 0
+    rapidAfter = 0
+    timeBefore = 0
+    timeAfter = 0
+
+    def saved(self):
+        return self.timeBefore - self.timeAfter
+
+    # Write the program, with compact through the writer dropping the
+    # redundant words
+    def write(self, path, compact=False, precision=PRECISION):
+        if (compact):
+            writer.write_program(gcode.parse_lines(self.lines), path, precision)
+            return
+        with open(path, "w") as fd:
+            fd.write("\n".join(self.lines) + "\n")
+
+    def __repr__(self):
+        template = '{0.__class__.__name__}({0.chains} chains, rapids {1:.1f} -> {2:.1f} mm, {3:.1f} s saved)'
+        return template.format(self, self.rapidBefore, self.rapidAfter, self.saved())
+
+# Splits a program into the chains of cutting moves between its rapids and
+# visits them in a shorter order: nearest neighbour on a spatial index of
+# the chain ends, then 2-opt when chains may run backwards and or-opt when
+# they may not, within the time limit. The rapids between the chains are
+# written again over the highest rapid height of their stretch.
+class RapidOptimizer(object):
+    reverse = False
+    timeLimit = 2.0
+    precision = PRECISION
+
+    def __init__(self, reverse=False, timeLimit=2.0, precision=PRECISION):
+        self.reverse = reverse
+        self.timeLimit = timeLimit
+        self.precision = precision
+
+    def optimize(self, path):
+        deadline = perf_counter() + self.timeLimit
+        (prog, state, kinds, starts, ends, paths, context) = classify(path)
+        result = Optimization()
+        result.lines = []
+        n = len(prog.statements)
+        i = 0
+        while (i < n):
+            if (kinds[i] == BARRIER):
+                result.lines.append(prog.statements[i].command.strip())
+                i += 1
+                continue
+            j = i
+            while (j < n and kinds[j] != BARRIER):
+                j += 1
+            result.lines.extend(self.stretch(prog, kinds, starts, ends, paths, context, i, j, result, deadline))
+            i = j
+        return result
+
+    # The lines of the statements i..j-1, which hold no barrier
+    def stretch(self, prog, kinds, starts, ends, paths, context, i, j, result, deadline):
+        original = [prog.statements[k].command.strip() for k in range(i, j)]
+        rapids = [k for k in range(i, j) if kinds[k] == RAPID]
+        rapidLength = sum(numpy.linalg.norm(ends[k] - starts[k]) for k in rapids)
+        rapidSpeed = context[i][3]
+        result.rapidBefore += rapidLength
+        result.timeBefore += rapidLength/rapidSpeed
+
+        # Cut it up in chains, statements other than moves going with the
+        # chain after them
+        chains = []
+        pending = []
+        current = None
+        last = i
+        for k in range(i, j):
+            if (kinds[k] == RAPID):
+                current = None
+            elif (kinds[k] == FEED):
+                if (current is None):
+                    current = Chain()
+                    current.statements = pending
+                    current.entry = starts[k]
+                    current.moves = []
+                    current.feedRate = context[k][2]
+                    chains.append(current)
+                    pending = []
+                current.statements.append(k)
+                current.moves.extend(paths[k])
+                current.exit = ends[k]
+                last = k + 1
+            elif (current is not None):
+                current.statements.append(k)
+            else:
+                pending.append(k)
+        if (len(chains) < 2):
+            result.rapidAfter += rapidLength
+            result.timeAfter += rapidLength/rapidSpeed
+            return original
+
+        start = starts[i]
+        clearance = max([start[2]] + [ends[k][2] for k in rapids])
+        entries = numpy.array([c.entry for c in chains])
+        exits = numpy.array([c.exit for c in chains])
+        for chain in chains:
+            chain.reversible = self.reverse and all(
+                isinstance(m, gcode.Line) or m.plane == "XY" for m in chain.moves) and all(
+                kinds[k] == FEED for k in chain.statements) and abs(chain.entry[2] - chain.exit[2]) < 1e-6
+        reverse = self.reverse and all(c.reversible for c in chains)
+        (order, flipped) = nearest_neighbour(start, entries, exits, reverse)
+        if (reverse):
+            (order, flipped) = two_opt(start, order, flipped, entries, exits, deadline)
+        else:
+            order = or_opt(start, order, entries, exits, deadline)
+
+        (origin, unitScale) = context[i][:2]
+        lines = []
+        travel = 0
+        position = start
+        for (chain, backwards) in zip(order, flipped):
+            chain = chains[chain]
+            entry = chain.exit if backwards else chain.entry
+            (moves, length) = self.travel(position, entry, clearance, origin, unitScale)
+            lines.extend(moves)
+            travel += length
+            if (backwards):
+                lines.extend(self.backwards(chain, origin, unitScale, context[i][4]))
+            else:
+                # The feed rate in effect may have been set before the chain
+                first = [k for k in chain.statements if kinds[k] == FEED][0]
+                if ("F" not in prog.statements[first].params):
+                    lines.append("F" + writer.format_number(chain.feedRate*60/unitScale, self.precision))
+                lines.extend(format_statement(prog.statements[k]) for k in chain.statements)
+            position = chain.entry if backwards else chain.exit
+        # What followed the last chain stays, after going up clear unless it
+        # goes straight up clear itself
+        if (last < j):
+            after = [k for k in range(last, j) if kinds[k] == RAPID]
+            retracts = (after and ends[after[0]][2] >= clearance - 1e-9 and
+                        not set("XY") & set(prog.statements[after[0]].params))
+            if (position[2] < clearance and not retracts):
+                lines.append("G00 Z" + writer.format_number((clearance - origin[2])/unitScale, self.precision))
+                travel += clearance - position[2]
+                position = numpy.array((position[0], position[1], clearance))
+            for k in range(last, j):
+                lines.append(format_statement(prog.statements[k]))
+                if (kinds[k] == RAPID):
+                    # The axes it does not name stay where the new order
+                    # left the tool
+                    end = numpy.array([ends[k][axis] if "XYZ"[axis] in prog.statements[k].params else position[axis]
+                                       for axis in range(3)])
+                    travel += numpy.linalg.norm(end - position)
+                    position = end
+        # The statements after the stretch expect the tool where it was left
+        # in the program, low ones are taken back there over the clearance
+        if (position[2] < clearance and not numpy.allclose(position, ends[j - 1])):
+            (moves, length) = self.travel(position, ends[j - 1], clearance, origin, unitScale)
+            lines.extend(moves)
+            travel += length
+        if (travel >= rapidLength):
+            result.rapidAfter += rapidLength
+            result.timeAfter += rapidLength/rapidSpeed
+            return original
+        result.chains += len(chains)
+        result.rapidAfter += travel
+        result.timeAfter += travel/rapidSpeed
+        return lines
+
+    # Rapids from the position to the entry of a chain over the clearance
+    # height, and their length
+    def travel(self, position, entry, clearance, origin, unitScale):
+        coord = lambda value, axis : writer.format_number((value - origin[axis])/unitScale, self.precision)
+        height = max(clearance, position[2], entry[2])
+        lines = []
+        length = 0
+        if (position[2] < height):
+            lines.append("G00 Z" + coord(height, 2))
+            length += height - position[2]
+        lines.append("G00 X%s Y%s" % (coord(entry[0], 0), coord(entry[1], 1)))
+        length += numpy.linalg.norm(entry[:2] - position[:2])
+        if (entry[2] < height):
+            lines.append("G00 Z" + coord(entry[2], 2))
+            length += height - entry[2]
+        return (lines, length)
+
+    # The moves of a chain from its end back to its start. The arc centres
+    # are written as the arc distance mode in effect reads them.
+    def backwards(self, chain, origin, unitScale, arcDistanceMode="incremental"):
+        coord = lambda value, axis : writer.format_number((value - origin[axis])/unitScale, self.precision)
+        lines = []
+        feedRate = None
+        for move in reversed(chain.moves):
+            (start, end) = (numpy.array(move.end), numpy.array(move.start))
+            words = ["G01"]
+            if (isinstance(move, gcode.Arc)):
+                words = ["G03" if move.clockwise else "G02"]
+            words += ["X" + coord(end[0], 0), "Y" + coord(end[1], 1), "Z" + coord(end[2], 2)]
+            if (isinstance(move, gcode.Arc)):
+                center = numpy.array(move.center)
+                if (arcDistanceMode == "absolute"):
+                    words += ["I" + coord(center[0], 0), "J" + coord(center[1], 1)]
+                else:
+                    words += ["I" + writer.format_number((center[0] - start[0])/unitScale, self.precision),
+                              "J" + writer.format_number((center[1] - start[1])/unitScale, self.precision)]
+            if (move.feedRate != feedRate):
+                words.append("F" + writer.format_number(move.feedRate*60/unitScale, self.precision))
+                feedRate = move.feedRate
+            lines.append(" ".join(words))
+        return lines
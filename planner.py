@@ -0,0 +1,244 @@
+# Kinematic look-ahead planner for cycle time estimation
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import gcode
+import segments
+
+###########
+# Globals #
+###########
+
+# Bisection steps used to find the peak speed of short jerk limited moves
+JERK_ITERATIONS = 30
+
+#############
+# Functions #
+#############
+
+# Unit tangents of every segment at its start and at its end
+def tangents(segs):
+    chord = segs.end - segs.start
+    norm = numpy.linalg.norm(chord, axis=1)
+    chord /= numpy.where(norm > 0, norm, 1)[:, None]
+    tin = chord.copy()
+    tout = chord.copy()
+
+    idx = numpy.nonzero(segs.kind == segments.ARC)[0]
+    if (len(idx)):
+        rows = numpy.arange(len(idx))
+        for (tangent, t) in ((tin, 0.0), (tout, 1.0)):
+            theta = segs.angle1[idx] + segs.sweep[idx]*t
+            d = numpy.zeros((len(idx), 3))
+            d[rows, segs.normalAxis[idx]] = segs.end[idx, segs.normalAxis[idx]] - segs.start[idx, segs.normalAxis[idx]]
+            d[rows, segs.cosAxis[idx]] = -segs.radius[idx]*numpy.sin(theta)*segs.sweep[idx]
+            d[rows, segs.sinAxis[idx]] = segs.radius[idx]*numpy.cos(theta)*segs.sweep[idx]
+            norm = numpy.linalg.norm(d, axis=1)
+            tangent[idx] = d/numpy.where(norm > 0, norm, 1)[:, None]
+    return (tin, tout)
+
+# The time needed to change speed from v0 to v1 at acceleration a, and with
+# jerk j when given (symmetric S-curve). Returns (time, distance).
+def _ramp(v0, v1, a, j=None):
+    dv = numpy.abs(v1 - v0)
+    if (j is None):
+        t = dv/a
+    else:
+        t = numpy.where(dv >= a*a/j, dv/a + a/j, 2*numpy.sqrt(dv/j))
+    return (t, (v0 + v1)*0.5*t)
+
+# Time to travel length L entering at v0, leaving at v1, never exceeding
+# vmax, at acceleration a and optionally jerk j, all element wise
+def move_times(L, v0, v1, vmax, a, j=None):
+    (ta, da) = _ramp(v0, vmax, a, j)
+    (td, dd) = _ramp(vmax, v1, a, j)
+    cruise = L - da - dd
+    times = ta + td + numpy.maximum(cruise, 0)/numpy.where(vmax > 0, vmax, 1)
+
+    short = (cruise < 0)
+    if (short.any()):
+        (Ls, v0s, v1s, vms, As) = (L[short], v0[short], v1[short], vmax[short], a[short])
+        if (j is None):
+            peak = numpy.sqrt(numpy.maximum((2*As*Ls + v0s*v0s + v1s*v1s)*0.5, 0))
+        else:
+            # No closed form with jerk, bisect on the peak speed
+            low = numpy.maximum(v0s, v1s)
+            high = vms.copy()
+            for _ in range(JERK_ITERATIONS):
+                peak = (low + high)*0.5
+                dist = _ramp(v0s, peak, As, j)[1] + _ramp(peak, v1s, As, j)[1]
+                over = (dist > Ls)
+                high = numpy.where(over, peak, high)
+                low = numpy.where(over, low, peak)
+            peak = low
+        peak = numpy.maximum(peak, numpy.maximum(v0s, v1s))
+        (ta, da) = _ramp(v0s, peak, As, j)
+        (td, dd) = _ramp(peak, v1s, As, j)
+        rest = numpy.maximum(Ls - da - dd, 0)/numpy.where(peak > 0, peak, 1)
+        times[short] = ta + td + rest
+    return times
+
+###########
+# Classes #
+###########
+
+# Per axis velocity and acceleration limits of a machine, in machine units
+# per second and per second squared
+class MachineProfile(object):
+    maxVelocity = None
+    maxAcceleration = None
+    # Allowed deviation from the programmed corner when taking it at speed
+    junctionDeviation = 0.02
+    # Optional jerk limit, None for a plain trapezoidal profile
+    jerk = None
+
+    def __init__(self, maxVelocity=(100.0, 100.0, 50.0), maxAcceleration=(500.0, 500.0, 200.0),
+                 junctionDeviation=0.02, jerk=None):
+        self.maxVelocity = numpy.array(maxVelocity, dtype=float)
+        self.maxAcceleration = numpy.array(maxAcceleration, dtype=float)
+        self.junctionDeviation = junctionDeviation
+        self.jerk = jerk
+
+    # The highest value of the per axis limits allowed along each direction,
+    # the slowest axis for null moves
+    def along(self, limits, direction):
+        with numpy.errstate(divide="ignore"):
+            values = (limits/numpy.abs(direction)).min(axis=1)
+        return numpy.where(numpy.isfinite(values), values, limits.min())
+
+# The planned speeds and times of a segment array
+class Plan(object):
+    segments = None
+    # Planned cruise limit, entry and exit speed of every segment
+    limit = None
+    entry = None
+    exit = None
+    duration = None
+
+    def total(self):
+        return self.duration.sum()
+
+# Trapezoidal look-ahead over the whole segment array. The forward and
+# backward passes are the usual v1^2 = min(limit, v0^2 + 2aL) recurrences;
+# written as running minimums over prefix sums they become a single
+# numpy.minimum.accumulate each instead of a Python loop.
+class Planner(object):
+    profile = None
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    # Plan the segments. stops marks the segments after which the machine
+    # has to come to rest, eg. for a dwell or a tool change.
+    def plan(self, segs, stops=None):
+        profile = self.profile
+        n = len(segs)
+        plan = Plan()
+        plan.segments = segs
+        if (n == 0):
+            plan.limit = plan.entry = plan.exit = plan.duration = numpy.zeros(0)
+            return plan
+
+        (tin, tout) = tangents(segs)
+        chord = segs.end - segs.start
+        norm = numpy.linalg.norm(chord, axis=1)
+        chord /= numpy.where(norm > 0, norm, 1)[:, None]
+
+        # Lines are limited along their direction, arcs by the slowest axis
+        # of their plane and by the centripetal acceleration
+        arcs = (segs.kind == segments.ARC)
+        planeAxes = numpy.zeros((n, 3))
+        rows = numpy.arange(n)
+        planeAxes[rows, segs.cosAxis] = 1
+        planeAxes[rows, segs.sinAxis] = 1
+        direction = numpy.where(arcs[:, None], planeAxes, chord)
+        vmax = profile.along(profile.maxVelocity, direction)
+        accel = profile.along(profile.maxAcceleration, direction)
+        feed = numpy.where(segs.rapid, numpy.inf, segs.feedRate)
+        limit = numpy.minimum(vmax, feed)
+        limit[arcs] = numpy.minimum(limit[arcs], numpy.sqrt(accel[arcs]*segs.radius[arcs]))
+        limit = numpy.where(numpy.isfinite(limit), limit, 0)
+
+        # Junction limits between segment i and i+1 (junction deviation)
+        cos = -numpy.einsum("ij,ij->i", tout[:-1], tin[1:])
+        sinHalf = numpy.sqrt(numpy.clip(0.5*(1 - cos), 0, 1))
+        a = numpy.minimum(accel[:-1], accel[1:])
+        with numpy.errstate(divide="ignore"):
+            junction = numpy.where(sinHalf < 1 - 1e-9,
+                a*profile.junctionDeviation*sinHalf/(1 - sinHalf), numpy.inf)
+        junction = numpy.minimum(junction, numpy.minimum(limit[:-1], limit[1:])**2)
+        # Gaps in the path, or moves meeting a full stop
+        gap = numpy.linalg.norm(segs.start[1:] - segs.end[:-1], axis=1) > 1e-6
+        junction[gap] = 0
+        if (stops is not None):
+            junction[numpy.asarray(stops)[:-1]] = 0
+
+        # Squared speeds at the N+1 junctions, at rest at both ends
+        J = numpy.concatenate(([0], junction, [0]))
+        d = 2*accel*segs.length
+        S = numpy.concatenate(([0], numpy.cumsum(d)))
+        forward = numpy.minimum.accumulate(J - S) + S
+        W = numpy.minimum.accumulate((forward + S)[::-1])[::-1] - S
+        W = numpy.maximum(W, 0)
+
+        plan.limit = limit
+        plan.entry = numpy.sqrt(W[:-1])
+        plan.exit = numpy.sqrt(W[1:])
+        plan.duration = move_times(segs.length, plan.entry, plan.exit,
+            numpy.maximum(limit, numpy.maximum(plan.entry, plan.exit)), accel, profile.jerk)
+        return plan
+
+    # Plan every motion path of the state and rewrite the startTime and
+    # duration of all its paths, dwells, tool changes and the records
+    # standing in for several moves (canned cycles) included
+    def apply(self, state):
+        records = list(state.paths.values())
+        groups = [record.expand() for record in records]
+        ordered = [path for group in groups for path in group]
+        segs = segments.Segments(ordered, state.scale)
+        motion = set(id(path) for path in segs.paths)
+        # Rest after a motion path that is followed by anything else
+        stops = numpy.zeros(len(segs), dtype=bool)
+        i = -1
+        for path in ordered:
+            if (id(path) in motion):
+                i += 1
+            elif (i >= 0):
+                stops[i] = True
+
+        plan = self.plan(segs, stops)
+        time = 0
+        i = 0
+        for (record, group) in zip(records, groups):
+            record.startTime = time
+            for path in group:
+                path.startTime = time
+                if (id(path) in motion):
+                    path.duration = plan.duration[i]
+                    i += 1
+                time += path.duration
+            record.duration = time - record.startTime
+            if (isinstance(record, gcode.CannedCycle)):
+                # Its moves are made again on every expand()
+                record.durations = [path.duration for path in group]
+        state.time = time
+        return plan
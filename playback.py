@@ -0,0 +1,166 @@
+# Real time playback of a program
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import itertools
+from time import perf_counter
+
+import numpy
+
+import segments
+
+###########
+# Globals #
+###########
+
+# How quickly the estimated drawing cost per point follows the measurements
+COST_SMOOTHING = 0.25
+
+# Chord tolerance (mm) of the arcs drawn
+TOLERANCE = 0.01
+
+###########
+# Classes #
+###########
+
+# Steps a State along with the wall clock. Every tick moves the machine time
+# on by the wall time passed since the last one times the speed, and hands
+# the points the tool went through by then to the drawing function in one
+# batch, up to where it is within the move under way, so a long move is
+# drawn as the tool goes. The stepping and the drawing together stay within
+# the budget (in seconds), which the drawing is charged by the point; when
+# they would not, playback falls behind instead of stalling the UI.
+class PlaybackScheduler(object):
+    state = None
+    # Machine seconds per wall clock second
+    speed = 1.0
+    budget = 0.02
+    tolerance = TOLERANCE
+    # The machine time played up to
+    time = 0
+    lastTick = None
+    # Paths stepped but not finished yet
+    queue = None
+    # The move under way, and how far along it (0..1) it has been drawn
+    partial = None
+    partialT = 0
+    # Estimated seconds it takes to draw a point
+    pointCost = 0
+    clock = None
+
+    def __init__(self, state, speed=1.0, budget=0.02, clock=perf_counter, tolerance=TOLERANCE):
+        self.state = state
+        self.speed = speed
+        self.budget = budget
+        self.clock = clock
+        self.tolerance = tolerance
+        self.time = state.time
+        self.queue = collections.deque()
+
+    # Start counting the wall time, eg. after a pause
+    def start(self):
+        self.lastTick = self.clock()
+
+    # Whether everything has been played
+    def done(self):
+        return self.state.finished and not self.queue
+
+    # The points (n, 3) the tool goes through from where the last tick left
+    # off up to the target time, and the machine time of every point
+    def points(self, target):
+        count = 0
+        for path in self.queue:
+            if (path.startTime > target):
+                break
+            count += 1
+        segs = segments.Segments(list(itertools.islice(self.queue, count)))
+        if (not len(segs)):
+            return (numpy.zeros((0, 3)), numpy.zeros(0))
+        # In the units of the paths
+        (points, owner, t) = segs.tessellate(self.tolerance/self.state.scale)
+        times = segs.startTime[owner] + segs.duration[owner]*t
+        keep = (times <= target)
+        if (segs.paths[0] is self.partial):
+            keep &= ~((owner == 0) & (t <= self.partialT))
+        (points, times) = (points[keep], times[keep])
+
+        # Where the tool is within the move under way, which is the last one
+        # started as the moves follow each other
+        ends = segs.startTime + segs.duration
+        under = numpy.nonzero((segs.startTime < target) & (ends > target))[0]
+        if (len(under)):
+            i = under[-1:]
+            t = (target - segs.startTime[i])/segs.duration[i]
+            if (segs.kind[i[0]] == segments.ARC):
+                point = segs.arc_points(i, t)
+            else:
+                point = segs.start[i] + (segs.end[i] - segs.start[i])*t[:, None]
+            points = numpy.vstack((points, point))
+            times = numpy.append(times, target)
+        return (points, times)
+
+    # Play the machine time passed since the last call. draw is called with
+    # the paths finished by then and the points to draw. Returns the paths
+    # finished.
+    def tick(self, draw):
+        now = self.clock()
+        if (self.lastTick is None):
+            self.lastTick = now
+        target = self.time + (now - self.lastTick)*self.speed
+        self.lastTick = now
+
+        # Step until the move under way at the target is known
+        while (not self.state.finished and
+               (not self.queue or self.queue[-1].startTime + self.queue[-1].duration < target)):
+            if (self.clock() - now > self.budget):
+                # Only as far as was stepped
+                last = self.queue[-1] if self.queue else None
+                target = min(target, last.startTime + last.duration if last else self.time)
+                break
+            self.state.step()
+            # Records standing in for several moves are played move by move
+            for record in self.state.stepPaths:
+                self.queue.extend(record.expand())
+
+        (points, times) = self.points(target)
+        if (self.pointCost > 0):
+            allowed = max(int((self.budget - (self.clock() - now))/self.pointCost), 1)
+            if (len(points) > allowed):
+                # Only as far as fits, the rest is left for later
+                (points, times) = (points[:allowed], times[:allowed])
+                target = times[-1]
+        self.time = max(self.time, target)
+
+        ready = []
+        while (self.queue and self.queue[0].startTime + self.queue[0].duration <= self.time):
+            ready.append(self.queue.popleft())
+        self.partial = None
+        if (self.queue and self.queue[0].startTime < self.time):
+            self.partial = self.queue[0]
+            self.partialT = (self.time - self.partial.startTime)/self.partial.duration
+
+        if (ready or len(points)):
+            start = self.clock()
+            draw(ready, points)
+            if (len(points)):
+                cost = (self.clock() - start)/len(points)
+                self.pointCost += (cost - self.pointCost)*COST_SMOOTHING
+        return ready
@@ -0,0 +1,202 @@
+# Headless toolpath previews
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import concurrent.futures
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+import numpy
+
+import machines
+import segments
+
+###########
+# Globals #
+###########
+
+# Pixels along the sides of a preview
+SIZE = 256
+
+# Empty pixels around the toolpath
+MARGIN = 8
+
+# Chord tolerance (mm) of the arcs
+TOLERANCE = 0.05
+
+# Colours of the background, the rapids and the cuts
+BACKGROUND = (32, 32, 32)
+RAPID_COLOR = (230, 90, 60)
+CUT_COLOR = (80, 170, 255)
+
+# The directions to the right and up of every view, in program coordinates.
+# The iso view looks from the front right corner down onto the part.
+VIEWS = {
+    "top": ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0)),
+    "front": ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+    "side": ((0.0, 1.0, 0.0), (0.0, 0.0, 1.0)),
+    "iso": ((1/math.sqrt(2), 1/math.sqrt(2), 0.0), (-1/math.sqrt(6), 1/math.sqrt(6), 2/math.sqrt(6))),
+}
+
+# The files of a job library previewed, as in the file browser
+EXTENSIONS = (".nc", ".gcode", ".ngc")
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cnc-emulator", "previews")
+
+# Bytes hashed at a time
+HASH_CHUNK = 1 << 20
+
+#############
+# Functions #
+#############
+
+# The hash of the content of a file, the key of its previews in the cache
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Where the preview of a view of a file with the given hash is cached
+def cache_path(cacheDir, digest, view, size=SIZE):
+    return os.path.join(cacheDir, "{}_{}_{}.png".format(digest, view, size))
+
+# An RGB image (rows, columns, 3) of uint8 as a PNG file, written without
+# any imaging library
+def write_png(image, path):
+    (height, width) = image.shape[:2]
+    # Every row starts with its filter type, 0 for none
+    raw = numpy.hstack((numpy.zeros((height, 1), numpy.uint8), image.reshape(height, width*3)))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    # Written next to the target and renamed, so a worker never leaves half
+    # a file in the cache
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as fd:
+        fd.write(b"\x89PNG\r\n\x1a\n")
+        fd.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        fd.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        fd.write(chunk(b"IEND", b""))
+    os.replace(temporary, path)
+
+# The pixels of the straight lines from a to b, (n, 2) arrays of column and
+# row, every line sampled once per pixel it crosses
+def line_pixels(a, b):
+    counts = numpy.ceil(numpy.abs(b - a).max(axis=1)).astype(numpy.int64) + 1
+    first = numpy.cumsum(counts) - counts
+    owner = numpy.repeat(numpy.arange(len(a)), counts)
+    step = numpy.arange(counts.sum()) - numpy.repeat(first, counts)
+    t = step/numpy.maximum(numpy.repeat(counts - 1, counts), 1)
+    return numpy.rint(a[owner] + (b[owner] - a[owner])*t[:, None]).astype(numpy.int64)
+
+# Draw the segments as seen in a view on a square image, the rapids first
+# and the cuts over them. The toolpath is fitted to the image keeping its
+# proportions.
+def rasterize(segs, view="top", size=SIZE, margin=MARGIN, tolerance=TOLERANCE):
+    image = numpy.empty((size, size, 3), numpy.uint8)
+    image[:] = BACKGROUND
+    if (not len(segs)):
+        return image
+    (points, owner, t) = segs.tessellate(tolerance)
+    (right, up) = VIEWS[view]
+    uv = numpy.column_stack((points.dot(right), points.dot(up)))
+
+    lo = uv.min(axis=0)
+    extent = max((uv.max(axis=0) - lo).max(), 1e-9)
+    scale = (size - 1 - 2*margin)/extent
+    # Centred, with the rows counted down from the top
+    centre = (size - 1 - (uv.max(axis=0) - lo)*scale)/2
+    pixels = (uv - lo)*scale + centre
+    pixels[:, 1] = size - 1 - pixels[:, 1]
+
+    # The pieces between the points of the same segment
+    joined = numpy.nonzero(owner[1:] == owner[:-1])[0]
+    rapid = segs.rapid[owner[joined]]
+    for (pieces, color) in ((joined[rapid], RAPID_COLOR), (joined[~rapid], CUT_COLOR)):
+        if (len(pieces)):
+            xy = line_pixels(pixels[pieces], pixels[pieces + 1])
+            image[xy[:, 1], xy[:, 0]] = color
+    return image
+
+# Simulate a program and write the previews of the views not cached yet.
+# Runs in the workers, the paths of the previews are returned.
+def render_file(path, views=tuple(VIEWS), size=SIZE, cacheDir=CACHE_DIR, digest=None):
+    digest = digest or file_hash(path)
+    targets = [cache_path(cacheDir, digest, view, size) for view in views]
+    missing = [(view, target) for (view, target) in zip(views, targets) if not os.path.exists(target)]
+    if (missing):
+        (arrays, duration, unknownCodes) = machines.simulate(path)
+        segs = segments.from_arrays(arrays)
+        if (not os.path.isdir(cacheDir)):
+            os.makedirs(cacheDir, exist_ok=True)
+        for (view, target) in missing:
+            write_png(rasterize(segs, view, size), target)
+    return targets
+
+# The previews of every program in a directory by file name, and the error
+# of every file that could not be previewed. The files with all their
+# previews cached are not handed to the workers at all. The workers are
+# threads unless asked for processes, which run outside Blender only.
+def render_directory(directory, views=tuple(VIEWS), size=SIZE, cacheDir=CACHE_DIR, workers=machines.WORKERS,
+                     processes=False):
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if os.path.splitext(name)[1].lower() in EXTENSIONS)
+    result = {}
+    failed = {}
+    jobs = {}
+    if (processes):
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        for path in paths:
+            digest = file_hash(path)
+            targets = [cache_path(cacheDir, digest, view, size) for view in views]
+            if (all(os.path.exists(target) for target in targets)):
+                result[path] = targets
+            else:
+                jobs[pool.submit(render_file, path, views, size, cacheDir, digest)] = path
+        for future in concurrent.futures.as_completed(jobs):
+            try:
+                result[jobs[future]] = future.result()
+            except Exception as error:
+                failed[jobs[future]] = error
+    return (result, failed)
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print('Usage: preview.py <G-code file or directory> [cache directory] [size]')
+        sys.exit(1)
+    cacheDir = sys.argv[2] if len(sys.argv) > 2 else CACHE_DIR
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else SIZE
+    if os.path.isdir(sys.argv[1]):
+        (previews, failed) = render_directory(sys.argv[1], size=size, cacheDir=cacheDir, processes=True)
+    else:
+        (previews, failed) = ({sys.argv[1]: render_file(sys.argv[1], size=size, cacheDir=cacheDir)}, {})
+    for path in sorted(previews):
+        print("{}: {}".format(path, " ".join(previews[path])))
+    for path in sorted(failed):
+        print("No preview of {}: {}".format(path, failed[path]))
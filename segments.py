@@ -0,0 +1,375 @@
+# Toolpath segment arrays
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+
+import gcode
+
+###########
+# Globals #
+###########
+
+# Segment kinds
+LINE = 0
+ARC = 1
+
+# Display layers of the segments, see Segments.layers()
+LAYER_RAPID = 0
+LAYER_CUT = 1
+LAYER_PLUNGE = 2
+LAYER_ARC = 3
+LAYER_IDLE = 4
+LAYERS = ("Rapid", "Cut", "Plunge", "Arc", "SpindleOff")
+
+# Arc planes, in the same order as G17/G18/G19
+PLANES = ("XY", "ZX", "YZ")
+
+# For every (plane, clockwise) the axis driven by cos() and the axis driven
+# by sin() when walking the arc angle. This mirrors how gcode.Arc measures
+# angle1/angle2 so that theta=angle1 is the start and theta=angle2 the end.
+ARC_AXES = {
+    ("XY", True):  (0, 1),
+    ("XY", False): (1, 0),
+    ("ZX", True):  (0, 2),
+    ("ZX", False): (2, 0),
+    ("YZ", True):  (2, 1),
+    ("YZ", False): (1, 2),
+}
+
+# The per segment arrays of Segments
+ARRAYS = ("start", "end", "center", "kind", "rapid", "spindleOn", "feedRate", "lineno",
+          "startTime", "duration", "length", "radius", "angle1", "sweep", "plane",
+          "cosAxis", "sinAxis", "normalAxis")
+
+#############
+# Functions #
+#############
+
+def from_state(state):
+    return Segments(state.paths.values(), state.scale)
+
+# Segments from the per segment arrays of another, eg. sent back from a
+# worker process. They have no path objects.
+def from_arrays(arrays, scale=1):
+    segs = Segments([], scale)
+    for name in ARRAYS:
+        setattr(segs, name, arrays[name])
+    segs.paths = [None]*len(segs.kind)
+    return segs
+
+# The segments of a state that State.reload() took back to its first kept
+# paths and ran on from there. The rows of the kept paths are taken over
+# from segs, only the paths run since are converted.
+def from_reload(segs, state, kept):
+    records = list(state.paths.values())
+    count = len([path for record in records[:kept] for path in record.expand()
+                 if isinstance(path, (gcode.Line, gcode.Arc))])
+    return segs.splice(count, records[kept:])
+
+# Whether the closed angle interval [a, b] contains phase + n*period for some n
+def _contains_angle(a, b, phase, period=2*math.pi):
+    return numpy.ceil((a-phase)/period) <= numpy.floor((b-phase)/period)
+
+###########
+# Classes #
+###########
+
+# The motion paths of a State flattened into NumPy arrays, one row per Line
+# or Arc. Records such as canned cycles are expanded into their moves here.
+# Coordinates are in machine units (mm), ie. the Blender positions stored in
+# the paths multiplied by the state scale.
+class Segments(object):
+    # (N,3) float arrays
+    start = None
+    end = None
+    center = None
+    # Per segment values
+    kind = None
+    rapid = None
+    spindleOn = None
+    feedRate = None
+    lineno = None
+    startTime = None
+    duration = None
+    length = None
+    # Arc geometry, zero for lines
+    radius = None
+    angle1 = None
+    sweep = None
+    plane = None
+    cosAxis = None
+    sinAxis = None
+    normalAxis = None
+    # The source path objects, in the same order as the arrays
+    paths = None
+    scale = 1
+
+    def __init__(self, paths, scale=1):
+        self.scale = scale
+        self.paths = [path for record in paths for path in record.expand()
+                      if isinstance(path, (gcode.Line, gcode.Arc))]
+        n = len(self.paths)
+
+        self.start = numpy.zeros((n, 3))
+        self.end = numpy.zeros((n, 3))
+        self.center = numpy.zeros((n, 3))
+        self.kind = numpy.zeros(n, dtype=numpy.int8)
+        self.rapid = numpy.zeros(n, dtype=bool)
+        self.spindleOn = numpy.zeros(n, dtype=bool)
+        self.feedRate = numpy.zeros(n)
+        self.lineno = numpy.zeros(n, dtype=numpy.int64)
+        self.startTime = numpy.zeros(n)
+        self.duration = numpy.zeros(n)
+        self.radius = numpy.zeros(n)
+        self.angle1 = numpy.zeros(n)
+        self.sweep = numpy.zeros(n)
+        self.plane = numpy.zeros(n, dtype=numpy.int8)
+        self.cosAxis = numpy.zeros(n, dtype=numpy.int8)
+        self.sinAxis = numpy.ones(n, dtype=numpy.int8)
+
+        for (i, path) in enumerate(self.paths):
+            self.start[i] = path.start
+            self.end[i] = path.end
+            self.feedRate[i] = path.feedRate
+            self.spindleOn[i] = path.spindleOn
+            self.startTime[i] = path.startTime
+            self.duration[i] = path.duration
+            if (path.statement is not None):
+                self.lineno[i] = path.statement.lineNumber
+            if (isinstance(path, gcode.Arc)):
+                self.kind[i] = ARC
+                self.center[i] = path.center
+                self.angle1[i] = path.angle1
+                self.sweep[i] = path.angle2 - path.angle1
+                self.plane[i] = PLANES.index(path.plane)
+                (self.cosAxis[i], self.sinAxis[i]) = ARC_AXES[(path.plane, path.clockwise)]
+            else:
+                self.rapid[i] = path.rapid
+
+        self.start *= scale
+        self.end *= scale
+        self.center *= scale
+        self.normalAxis = (3 - self.cosAxis - self.sinAxis).astype(numpy.int8)
+
+        # Use the radius within the arc plane, gcode.Arc measures it in 3D
+        rows = numpy.arange(n)
+        u = self.start - self.center
+        self.radius = numpy.hypot(u[rows, self.cosAxis], u[rows, self.sinAxis])
+        self.radius[self.kind != ARC] = 0
+
+        self.length = numpy.linalg.norm(self.end - self.start, axis=1)
+        arcs = (self.kind == ARC)
+        self.length[arcs] = numpy.hypot(self.radius[arcs]*self.sweep[arcs],
+            self.end[arcs, self.normalAxis[arcs]] - self.start[arcs, self.normalAxis[arcs]])
+
+    def __len__(self):
+        return len(self.kind)
+
+    # The per segment arrays by name, without the path objects
+    def arrays(self):
+        return dict((name, getattr(self, name)) for name in ARRAYS)
+
+    # A copy of the first count segments followed by those of the paths
+    def splice(self, count, paths):
+        tail = Segments(paths, self.scale)
+        segs = Segments([], self.scale)
+        segs.paths = self.paths[:count] + tail.paths
+        for name in ARRAYS:
+            setattr(segs, name, numpy.concatenate((getattr(self, name)[:count], getattr(tail, name))))
+        return segs
+
+    # The display layer of every segment: rapids, moves with the spindle off,
+    # plunges (feed moves going down steeper than 45 degrees), arcs and the
+    # remaining cuts
+    def layers(self):
+        layer = numpy.full(len(self), LAYER_CUT, dtype=numpy.int8)
+        d = self.end - self.start
+        plunge = (self.kind == LINE) & (d[:, 2] < 0) & (numpy.hypot(d[:, 0], d[:, 1]) <= -d[:, 2])
+        layer[plunge] = LAYER_PLUNGE
+        layer[self.kind == ARC] = LAYER_ARC
+        layer[~self.spindleOn] = LAYER_IDLE
+        layer[self.rapid] = LAYER_RAPID
+        return layer
+
+    # Returns the points at parameter t (0..1) along the given arc segments.
+    # The axis normal to the arc plane is interpolated linearly (helix).
+    def arc_points(self, idx, t):
+        idx = numpy.asarray(idx)
+        t = numpy.asarray(t, dtype=float)
+        theta = self.angle1[idx] + self.sweep[idx]*t
+        rows = numpy.arange(len(idx))
+        pts = self.center[idx].copy()
+        normal = self.normalAxis[idx]
+        pts[rows, normal] = (self.start[idx, normal] +
+            (self.end[idx, normal] - self.start[idx, normal])*t)
+        pts[rows, self.cosAxis[idx]] += self.radius[idx]*numpy.cos(theta)
+        pts[rows, self.sinAxis[idx]] += self.radius[idx]*numpy.sin(theta)
+        return pts
+
+    # Returns points along the given segments no further than spacing apart,
+    # both end points included, and for every point the segment it belongs to
+    def sample(self, idx, spacing):
+        (pts, owner, _) = self._sample(idx, spacing)
+        return (pts, owner)
+
+    # Returns points following the segments within the given chord tolerance,
+    # lines by their end points only, as (points, owner, t) where t is the
+    # position of every point along its own segment
+    def tessellate(self, tolerance, idx=None):
+        if (idx is None):
+            idx = numpy.arange(len(self))
+        idx = numpy.asarray(idx)
+        # A chord c of an arc of radius r is off it by c*c/(8r) in the middle
+        chord = numpy.maximum(numpy.sqrt(8*self.radius[idx]*tolerance), tolerance)
+        spacing = numpy.where(self.kind[idx] == ARC, chord, numpy.inf)
+        return self._sample(idx, spacing)
+
+    # spacing may be a single value or one per segment
+    def _sample(self, idx, spacing):
+        idx = numpy.asarray(idx)
+        counts = numpy.maximum(numpy.ceil(self.length[idx]/spacing), 1).astype(numpy.int64) + 1
+        owner = numpy.repeat(idx, counts)
+        # Position of every point within its own segment
+        first = numpy.cumsum(counts) - counts
+        step = numpy.arange(counts.sum()) - numpy.repeat(first, counts)
+        t = step/numpy.repeat(counts - 1, counts).astype(float)
+
+        pts = self.start[owner] + (self.end[owner] - self.start[owner])*t[:, None]
+        arcs = (self.kind[owner] == ARC)
+        if (arcs.any()):
+            pts[arcs] = self.arc_points(owner[arcs], t[arcs])
+        return (pts, owner, t)
+
+    # Returns the exact (lo, hi) bounding boxes of every segment, including the
+    # extreme points an arc passes between its end points
+    def bounds(self):
+        lo = numpy.minimum(self.start, self.end)
+        hi = numpy.maximum(self.start, self.end)
+
+        idx = numpy.nonzero(self.kind == ARC)[0]
+        if (len(idx) == 0):
+            return (lo, hi)
+
+        a = numpy.minimum(self.angle1[idx], self.angle1[idx] + self.sweep[idx])
+        b = numpy.maximum(self.angle1[idx], self.angle1[idx] + self.sweep[idx])
+        r = self.radius[idx]
+        ca = self.cosAxis[idx]
+        sa = self.sinAxis[idx]
+        c = self.center[idx]
+        rows = numpy.arange(len(idx))
+        # (phase of the extreme, axis, sign) for cos and sin
+        for (phase, axis, sign) in ((0, ca, 1), (math.pi, ca, -1),
+                                    (math.pi/2, sa, 1), (3*math.pi/2, sa, -1)):
+            hit = _contains_angle(a, b, phase)
+            ext = c[rows, axis] + sign*r
+            sel = idx[hit]
+            if (sign > 0):
+                hi[sel, axis[hit]] = numpy.maximum(hi[sel, axis[hit]], ext[hit])
+            else:
+                lo[sel, axis[hit]] = numpy.minimum(lo[sel, axis[hit]], ext[hit])
+        return (lo, hi)
+
+    # Returns the distance from the point to each of the given segments
+    def distance_to_point(self, idx, point):
+        idx = numpy.asarray(idx)
+        point = numpy.asarray(point, dtype=float)
+        dist = numpy.empty(len(idx))
+
+        lines = (self.kind[idx] == LINE)
+        li = idx[lines]
+        if (len(li)):
+            p0 = self.start[li]
+            u = self.end[li] - p0
+            uu = numpy.einsum("ij,ij->i", u, u)
+            s = numpy.einsum("ij,ij->i", point - p0, u)/numpy.where(uu > 0, uu, 1)
+            s = numpy.clip(s, 0, 1)
+            dist[lines] = numpy.linalg.norm(p0 + u*s[:, None] - point, axis=1)
+
+        ai = idx[~lines]
+        if (len(ai)):
+            rows = numpy.arange(len(ai))
+            c = self.center[ai]
+            dc = point[self.cosAxis[ai]] - c[rows, self.cosAxis[ai]]
+            ds = point[self.sinAxis[ai]] - c[rows, self.sinAxis[ai]]
+            # Parameter of the projection of the point onto the arc circle
+            phi = numpy.arctan2(ds, dc)
+            sweep = self.sweep[ai]
+            rel = numpy.mod((phi - self.angle1[ai])*numpy.sign(sweep), 2*math.pi)
+            absSweep = numpy.abs(sweep)
+            inside = (rel <= absSweep) & (absSweep > 0)
+            t = numpy.where(inside, rel/numpy.where(absSweep > 0, absSweep, 1), 0)
+            onArc = numpy.linalg.norm(self.arc_points(ai, t) - point, axis=1)
+            toStart = numpy.linalg.norm(self.start[ai] - point, axis=1)
+            toEnd = numpy.linalg.norm(self.end[ai] - point, axis=1)
+            d = numpy.minimum(toStart, toEnd)
+            dist[~lines] = numpy.where(inside, numpy.minimum(onArc, d), d)
+        return dist
+
+    # Returns (distance, depth) of the closest approach between each segment and
+    # the ray. Arcs are measured against a chord approximation.
+    def distance_to_ray(self, idx, origin, direction, chords=16):
+        idx = numpy.asarray(idx)
+        origin = numpy.asarray(origin, dtype=float)
+        direction = numpy.asarray(direction, dtype=float)
+        direction = direction/numpy.linalg.norm(direction)
+
+        dist = numpy.empty(len(idx))
+        depth = numpy.empty(len(idx))
+
+        lines = (self.kind[idx] == LINE)
+        li = idx[lines]
+        if (len(li)):
+            (dist[lines], depth[lines]) = _segment_ray(self.start[li], self.end[li], origin, direction)
+
+        ai = idx[~lines]
+        if (len(ai)):
+            t = numpy.linspace(0, 1, chords + 1)
+            rep = numpy.repeat(ai, chords + 1)
+            pts = self.arc_points(rep, numpy.tile(t, len(ai))).reshape(len(ai), chords + 1, 3)
+            (d, z) = _segment_ray(pts[:, :-1].reshape(-1, 3), pts[:, 1:].reshape(-1, 3), origin, direction)
+            d = d.reshape(len(ai), chords)
+            z = z.reshape(len(ai), chords)
+            best = numpy.argmin(d, axis=1)
+            rows = numpy.arange(len(ai))
+            dist[~lines] = d[rows, best]
+            depth[~lines] = z[rows, best]
+        return (dist, depth)
+
+# Closest approach between segments p0-p1 and a ray with unit direction
+def _segment_ray(p0, p1, origin, direction):
+    u = p1 - p0
+    w = p0 - origin
+    uu = numpy.einsum("ij,ij->i", u, u)
+    ud = u.dot(direction)
+    wd = w.dot(direction)
+    wu = numpy.einsum("ij,ij->i", w, u)
+    denom = uu - ud*ud
+    safe = numpy.where(denom > 1e-12, denom, 1)
+    s = numpy.where(denom > 1e-12, (ud*wd - wu)/safe, 0)
+    s = numpy.clip(s, 0, 1)
+    t = numpy.maximum(wd + s*ud, 0)
+    # Re-project onto the segment for rays that got clamped at the origin
+    s = numpy.clip(numpy.einsum("ij,ij->i", (origin + numpy.outer(t, direction)) - p0, u)/numpy.where(uu > 0, uu, 1), 0, 1)
+    t = numpy.maximum(wd + s*ud, 0)
+    closest = p0 + u*s[:, None]
+    dist = numpy.linalg.norm(closest - (origin + numpy.outer(t, direction)), axis=1)
+    return (dist, t)
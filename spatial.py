@@ -0,0 +1,215 @@
+# Spatial index over toolpath segments
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# Number of children per node in the packed tree
+NODE_SIZE = 16
+
+# Bits per axis of the Morton code used to sort the boxes
+MORTON_BITS = 10
+
+#############
+# Functions #
+#############
+
+# Spread the lower 10 bits of each value so there are two zero bits between them
+def _spread_bits(v):
+    v = v.astype(numpy.uint32) & 0x3ff
+    v = (v | (v << 16)) & 0x030000ff
+    v = (v | (v << 8)) & 0x0300f00f
+    v = (v | (v << 4)) & 0x030c30c3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+def morton_codes(points, lo, hi):
+    size = numpy.where(hi - lo > 0, hi - lo, 1)
+    cells = (1 << MORTON_BITS) - 1
+    q = numpy.clip((points - lo)/size*cells, 0, cells)
+    return (_spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << 1) |
+            (_spread_bits(q[:, 2]) << 2))
+
+# Squared distance from a point to each box, and to the farthest corner of it
+def _box_distances(lo, hi, point):
+    near = numpy.maximum(numpy.maximum(lo - point, point - hi), 0)
+    far = numpy.maximum(numpy.abs(lo - point), numpy.abs(hi - point))
+    return ((near*near).sum(axis=1), (far*far).sum(axis=1))
+
+###########
+# Classes #
+###########
+
+# A static bounding volume hierarchy over a set of boxes. The boxes are sorted
+# along a Morton curve and packed NODE_SIZE to a node, level by level, so the
+# whole tree is a handful of flat arrays built without any Python loop over
+# the items. Queries walk the tree one level at a time, testing every
+# candidate node of a level in one vectorized operation.
+class BoxTree(object):
+    # Item index for every leaf slot, in Morton order
+    order = None
+    # Per level (lo, hi) arrays, level 0 being the items themselves
+    levels = None
+    count = 0
+
+    def __init__(self, lo, hi, nodeSize=NODE_SIZE):
+        self.nodeSize = nodeSize
+        lo = numpy.asarray(lo, dtype=float)
+        hi = numpy.asarray(hi, dtype=float)
+        self.count = len(lo)
+        self.levels = []
+        if (self.count == 0):
+            self.order = numpy.zeros(0, dtype=numpy.int64)
+            return
+
+        codes = morton_codes((lo + hi)*0.5, lo.min(axis=0), hi.max(axis=0))
+        self.order = numpy.argsort(codes, kind="stable")
+        lo = lo[self.order]
+        hi = hi[self.order]
+        self.levels.append((lo, hi))
+        while (len(lo) > 1):
+            pad = -len(lo) % nodeSize
+            if (pad):
+                lo = numpy.concatenate((lo, numpy.full((pad, 3), numpy.inf)))
+                hi = numpy.concatenate((hi, numpy.full((pad, 3), -numpy.inf)))
+            lo = lo.reshape(-1, nodeSize, 3).min(axis=1)
+            hi = hi.reshape(-1, nodeSize, 3).max(axis=1)
+            self.levels.append((lo, hi))
+
+    # Walks the tree from the root. select(lo, hi, leaf) is given the boxes of
+    # the candidate nodes of one level and returns a mask of those to keep.
+    # Returns the surviving item indices.
+    def walk(self, select):
+        if (self.count == 0):
+            return numpy.zeros(0, dtype=numpy.int64)
+        top = len(self.levels) - 1
+        cand = numpy.arange(len(self.levels[top][0]))
+        (lo, hi) = self.levels[top]
+        cand = cand[select(lo[cand], hi[cand], top == 0)]
+        for level in range(top - 1, -1, -1):
+            (lo, hi) = self.levels[level]
+            children = (cand[:, None]*self.nodeSize + numpy.arange(self.nodeSize)).ravel()
+            children = children[children < len(lo)]
+            cand = children[select(lo[children], hi[children], level == 0)]
+        return self.order[cand]
+
+    def query_box(self, lo, hi):
+        lo = numpy.asarray(lo, dtype=float)
+        hi = numpy.asarray(hi, dtype=float)
+        def select(blo, bhi, leaf):
+            return numpy.all((blo <= hi) & (bhi >= lo), axis=1)
+        return self.walk(select)
+
+    def query_radius(self, point, radius):
+        point = numpy.asarray(point, dtype=float)
+        r2 = radius*radius
+        def select(blo, bhi, leaf):
+            return _box_distances(blo, bhi, point)[0] <= r2
+        return self.walk(select)
+
+    # Candidates for the k nearest items to the point. Every node box holds at
+    # least one whole item, so the k-th smallest far-corner distance of a
+    # level bounds the k-th nearest item, and anything whose near distance
+    # lies beyond that bound can be pruned.
+    def query_nearest_candidates(self, point, k=1):
+        point = numpy.asarray(point, dtype=float)
+        def select(blo, bhi, leaf):
+            (near, far) = _box_distances(blo, bhi, point)
+            if (len(far) > k):
+                bound = numpy.partition(far, k - 1)[k - 1]
+            else:
+                bound = far.max() if len(far) else 0
+            return near <= bound
+        return self.walk(select)
+
+    def query_ray(self, origin, direction, radius=0):
+        origin = numpy.asarray(origin, dtype=float)
+        direction = numpy.asarray(direction, dtype=float)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            inv = 1.0/direction
+        def select(blo, bhi, leaf):
+            with numpy.errstate(invalid="ignore"):
+                t1 = (blo - radius - origin)*inv
+                t2 = (bhi + radius - origin)*inv
+            # Axis parallel rays only hit boxes whose slab holds the origin
+            parallel = (direction == 0)
+            inSlab = (origin >= blo - radius) & (origin <= bhi + radius)
+            tmin = numpy.where(parallel, numpy.where(inSlab, -numpy.inf, numpy.inf), numpy.minimum(t1, t2))
+            tmax = numpy.where(parallel, numpy.where(inSlab, numpy.inf, -numpy.inf), numpy.maximum(t1, t2))
+            enter = tmin.max(axis=1)
+            leave = tmax.min(axis=1)
+            return (leave >= numpy.maximum(enter, 0))
+        return self.walk(select)
+
+# Spatial index over the segments of a segments.Segments
+class SegmentIndex(object):
+    segments = None
+    tree = None
+    lo = None
+    hi = None
+
+    def __init__(self, segs, nodeSize=NODE_SIZE):
+        self.segments = segs
+        (self.lo, self.hi) = segs.bounds()
+        self.tree = BoxTree(self.lo, self.hi, nodeSize)
+
+    # Segments whose bounding box overlaps the given box
+    def box(self, lo, hi):
+        return numpy.sort(self.tree.query_box(lo, hi))
+
+    # Segments passing within radius of the point, sorted by distance
+    def radius(self, point, radius):
+        idx = self.tree.query_radius(point, radius)
+        dist = self.segments.distance_to_point(idx, point)
+        keep = (dist <= radius)
+        (idx, dist) = (idx[keep], dist[keep])
+        order = numpy.argsort(dist, kind="stable")
+        return (idx[order], dist[order])
+
+    # The k segments nearest to the point, sorted by distance
+    def nearest(self, point, k=1):
+        idx = self.tree.query_nearest_candidates(point, k)
+        dist = self.segments.distance_to_point(idx, point)
+        order = numpy.argsort(dist, kind="stable")[:k]
+        return (idx[order], dist[order])
+
+    # Segments passing within radius of the ray, sorted front to back
+    def ray(self, origin, direction, radius):
+        idx = self.tree.query_ray(origin, direction, radius)
+        (dist, depth) = self.segments.distance_to_ray(idx, origin, direction)
+        keep = (dist <= radius)
+        (idx, dist, depth) = (idx[keep], dist[keep], depth[keep])
+        order = numpy.lexsort((dist, depth))
+        return (idx[order], dist[order])
+
+    # The segment under a ray, preferring the one closest to the ray and then
+    # the one closest to the viewer. Returns None if nothing is in reach.
+    def pick(self, origin, direction, radius):
+        idx = self.tree.query_ray(origin, direction, radius)
+        (dist, depth) = self.segments.distance_to_ray(idx, origin, direction)
+        keep = (dist <= radius)
+        if (not keep.any()):
+            return None
+        (idx, dist, depth) = (idx[keep], dist[keep], depth[keep])
+        return idx[numpy.lexsort((depth, dist))[0]]
@@ -0,0 +1,181 @@
+# Heightmap stock model
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# Cells per side of the coarse tiles holding the maximum height below them
+TILE_SIZE = 16
+
+# Upper limit of (sample, cell) pairs handled in one vectorized batch
+BATCH_SIZE = 1 << 22
+
+#############
+# Functions #
+#############
+
+# Cell offsets covered by a flat tool of the given radius in cells
+def disk_offsets(radius):
+    n = int(numpy.ceil(radius))
+    (di, dj) = numpy.mgrid[-n:n+1, -n:n+1]
+    inside = (di*di + dj*dj <= radius*radius)
+    return (di[inside].ravel(), dj[inside].ravel())
+
+###########
+# Classes #
+###########
+
+# A 2.5D stock: the top surface height over a regular XY grid, in machine
+# units. A coarse grid of tile maxima is kept up to date as material is
+# removed so that queries high above the stock never touch single cells.
+class Heightmap(object):
+    origin = None
+    cellSize = 1.0
+    heights = None
+    tiles = None
+    bottom = 0
+
+    def __init__(self, lo, hi, cellSize, top=0.0, bottom=None):
+        self.cellSize = float(cellSize)
+        self.origin = numpy.array(lo[:2], dtype=float)
+        cells = numpy.ceil((numpy.array(hi[:2], dtype=float) - self.origin)/self.cellSize).astype(int)
+        # Round the grid up to whole tiles
+        cells = numpy.maximum(-(-cells // TILE_SIZE) * TILE_SIZE, TILE_SIZE)
+        self.heights = numpy.full((cells[0], cells[1]), float(top))
+        self.bottom = lo[2] if bottom is None else bottom
+        self.tiles = numpy.full((cells[0]//TILE_SIZE, cells[1]//TILE_SIZE), float(top))
+
+    @property
+    def shape(self):
+        return self.heights.shape
+
+    # Grid cell of each XY point, and whether it lies on the stock
+    def cells(self, points):
+        ij = numpy.floor((points[:, :2] - self.origin)/self.cellSize).astype(numpy.int64)
+        inside = numpy.all((ij >= 0) & (ij < self.heights.shape), axis=1)
+        return (ij, inside)
+
+    # The (sample, cell) pairs a flat tool of the given radius covers when
+    # standing on the points, yielded in batches as (sample, i, j)
+    def footprint(self, points, radius):
+        (di, dj) = disk_offsets(radius/self.cellSize)
+        (ij, _) = self.cells(points)
+        per = max(BATCH_SIZE // len(di), 1)
+        for first in range(0, len(points), per):
+            sample = numpy.repeat(numpy.arange(first, min(first + per, len(points))), len(di))
+            i = ij[sample, 0] + numpy.tile(di, len(sample)//len(di))
+            j = ij[sample, 1] + numpy.tile(dj, len(sample)//len(dj))
+            inside = (i >= 0) & (j >= 0) & (i < self.heights.shape[0]) & (j < self.heights.shape[1])
+            yield (sample[inside], i[inside], j[inside])
+
+    # Lower the surface to the tool tip wherever a flat tool of the given
+    # radius stands on the points. Returns the removed volume per point when
+    # asked to, which costs a sort of the covered cells, and with depths also
+    # how deep into the material every point went, as (removed, depth).
+    def cut(self, points, radius, volumes=False, depths=False):
+        removed = numpy.zeros(len(points))
+        depth = numpy.zeros(len(points))
+        volumes = volumes or depths
+        area = self.cellSize*self.cellSize
+        heights = self.heights.reshape(-1)
+        for (sample, i, j) in self.footprint(points, radius):
+            if (not len(sample)):
+                continue
+            z = numpy.maximum(points[sample, 2], self.bottom)
+            flat = i*self.heights.shape[1] + j
+            if (not volumes):
+                numpy.minimum.at(heights, flat, z)
+                self.refresh_tiles(i, j)
+                continue
+            # Visit every cell's samples in path order so the material is
+            # credited to the sample that actually removed it
+            order = numpy.lexsort((sample, flat))
+            (flat, z, sample) = (flat[order], z[order], sample[order])
+            newCell = numpy.ones(len(flat), dtype=bool)
+            newCell[1:] = (flat[1:] != flat[:-1])
+            group = numpy.cumsum(newCell) - 1
+            # Running minimum that restarts at every cell: shifting each group
+            # further down than the spread of z keeps earlier cells out of it
+            shift = group*(z.max() - z.min() + 1.0)
+            running = numpy.minimum.accumulate(z - shift) + shift
+            level = numpy.empty(len(z))
+            level[0] = numpy.inf
+            level[1:] = running[:-1]
+            level[newCell] = numpy.inf
+            level = numpy.minimum(level, heights[flat])
+            drop = numpy.maximum(level - z, 0)
+            removed += numpy.bincount(sample, drop*area, len(points))
+            if (depths):
+                numpy.maximum.at(depth, sample, drop)
+            last = numpy.append(newCell[1:], True)
+            heights[flat[last]] = numpy.minimum(heights[flat[last]], running[last])
+            self.refresh_tiles(i, j)
+        if (depths):
+            return (removed, depth)
+        return removed
+
+    # Recompute the maxima of the tiles holding the given cells
+    def refresh_tiles(self, i, j):
+        t = numpy.unique((i // TILE_SIZE)*self.tiles.shape[1] + j // TILE_SIZE)
+        (ti, tj) = (t // self.tiles.shape[1], t % self.tiles.shape[1])
+        view = self.heights.reshape(self.tiles.shape[0], TILE_SIZE, self.tiles.shape[1], TILE_SIZE)
+        self.tiles[ti, tj] = view[ti, :, tj, :].reshape(len(t), -1).max(axis=1)
+
+    # Upper bound of the surface under a tool of the given radius standing on
+    # each point, taken from the tiles only
+    def coarse_max(self, points, radius):
+        span = self.cellSize*TILE_SIZE
+        lo = numpy.floor((points[:, :2] - radius - self.origin)/span).astype(numpy.int64)
+        hi = numpy.floor((points[:, :2] + radius - self.origin)/span).astype(numpy.int64)
+        lo = numpy.clip(lo, 0, numpy.array(self.tiles.shape) - 1)
+        hi = numpy.clip(hi, 0, numpy.array(self.tiles.shape) - 1)
+        # Points off the stock entirely see nothing
+        off = numpy.any((points[:, :2] + radius < self.origin) |
+            (points[:, :2] - radius >= self.origin + numpy.array(self.heights.shape)*self.cellSize), axis=1)
+        # Tools rarely span more than a couple of tiles, so loop over the
+        # largest span and take the maximum of every covered tile
+        result = numpy.full(len(points), -numpy.inf)
+        size = (hi - lo).max(axis=0) + 1 if len(points) else (0, 0)
+        for a in range(size[0]):
+            for b in range(size[1]):
+                ti = numpy.minimum(lo[:, 0] + a, hi[:, 0])
+                tj = numpy.minimum(lo[:, 1] + b, hi[:, 1])
+                result = numpy.maximum(result, self.tiles[ti, tj])
+        result[off] = -numpy.inf
+        return result
+
+    # Returns for every point how far a flat tool of the given radius standing
+    # on it would be buried in the stock, zero when it is clear
+    def penetration(self, points, radius):
+        depth = numpy.zeros(len(points))
+        if (not len(points)):
+            return depth
+        # Only points below the highest surface near them need the cells
+        close = numpy.nonzero(self.coarse_max(points, radius) > points[:, 2])[0]
+        if (not len(close)):
+            return depth
+        for (sample, i, j) in self.footprint(points[close], radius):
+            buried = self.heights[i, j] - points[close[sample], 2]
+            numpy.maximum.at(depth, close[sample], buried)
+        return depth
@@ -0,0 +1,130 @@
+# Tests of the G-code parser and state
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import sys
+import unittest
+
+import numpy
+
+# The modules are loaded from the addon directory, as Blender does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcode
+import planner
+import segments
+import writer
+
+# Run the lines on a state in mm
+def run(lines):
+    state = gcode.parse_lines(lines).start()
+    state.scale = 1
+    return state.run()
+
+# The ends, rapid flags and feed rates of the moves of a state that go
+# somewhere, the writer leaves out those that do not
+def moves(state):
+    segs = segments.from_state(state)
+    going = segs.length > 0
+    return (segs.end[going], segs.rapid[going], segs.feedRate[going])
+
+class LeadingWordTest(unittest.TestCase):
+    # A T, S or F word before the codes of a line is kept as a parameter
+
+    def test_tool_change(self):
+        st = gcode.parse_lines(["T1 M06"]).statements[0]
+        self.assertEqual((st.code, st.params, st.modes), ("M06", {"T": "1"}, []))
+        self.assertEqual(run(["T1 M06"]).tool, 1)
+
+    def test_spindle_speed(self):
+        st = gcode.parse_lines(["S1000 M03"]).statements[0]
+        self.assertEqual((st.code, st.params, st.modes), ("M03", {"S": "1000"}, []))
+        state = run(["M05", "S1000 M03"])
+        self.assertEqual(state.spindleSpeed, 1000)
+        self.assertTrue(state.spindleOn)
+
+    def test_feed_rate(self):
+        st = gcode.parse_lines(["F300 G01 X5"]).statements[0]
+        self.assertEqual((st.code, st.params, st.modes), ("G01", {"X": "5", "F": "300"}, []))
+        self.assertAlmostEqual(run(["G00 X0 Y0 Z0", "F300 G01 X5"]).feedRate, 5.0)
+
+    def test_axis_word_before_motion_code(self):
+        st = gcode.parse_lines(["G00 X0", "X5 G01 F100"]).statements[1]
+        self.assertEqual((st.code, st.params, st.modes), ("G01", {"X": "5", "F": "100"}, []))
+
+    def test_compensation_radius_from_tool(self):
+        state = run(["G10 L1 P2 R3", "T2 M06", "G00 X0 Y0 Z0", "G41"])
+        self.assertAlmostEqual(state.compRadius*state.scale, 3.0)
+
+class PathRecordTest(unittest.TestCase):
+    # Every record of a line is kept, not just the last
+
+    def test_tool_change_and_move(self):
+        state = run(["G00 X0 Y0 Z0", "T1 M06 G00 X10", "G04 P2 G01 X20"])
+        kinds = [type(path).__name__ for path in state.paths.values()]
+        self.assertEqual(kinds, ["Line", "ToolChange", "Line", "Dwell", "Line"])
+
+class CycleTimingTest(unittest.TestCase):
+    # The moves of a planned canned cycle keep the times the planner gave them
+
+    def test_planned_cycle_moves(self):
+        state = run(["G21 G90", "M03", "G00 X0 Y0 Z10", "G83 X5 Y5 Z-6 R1 Q2 F120", "X20", "G80", "G01 X30 F600"])
+        plan = planner.Planner(planner.MachineProfile()).apply(state)
+        segs = segments.from_state(state)
+        for (duration, planned) in zip(segs.duration, plan.duration):
+            self.assertAlmostEqual(duration, planned)
+        for (end, start) in zip(segs.startTime[:-1] + segs.duration[:-1], segs.startTime[1:]):
+            self.assertAlmostEqual(end, start)
+
+class WriterRoundTripTest(unittest.TestCase):
+    # The compact output of the writer reads back as the same toolpath
+
+    def assertRoundTrip(self, lines):
+        fd = io.StringIO()
+        with writer.GCodeWriter(fd) as out:
+            out.write_program(gcode.parse_lines(lines))
+        written = fd.getvalue().splitlines()
+        (a, b) = (moves(run(lines)), moves(run(written)))
+        self.assertEqual(len(a[0]), len(b[0]), written)
+        self.assertTrue(numpy.allclose(a[0], b[0]), written)
+        self.assertEqual(a[1].tolist(), b[1].tolist(), written)
+        self.assertTrue(numpy.allclose(a[2], b[2]), written)
+
+    def test_modal_continuation(self):
+        self.assertRoundTrip(["G21 G90", "G00 X0 Y0 Z5", "G01 Z-1 F200", "X10", "Y10", "X0 Y0", "G00 Z5", "X20"])
+
+    def test_motion_code_after_axis_words(self):
+        self.assertRoundTrip(["G21 G90", "G00 X0 Y0 Z0", "X5 G01 F100", "Y5 G00", "X9"])
+
+    def test_incremental(self):
+        self.assertRoundTrip(["G21 G91", "G00 X1 Y1", "G01 X5 F300", "Y0", "Y5", "X0 Y-5", "G90 G00 X0 Y0"])
+
+    def test_arcs_in_other_planes(self):
+        self.assertRoundTrip(["G21 G90", "G00 X0 Y0 Z0", "G18 G02 X10 Z0 I5 K0 F300", "G19 G03 Y10 Z0 J5 K0",
+                              "G17 G02 X0 Y10 I-5 J0", "G18 G03 X-10 Z0 I-5 K0"])
+
+    def test_feed_only_lines(self):
+        self.assertRoundTrip(["G21 G90", "G00 X0 Y0 Z0", "G01 X5 F100", "F200", "X10", "F200", "Y5", "F50",
+                              "G02 X15 Y10 I5 J0"])
+
+if __name__ == '__main__':
+    unittest.main()
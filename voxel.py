@@ -0,0 +1,324 @@
+# Sparse voxel stock model
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# Voxels per side of a block, and blocks per side of a chunk, the unit the
+# surface is extracted in
+BLOCK = 8
+CHUNK = 8
+
+# Block slots that are not in the pool
+EMPTY = -1
+FULL = -2
+
+# Upper limit of (move, voxel) pairs tested in one vectorized batch
+BATCH_SIZE = 1 << 20
+
+# Moves shorter than this in XY only go up or down
+EPSILON = 1e-12
+
+# Voxel indices within a block, in the order of a (BLOCK, BLOCK, BLOCK) array
+LOCAL = numpy.indices((BLOCK, BLOCK, BLOCK)).reshape(3, -1).T
+
+# The corners of the unit cube
+CORNERS = numpy.indices((2, 2, 2)).reshape(3, -1).T
+
+# The faces of a voxel as (axis, side) and their corners on the unit cube,
+# counter-clockwise seen from outside
+FACES = ((0, -1), (0, 1), (1, -1), (1, 1), (2, -1), (2, 1))
+FACE_CORNERS = numpy.array([
+    ((0, 0, 0), (0, 0, 1), (0, 1, 1), (0, 1, 0)),
+    ((1, 0, 0), (1, 1, 0), (1, 1, 1), (1, 0, 1)),
+    ((0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)),
+    ((0, 1, 0), (0, 1, 1), (1, 1, 1), (1, 1, 0)),
+    ((0, 0, 0), (0, 1, 0), (1, 1, 0), (1, 0, 0)),
+    ((0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)),
+])
+
+#############
+# Functions #
+#############
+
+# The straight moves following the segments within the tolerance, none
+# longer than maxLength, as (p0, p1, owner). Arcs in any plane become chords.
+def chords(segs, tolerance, maxLength, idx=None):
+    (pts, owner, _) = segs.tessellate(tolerance, idx)
+    joined = (owner[1:] == owner[:-1])
+    (p0, p1, owner) = (pts[:-1][joined], pts[1:][joined], owner[:-1][joined])
+    pieces = numpy.maximum(numpy.ceil(numpy.linalg.norm(p1 - p0, axis=1)/maxLength), 1).astype(numpy.int64)
+    if (pieces.max(initial=1) > 1):
+        row = numpy.repeat(numpy.arange(len(p0)), pieces)
+        first = numpy.cumsum(pieces) - pieces
+        step = (numpy.arange(pieces.sum()) - first[row]).astype(float)
+        d = (p1 - p0)[row]/pieces[row][:, None]
+        (p0, p1, owner) = (p0[row] + d*step[:, None], p0[row] + d*(step[:, None] + 1), owner[row])
+    return (p0, p1, owner)
+
+# Whether the points q (M,K,3) are inside the volume swept by a flat tool
+# of the given radius and length moving from p0 to p1 (M,1,3). Over the
+# part of the move where the tool is above a point in XY, the height is
+# linear, so the point is inside when it is between the lowest tip and the
+# highest top of that part.
+def _swept(q, p0, p1, radius, length):
+    f = p0[..., :2] - q[..., :2]
+    d = (p1 - p0)[..., :2]
+    a = (d*d).sum(axis=-1)
+    b = 2*(f*d).sum(axis=-1)
+    c = (f*f).sum(axis=-1) - radius*radius
+    vertical = (a <= EPSILON)
+    a = numpy.where(vertical, 1, a)
+    disc = b*b - 4*a*c
+    root = numpy.sqrt(numpy.maximum(disc, 0))
+    t0 = numpy.where(vertical, 0, numpy.maximum((-b - root)/(2*a), 0))
+    t1 = numpy.where(vertical, 1, numpy.minimum((-b + root)/(2*a), 1))
+    inside = numpy.where(vertical, c <= 0, disc >= 0) & (t0 <= t1)
+    dz = p1[..., 2] - p0[..., 2]
+    z0 = p0[..., 2] + t0*dz
+    z1 = p0[..., 2] + t1*dz
+    return inside & (q[..., 2] >= numpy.minimum(z0, z1)) & (q[..., 2] <= numpy.maximum(z0, z1) + length)
+
+###########
+# Classes #
+###########
+
+# A volumetric stock of cubic voxels, for tool moves in any direction and
+# material left below overhangs. The grid is split in blocks of BLOCK^3
+# voxels that are either empty, full or mixed; only the mixed ones hold
+# voxels, in a shared pool, so the memory follows the machined surface
+# rather than the volume. The blocks changed since the surface was last
+# taken are marked dirty.
+class VoxelStock(object):
+    origin = None
+    cellSize = 1.0
+    # Slot in the pool of every block, or EMPTY/FULL
+    slots = None
+    pool = None
+    free = None
+    dirty = None
+
+    def __init__(self, lo, hi, cellSize):
+        self.cellSize = float(cellSize)
+        self.origin = numpy.array(lo, dtype=float)
+        span = self.cellSize*BLOCK
+        blocks = numpy.maximum(numpy.ceil((numpy.array(hi, dtype=float) - self.origin)/span), 1).astype(int)
+        self.slots = numpy.full(tuple(blocks), FULL, dtype=numpy.int32)
+        self.pool = numpy.zeros((0, BLOCK, BLOCK, BLOCK), dtype=bool)
+        self.free = []
+        self.dirty = numpy.ones(self.slots.shape, dtype=bool)
+
+        # The last blocks reach past hi, only the voxels up to it are stock
+        cells = numpy.maximum(numpy.round((numpy.array(hi, dtype=float) - self.origin)/self.cellSize), 1).astype(int)
+        coords = numpy.argwhere(numpy.ones(self.shape, dtype=bool))
+        coords = coords[numpy.any((coords + 1)*BLOCK > cells, axis=1)]
+        if (len(coords)):
+            slots = self._allocate(len(coords))
+            voxel = coords[:, None, :]*BLOCK + LOCAL[None, :, :]
+            self.pool[slots] = numpy.all(voxel < cells, axis=2).reshape(-1, BLOCK, BLOCK, BLOCK)
+            self.slots[tuple(coords.T)] = slots
+
+    @property
+    def shape(self):
+        return self.slots.shape
+
+    # Number of blocks holding voxels of their own
+    def mixed(self):
+        return len(self.pool) - len(self.free)
+
+    def _allocate(self, n):
+        slots = [self.free.pop() for _ in range(min(n, len(self.free)))]
+        extra = n - len(slots)
+        if (extra):
+            # Grow the pool by doubling
+            first = len(self.pool)
+            grow = max(extra, first)
+            self.pool = numpy.concatenate((self.pool, numpy.zeros((grow, BLOCK, BLOCK, BLOCK), dtype=bool)))
+            slots.extend(range(first, first + extra))
+            self.free.extend(range(first + extra, first + grow))
+        return numpy.array(slots, dtype=numpy.int64)
+
+    # The voxels of the blocks with the given flat indices, (N,B,B,B)
+    def material(self, ids):
+        slots = self.slots.reshape(-1)[ids]
+        voxels = numpy.zeros((len(ids), BLOCK, BLOCK, BLOCK), dtype=bool)
+        voxels[slots == FULL] = True
+        mixed = (slots >= 0)
+        voxels[mixed] = self.pool[slots[mixed]]
+        return voxels
+
+    # The (move, block) pairs of every block a move's tool can reach that
+    # still holds material, sorted by block, and whether the move removes
+    # the whole block. The swept volume is convex, so that is when it holds
+    # the outermost voxel centers of the block.
+    def _pairs(self, p0, p1, radius, length):
+        span = self.cellSize*BLOCK
+        shape = numpy.array(self.shape)
+        lo = numpy.minimum(p0, p1)
+        hi = numpy.maximum(p0, p1)
+        lo[:, :2] -= radius
+        hi[:, :2] += radius
+        hi[:, 2] += length
+        inside = numpy.all((hi >= self.origin) & (lo < self.origin + shape*span), axis=1)
+        blo = numpy.clip(numpy.floor((lo - self.origin)/span).astype(numpy.int64), 0, shape - 1)[inside]
+        bhi = numpy.clip(numpy.floor((hi - self.origin)/span).astype(numpy.int64), 0, shape - 1)[inside]
+        extent = bhi - blo + 1
+        counts = extent.prod(axis=1)
+        move = numpy.repeat(numpy.nonzero(inside)[0], counts)
+        row = numpy.repeat(numpy.arange(len(counts)), counts)
+        local = numpy.arange(counts.sum()) - (numpy.cumsum(counts) - counts)[row]
+        (ey, ez) = (extent[row, 1], extent[row, 2])
+        block = blo[row] + numpy.stack((local//(ey*ez), (local//ez) % ey, local % ez), axis=1)
+        flat = numpy.ravel_multi_index(block.T, self.shape)
+        keep = (self.slots.reshape(-1)[flat] != EMPTY)
+
+        # Drop the blocks of the bounding boxes the tool passes by in XY
+        first = self.origin + (block*BLOCK + 0.5)*self.cellSize
+        half = (BLOCK - 1)*0.5*self.cellSize
+        center = first[:, :2] + half
+        (a, d) = (p0[move, :2], (p1 - p0)[move, :2])
+        dd = (d*d).sum(axis=1)
+        t = numpy.clip(((center - a)*d).sum(axis=1)/numpy.where(dd > EPSILON, dd, 1), 0, 1)
+        gap = numpy.linalg.norm(a + d*t[:, None] - center, axis=1)
+        keep &= (gap <= radius + half*numpy.sqrt(2))
+        (move, first) = (move[keep], first[keep])
+        flat = flat[keep]
+
+        corners = first[:, None, :] + CORNERS[None, :, :]*(BLOCK - 1)*self.cellSize
+        whole = _swept(corners, p0[move][:, None, :], p1[move][:, None, :], radius, length).all(axis=1)
+        order = numpy.argsort(flat, kind="stable")
+        return (move[order], flat[order], whole[order])
+
+    # Remove the volume swept by a flat tool of the given radius and length
+    # (from its tip up) along the straight moves p0 -> p1. Returns the
+    # removed volume.
+    def cut(self, p0, p1, radius, length):
+        p0 = numpy.asarray(p0, dtype=float).reshape(-1, 3)
+        p1 = numpy.asarray(p1, dtype=float).reshape(-1, 3)
+        (move, flat, whole) = self._pairs(p0, p1, radius, length)
+        if (not len(flat)):
+            return 0.0
+        # Blocks removed whole need no voxel tests
+        cleared = numpy.unique(flat[whole])
+        partial = ~numpy.isin(flat, cleared)
+        (move, flat) = (move[partial], flat[partial])
+
+        touched = numpy.unique(flat)
+        hit = numpy.zeros((len(touched), BLOCK**3), dtype=bool)
+        per = max(BATCH_SIZE // BLOCK**3, 1)
+        for first in range(0, len(flat), per):
+            (m, f) = (move[first:first + per], flat[first:first + per])
+            block = numpy.array(numpy.unravel_index(f, self.shape)).T
+            q = self.origin + (block[:, None, :]*BLOCK + LOCAL[None, :, :] + 0.5)*self.cellSize
+            inside = _swept(q, p0[m][:, None, :], p1[m][:, None, :], radius, length)
+            # Pairs are sorted by block, so each block is one run
+            (blocks, starts) = numpy.unique(f, return_index=True)
+            pos = numpy.searchsorted(touched, blocks)
+            hit[pos] |= numpy.logical_or.reduceat(inside, starts, axis=0)
+
+        changed = hit.any(axis=1)
+        (ids, hit) = (touched[changed], hit[changed].reshape(-1, BLOCK, BLOCK, BLOCK))
+        removed = numpy.count_nonzero(self.material(cleared))
+        slots = self.slots.reshape(-1)[cleared]
+        self.free.extend(slots[slots >= 0].tolist())
+        self.slots.reshape(-1)[cleared] = EMPTY
+
+        if (len(ids)):
+            before = self.material(ids)
+            removed += numpy.count_nonzero(before & hit)
+            slots = self.slots.reshape(-1)[ids]
+            full = (slots == FULL)
+            if (full.any()):
+                slots[full] = self._allocate(numpy.count_nonzero(full))
+            self.pool[slots] = before & ~hit
+            empty = ~self.pool[slots].reshape(len(slots), -1).any(axis=1)
+            self.free.extend(slots[empty].tolist())
+            slots[empty] = EMPTY
+            self.slots.reshape(-1)[ids] = slots
+        self.mark_dirty(numpy.concatenate((cleared, ids)))
+        return removed*self.cellSize**3
+
+    # Cut the given segments, the non-rapid ones by default. Arcs are
+    # followed within a quarter voxel.
+    def cut_segments(self, segs, radius, length, idx=None):
+        if (idx is None):
+            idx = numpy.nonzero(~segs.rapid)[0]
+        if (not len(idx)):
+            return 0.0
+        (p0, p1, _) = chords(segs, self.cellSize*0.25, self.cellSize*BLOCK, idx)
+        return self.cut(p0, p1, radius, length)
+
+    # Mark blocks and their face neighbours, whose faces towards them may
+    # have been uncovered
+    def mark_dirty(self, ids):
+        coords = numpy.array(numpy.unravel_index(ids, self.shape)).T
+        self.dirty[tuple(coords.T)] = True
+        for axis in range(3):
+            for side in (-1, 1):
+                nb = coords.copy()
+                nb[:, axis] += side
+                nb = nb[numpy.all((nb >= 0) & (nb < self.shape), axis=1)]
+                self.dirty[tuple(nb.T)] = True
+
+    # The chunks holding dirty blocks, as (N,3) chunk coordinates, and clear
+    # the marks
+    def take_dirty(self):
+        coords = numpy.argwhere(self.dirty)
+        self.dirty[:] = False
+        return numpy.unique(coords // CHUNK, axis=0)
+
+    # The flat indices of the blocks of a chunk holding material
+    def chunk_blocks(self, chunk):
+        lo = numpy.asarray(chunk)*CHUNK
+        hi = numpy.minimum(lo + CHUNK, self.shape)
+        coords = numpy.argwhere(self.slots[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] != EMPTY) + lo
+        return numpy.ravel_multi_index(coords.T, self.shape)
+
+    # The boundary faces of the given blocks as (vertices, quads): every
+    # side of a full voxel that faces an empty one or the outside
+    def surface(self, ids):
+        coords = numpy.array(numpy.unravel_index(ids, self.shape)).T.reshape(-1, 3)
+        solid = self.material(ids)
+        padded = numpy.zeros((len(ids), BLOCK + 2, BLOCK + 2, BLOCK + 2), dtype=bool)
+        padded[:, 1:-1, 1:-1, 1:-1] = solid
+        for (axis, side) in FACES:
+            nb = coords.copy()
+            nb[:, axis] += side
+            valid = numpy.nonzero(numpy.all((nb >= 0) & (nb < self.shape), axis=1))[0]
+            slab = numpy.take(self.material(numpy.ravel_multi_index(nb[valid].T, self.shape)),
+                              BLOCK - 1 if side < 0 else 0, axis=axis + 1)
+            index = [valid, slice(1, -1), slice(1, -1), slice(1, -1)]
+            index[axis + 1] = 0 if side < 0 else BLOCK + 1
+            padded[tuple(index)] = slab
+
+        corners = []
+        for (f, (axis, side)) in enumerate(FACES):
+            index = [slice(None), slice(1, -1), slice(1, -1), slice(1, -1)]
+            index[axis + 1] = slice(1 + side, BLOCK + 1 + side)
+            (b, i, j, k) = numpy.nonzero(solid & ~padded[tuple(index)])
+            voxel = coords[b]*BLOCK + numpy.stack((i, j, k), axis=1)
+            corners.append(voxel[:, None, :] + FACE_CORNERS[f][None, :, :])
+        corners = numpy.concatenate(corners).reshape(-1, 3)
+        vertices = self.origin + corners*self.cellSize
+        return (vertices, numpy.arange(len(vertices)).reshape(-1, 4))
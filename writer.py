@@ -0,0 +1,327 @@
+# Compact G-code writer
+#
+# Copyright (C) 2020 Ulrik Holmen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with self program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+import gcode
+import segments
+
+###########
+# Globals #
+###########
+
+# Decimals of the numbers written
+PRECISION = 4
+
+# Characters buffered before they are written out
+CHUNK_SIZE = 1 << 16
+
+# The modal groups whose codes are dropped when already in effect
+GROUPS = {}
+for (group, codes) in (
+        ("plane", ("G17", "G18", "G19")),
+        ("distance", ("G90", "G91")),
+        ("arcDistance", ("G90.1", "G91.1")),
+        ("units", ("G20", "G21")),
+        ("feedMode", ("G93", "G94", "G95")),
+        ("retract", ("G98", "G99")),
+        ("coordinates", tuple(gcode.COORDINATE_SYSTEMS))):
+    for code in codes:
+        GROUPS[code] = group
+
+# Codes after which the program coordinates of the tool are not known, and
+# those on whose line the axis words are not program coordinates
+FORGET_CODES = set(("G10", "G28", "G30", "G43", "G49", "G53", "G92", "G92.1", "G92.2",
+                    "G92.3", "G20", "G21", "M98")) | set(gcode.COORDINATE_SYSTEMS) | set(gcode.CANNED_CYCLES)
+MACHINE_CODES = set(("G10", "G28", "G30", "G53", "G92"))
+
+LINEAR_CODES = ("G00", "G01")
+ARC_CODES = ("G02", "G03")
+
+# Plane codes of the segment planes
+PLANE_CODES = ("G17", "G18", "G19")
+
+#############
+# Functions #
+#############
+
+# A number with at most the given decimals and no trailing zeros
+def format_number(value, precision=PRECISION):
+    text = ("%.*f" % (precision, value)).rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+# Write a parsed program to a file
+def write_program(prog, path, precision=PRECISION, comments=True):
+    with open(path, "w") as fd:
+        with GCodeWriter(fd, precision, comments=comments) as writer:
+            writer.write_program(prog)
+
+# Write segment arrays to a file as a millimetre program
+def write_segments(segs, path, precision=PRECISION):
+    with open(path, "w") as fd:
+        with GCodeWriter(fd, precision) as writer:
+            writer.write_segments(segs)
+
+###########
+# Classes #
+###########
+
+# Writes G-code to a file object in large chunks, leaving out the words the
+# controller would not miss: modal codes already in effect, the motion code
+# of moves continuing in the same mode, axis words for where the tool
+# already is and feed rates and spindle speeds that did not change. What is
+# dropped is decided on the text as written, so the output reads back as the
+# same program. Anything whose effect is not known for certain (flow
+# control, offsets, canned cycles, expressions) makes the writer forget the
+# state it touches and write the next words in full.
+class GCodeWriter(object):
+    fd = None
+    precision = PRECISION
+    chunkSize = CHUNK_SIZE
+    comments = True
+    buffer = None
+    size = 0
+    # Statements written
+    count = 0
+    # The codes in effect by modal group, and the motion mode
+    modes = None
+    motion = None
+    # The axis words of the tool position as written, None when not known
+    position = None
+    # The tool position in mm for the segment arrays
+    point = None
+    feed = None
+    speed = None
+    spindleOn = None
+
+    def __init__(self, fd, precision=PRECISION, chunkSize=CHUNK_SIZE, comments=True):
+        self.fd = fd
+        self.precision = precision
+        self.chunkSize = chunkSize
+        self.comments = comments
+        self.buffer = []
+        self.modes = {}
+        self.forget()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    # Drop everything known about the machine, eg. at a jump in the program
+    def forget(self):
+        self.modes = {}
+        self.motion = None
+        self.position = [None, None, None]
+        self.point = None
+        self.feed = None
+        self.speed = None
+        self.spindleOn = None
+
+    def number(self, value):
+        return format_number(value, self.precision)
+
+    # A parameter value formatted, expressions are left as they are
+    def value(self, text):
+        try:
+            return self.number(float(text))
+        except ValueError:
+            return text
+
+    def write_line(self, line):
+        self.buffer.append(line + "\n")
+        self.size += len(line) + 1
+        self.count += 1
+        if (self.size >= self.chunkSize):
+            self.flush()
+
+    def flush(self):
+        if (self.buffer):
+            self.fd.write("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    # The words of a line joined up, with the comment if kept
+    def write_words(self, words, comment=""):
+        if (comment and self.comments):
+            words = words + [comment]
+        if (words):
+            self.write_line(" ".join(words))
+
+    # A modal code unless it is already in effect
+    def mode(self, code, words):
+        group = GROUPS.get(code)
+        if (group is None):
+            words.append(code)
+            return
+        if (self.modes.get(group) == code):
+            return
+        words.append(code)
+        self.modes[group] = code
+
+    # The axis words of a move, leaving out those not moving the tool. Zero
+    # increments only when the distance mode is known to be incremental.
+    def axes(self, params, keep=False):
+        distance = self.modes.get("distance")
+        words = []
+        for (i, axis) in enumerate("XYZ"):
+            if (axis not in params):
+                continue
+            text = self.value(params[axis])
+            if (not keep):
+                if (distance == "G91" and text == "0"):
+                    continue
+                if (distance == "G90" and text == self.position[i]):
+                    continue
+            words.append(axis + text)
+            if (distance != "G90" or keep or text[:1] in "#["):
+                self.position[i] = None
+            else:
+                self.position[i] = text
+        return words
+
+    # The motion code of a move. A line starting with an axis word moves in
+    # the mode of the last one, and a straight move going nowhere needs no
+    # code at all. Arcs without axis words are full circles and keep it.
+    def motion_code(self, code, axes, words, keep=False):
+        if (code in LINEAR_CODES and not axes and not keep):
+            return
+        if (code != self.motion or code in ARC_CODES and not axes or keep):
+            words.append(code)
+            self.motion = code
+
+    # The F and S words unless they are already in effect
+    def rates(self, params, words):
+        if ("F" in params):
+            text = self.value(params["F"])
+            if (text != self.feed):
+                words.append("F" + text)
+            self.feed = text if text[:1] not in "#[" else None
+        if ("S" in params):
+            text = self.value(params["S"])
+            if (text != self.speed):
+                words.append("S" + text)
+            self.speed = text if text[:1] not in "#[" else None
+
+    def write_statement(self, st):
+        code = st.code
+        if (code in ("O", "=")):
+            self.write_words([st.command[:len(st.command) - len(st.comment)].strip()], st.comment)
+            if (code == "O"):
+                # The statement run next is not the one written next
+                self.forget()
+            return
+
+        words = []
+        codes = set(st.modes) | set((code,))
+        keep = bool(codes & MACHINE_CODES)
+        for mode in st.modes:
+            self.mode(mode, words)
+        params = st.params
+        if (code in LINEAR_CODES or code in ARC_CODES):
+            axes = self.axes(params, keep)
+            self.motion_code(code, axes, words, keep)
+            words.extend(axes)
+            for key in "IJKRP":
+                if (key in params):
+                    words.append(key + self.value(params[key]))
+            self.rates(params, words)
+            rest = [key for key in params if key not in "XYZIJKRPFS"]
+        elif (code.startswith("F") and not params):
+            self.rates({"F": code[1:]}, words)
+            rest = []
+        elif (code.startswith("S") and not params):
+            self.rates({"S": code[1:]}, words)
+            rest = []
+        else:
+            if (code):
+                self.mode(code, words)
+            if (code in gcode.CANNED_CYCLES):
+                self.motion = code
+            elif (code == "G80"):
+                self.motion = None
+            words.extend(key + self.value(params[key]) for key in params if key in "XYZ")
+            self.rates(params, words)
+            rest = [key for key in params if key not in "XYZFS"]
+        words.extend(key + self.value(params[key]) for key in rest)
+
+        if (codes & FORGET_CODES):
+            self.position = [None, None, None]
+            self.point = None
+        if (codes & set(("M03", "M04"))):
+            self.spindleOn = True
+        elif (codes & set(("M05", "M02", "M30"))):
+            self.spindleOn = False
+        self.write_words(words, st.comment)
+
+    def write_program(self, prog):
+        for st in prog.statements:
+            self.write_statement(st)
+
+    # A move to end in mm from the segment arrays. Arcs go around the center
+    # from the start.
+    def move(self, code, start, end, center=None, feed=None):
+        words = []
+        axes = []
+        for i in range(3):
+            text = self.number(end[i])
+            if (text != self.position[i]):
+                axes.append("XYZ"[i] + text)
+                self.position[i] = text
+        self.motion_code(code, axes, words)
+        words.extend(axes)
+        if (center is not None):
+            for i in range(3):
+                text = self.number(center[i] - start[i])
+                if (text != "0"):
+                    words.append("IJK"[i] + text)
+        if (feed is not None):
+            self.rates({"F": self.number(feed)}, words)
+        self.point = numpy.array(end, dtype=float)
+        self.write_words(words)
+
+    # Write the moves of segment arrays, in their own coordinates in mm. A
+    # segment starting away from where the last ended is reached by a rapid.
+    def write_segments(self, segs):
+        words = []
+        self.mode("G21", words)
+        self.mode("G90", words)
+        self.write_words(words)
+        for i in range(len(segs)):
+            if (segs.spindleOn[i] != self.spindleOn):
+                self.write_line("M03" if segs.spindleOn[i] else "M05")
+                self.spindleOn = bool(segs.spindleOn[i])
+            start = segs.start[i]
+            if (self.point is None or any(self.number(start[k]) != self.position[k] for k in range(3))):
+                self.move("G00", start, start)
+            feed = segs.feedRate[i]*60
+            if (segs.kind[i] == segments.ARC):
+                plane = segs.plane[i]
+                words = []
+                self.mode(PLANE_CODES[plane], words)
+                self.write_words(words)
+                clockwise = (segments.ARC_AXES[(segments.PLANES[plane], True)][0] == segs.cosAxis[i])
+                self.move("G02" if clockwise else "G03", start, segs.end[i], segs.center[i], feed)
+            elif (segs.rapid[i]):
+                self.move("G00", start, segs.end[i])
+            else:
+                self.move("G01", start, segs.end[i], feed=feed)